@@ -4,6 +4,7 @@ from app.api.user import router as user_router
 from app.api.case import router as case_router
 from app.api.count import router as count_router
 from app.api.analysis import router as analysis_router
+from app.api.admin import router as admin_router
 
 router = APIRouter()
 '''
@@ -15,3 +16,4 @@ router.include_router(user_router)
 router.include_router(case_router)
 router.include_router(count_router)
 router.include_router(analysis_router)
+router.include_router(admin_router)
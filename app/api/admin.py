@@ -0,0 +1,91 @@
+from fastapi import APIRouter, Depends, HTTPException, Header
+from starlette.status import HTTP_400_BAD_REQUEST
+# custom defined
+from app.models.user import User, CaseTypeEnum
+from app.dependencies.jwt import get_current_user_authorizer
+from app.db.mongodb import AsyncIOMotorClient, get_database
+from app.db.indexes import get_index_report
+from app.dependencies.jwt import user_cache
+from app.db.cache import cache
+from app.core.config import api_key
+from app.core.metrics import metrics_response
+from app.db.profiler import query_profiler
+from app.models.common import QuerySortEnum
+from app.crud.workload import get_workload_list, rebuild_workload
+from app.utils.response import respond
+
+router = APIRouter()
+
+
+@router.get('/admin/index', tags=['admin'], name='索引使用情况及查询计划')
+async def get_admin_index(
+        user: User = Depends(get_current_user_authorizer(required=True)),
+        db: AsyncIOMotorClient = Depends(get_database)
+):
+    if not user.is_admin:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    return await get_index_report(client=db)
+
+
+@router.get('/admin/cache', tags=['admin'], name='缓存命中情况')
+async def get_admin_cache(
+        user: User = Depends(get_current_user_authorizer(required=True))
+):
+    if not user.is_admin:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    return {'user': user_cache.stats(), 'shared': cache.stats()}
+
+
+@router.get('/admin/metrics', tags=['admin'], name='Prometheus监控指标')
+async def get_admin_metrics(
+        x_api_key: str = Header(None),
+        user: User = Depends(get_current_user_authorizer(required=False))
+):
+    # 管理员token或X-API-Key请求头均可访问，便于Prometheus抓取
+    if x_api_key != api_key and not (user and user.is_admin):
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    return metrics_response()
+
+
+@router.get('/admin/query', tags=['admin'], name='查询耗时排行')
+async def get_admin_query(
+        top: int = 20, sort: QuerySortEnum = QuerySortEnum.T,
+        user: User = Depends(get_current_user_authorizer(required=True))
+):
+    if not user.is_admin:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    return {'data': query_profiler.top(n=top, sort=sort.value)}
+
+
+@router.delete('/admin/query', tags=['admin'], name='清空查询耗时统计')
+async def delete_admin_query(
+        user: User = Depends(get_current_user_authorizer(required=True))
+):
+    if not user.is_admin:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    query_profiler.reset()
+    return {'msg': '操作成功'}
+
+
+@router.get('/admin/workload', tags=['admin'], name='用户工作量统计')
+async def get_admin_workload(
+        case_type: CaseTypeEnum = None, month: str = None,
+        user: User = Depends(get_current_user_authorizer(required=True)),
+        db: AsyncIOMotorClient = Depends(get_database)
+):
+    # month为年月，例如2104；pending、finished按工作类型C、MA、SA分别统计
+    if not user.is_admin:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    data = await get_workload_list(conn=db, case_type=case_type.value if case_type else None, month=month)
+    return respond({'data': data})
+
+
+@router.post('/admin/workload/rebuild', tags=['admin'], name='重新统计用户工作量')
+async def post_admin_workload_rebuild(
+        user: User = Depends(get_current_user_authorizer(required=True)),
+        db: AsyncIOMotorClient = Depends(get_database)
+):
+    if not user.is_admin:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    await rebuild_workload(conn=db)
+    return {'msg': '操作成功'}
@@ -4,12 +4,15 @@ from typing import List
 from datetime import datetime
 # custom defined
 from app.models.user import User
-from app.core.config import timezone
+from app.core.config import timezone, fast_response
 from app.dependencies.jwt import get_current_user_authorizer
 from app.db.mongodb import AsyncIOMotorClient, get_database
-from app.crud.analysis import get_one_analysis_by_query, update_analysis_by_query_with_item, get_analysis_list_by_query
-
-# from app.models.analysis import AnalysisUpdateModel
+from app.crud.analysis import get_one_analysis_by_query, get_analysis_list_by_query, \
+    update_and_get_analysis_by_query_with_item, update_analysis_list_by_user
+from app.crud.case import update_case_view_by_analysis, update_case_view_list
+from app.crud.workload import finish_workload
+from app.models.analysis import AnalysisPatchItem
+from app.utils.response import respond
 
 router = APIRouter()
 
@@ -20,17 +23,34 @@ async def patch_analysis(
         user: User = Depends(get_current_user_authorizer(required=True)),
         db: AsyncIOMotorClient = Depends(get_database)
 ):
-    data_analysis = await get_one_analysis_by_query(conn=db, query={'case_id': case_id, 'user_id': user.id})
-    if not data_analysis:
-        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='非分配用户无法修改')
     item = {}
     if analysis is not None:
         item['analysis'] = analysis
     if karyotype is not None:
         item['karyotype'] = karyotype
     item['update_time'] = datetime.now(tz=timezone).isoformat()
-    await update_analysis_by_query_with_item(conn=db, query={'case_id': case_id, 'user_id': user.id}, item=item)
-    return {'msg': '提交成功'}
+    data_analysis = await update_and_get_analysis_by_query_with_item(
+        conn=db, query={'case_id': case_id, 'user_id': user.id}, item=item)
+    if not data_analysis:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='非分配用户无法修改')
+    await update_case_view_by_analysis(conn=db, case_id=case_id, user_id=user.id, item=item)
+    await finish_workload(conn=db, task='analysis', user_id=user.id, case_ids=[case_id])
+    return {'msg': '提交成功', 'data': data_analysis}
+
+
+@router.patch('/analysis/batch', tags=['analysis'], name='批量录入分析数据')
+async def patch_analysis_batch(
+        data: List[AnalysisPatchItem] = Body(..., embed=True),
+        user: User = Depends(get_current_user_authorizer(required=True)),
+        db: AsyncIOMotorClient = Depends(get_database)
+):
+    update_time = datetime.now(tz=timezone).isoformat()
+    items = {x.case_id: {**x.dict(exclude={'case_id'}, exclude_none=True), 'update_time': update_time} for x in data}
+    success = await update_analysis_list_by_user(conn=db, user_id=user.id, items=items)
+    await update_case_view_list(conn=db, task='analysis', user_id=user.id, items={x: items[x] for x in success})
+    await finish_workload(conn=db, task='analysis', user_id=user.id, case_ids=success)
+    error = [{'case_id': x, 'error': '非分配用户无法修改'} for x in items if x not in set(success)]
+    return {'msg': '提交成功', 'success': success, 'error': error}
 
 
 @router.get('/analysis', tags=['analysis'], name='获取单个分析数据')
@@ -50,5 +70,5 @@ async def get_analysis_me(
         user: User = Depends(get_current_user_authorizer(required=True)),
         db: AsyncIOMotorClient = Depends(get_database)
 ):
-    data_analysis = await get_analysis_list_by_query(conn=db, query={'user_id': user.id})
-    return {'data': data_analysis}
+    data_analysis = await get_analysis_list_by_query(conn=db, query={'user_id': user.id}, raw=fast_response)
+    return respond({'data': data_analysis})
@@ -1,20 +1,31 @@
-from fastapi import APIRouter, Depends, HTTPException, Body
-from fastapi.responses import FileResponse
-from starlette.status import HTTP_400_BAD_REQUEST
+from fastapi import APIRouter, Depends, HTTPException, Body, Header, Request, WebSocket
+from pydantic import ValidationError
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.status import HTTP_400_BAD_REQUEST, WS_1008_POLICY_VIOLATION
+from starlette.websockets import WebSocketDisconnect
 from typing import List
-import pandas as pd
 import logging
-import time
+import asyncio
+import json
 import os
 # custom defined
 from app.models.user import User
-from app.models.case import CaseCreateModel, CaseImportRequest
-from app.dependencies.jwt import get_current_user_authorizer
+from app.models.case import CaseCreateModel, CaseImportRequest, CaseBatchImportRequest, CaseImportResult, \
+    CaseImportStatusEnum, ExportJobModel, ExportJobStatusEnum
+from app.dependencies.jwt import get_current_user_authorizer, get_user_by_token
 from app.db.mongodb import AsyncIOMotorClient, get_database
-from app.crud.case import get_case_list_with_analysis_and_count_by_query, get_case_list_by_query, \
-    create_case_list_with_item, get_one_case_with_analysis_and_count_by_query, count_case_by_query
+from app.db.cache import cache, CASE_LIST, CASE_TOTAL
+from app.crud.case import get_case_list_with_analysis_and_count_by_query, get_exist_case_id_set, \
+    create_case_list_with_item, count_case_view_by_query, create_case_with_analysis_and_count
 from app.crud.user import get_one_user_by_query
-from app.core.config import api_key, export_path
+from app.core.config import api_key, export_path, approx_total_cap, import_max_cases, fast_response
+from app.utils.assignment import get_assignment_table, build_assignment
+from app.models.common import TotalEnum
+from app.utils.pagination import decode_cursor, next_cursor
+from app.utils.export_job import export_jobs
+from app.utils.response import respond
+from app.utils.push import push_hub
 
 from app.crud.analysis import get_analysis_list_by_query
 from app.crud.count import get_one_count_by_query
@@ -28,10 +39,10 @@ async def post_case_import(
         db: AsyncIOMotorClient = Depends(get_database)
 ):
     # data里只会有一个样本，暂时排除重复排序的情况
-    # TODO 有可能会重复导入，所以需要考虑冥等性
+    # 按case_id幂等写入，并发重复导入也不会产生重复数据
     if API_KEY != api_key:
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='wrong key')
-    data_case = await get_case_list_by_query(conn=db, query={'case_id': case_id})
+    data_case = await get_exist_case_id_set(conn=db, case_ids=[case_id] + [x.case_id for x in data])
     if data_case:
         logging.info('Case Import Debug: 已有数据')
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='已有数据')
@@ -42,16 +53,73 @@ async def post_case_import(
     # 创建analysis表，附带分配工作
 
 
+@router.post('/case/import/batch', tags=['case', 'admin'], name='样本数据批量入口')
+async def post_case_import_batch(
+        request: Request, x_api_key: str = Header(None),
+        db: AsyncIOMotorClient = Depends(get_database)
+):
+    '''
+        application/json: {"API_KEY": "...", "data": [{"case_id": "..."}]}
+        application/x-ndjson: 每行一个{"case_id": "..."}，API_KEY放在X-API-Key请求头
+        与扫描使用同一分工分配，返回每个样本的处理结果
+    '''
+    body = await request.body()
+    try:
+        if 'ndjson' in request.headers.get('content-type', ''):
+            data = CaseBatchImportRequest(API_KEY=x_api_key, data=[
+                json.loads(x) for x in body.decode().splitlines() if x.strip()])
+        else:
+            data = CaseBatchImportRequest.parse_obj(json.loads(body))
+    except (ValueError, ValidationError):
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='数据格式错误')
+    if (data.API_KEY or x_api_key) != api_key:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='wrong key')
+    if len(data.data) > import_max_cases:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f'单次最多导入{import_max_cases}个样本')
+    # 请求内去重，保持原顺序
+    case_ids = list(dict.fromkeys(x.case_id for x in data.data))
+    # 一次查询排除已有样本
+    exist_ids = await get_exist_case_id_set(conn=db, case_ids=case_ids)
+    outcomes = {x: CaseImportStatusEnum.E for x in exist_ids}
+    table = await get_assignment_table(conn=db)
+    case_item, analysis_item, count_item, created = build_assignment(
+        table=table, case_ids=[x for x in case_ids if x not in exist_ids])
+    outcomes.update(created)
+    if case_item:
+        _, inserted = await create_case_with_analysis_and_count(conn=db, case_item=case_item,
+                                                                analysis_item=analysis_item, count_item=count_item)
+        # 并发导入时case已由另一请求写入
+        for x in case_item:
+            if x.case_id not in inserted:
+                outcomes[x.case_id] = CaseImportStatusEnum.E
+    result = [CaseImportResult(case_id=x, status=outcomes[x]) for x in case_ids]
+    seen = set()
+    for x in data.data:
+        if x.case_id in seen:
+            result.append(CaseImportResult(case_id=x.case_id, status=CaseImportStatusEnum.D))
+        seen.add(x.case_id)
+    summary = {}
+    for x in result:
+        summary[x.status.value] = summary.get(x.status.value, 0) + 1
+    return {'summary': summary, 'data': result}
+
+
 @router.get('/case/list', tags=['case'], name='获取样本列表')
 async def get_case_list(
         user: User = Depends(get_current_user_authorizer(required=True)),
         db: AsyncIOMotorClient = Depends(get_database)
 ):
+    data_case = await cache.get(CASE_LIST, user.id)
+    if data_case is not None:
+        return respond(data_case)
     # 筛选count或analysis中该用户拥有权限的case
     data_case = await get_case_list_with_analysis_and_count_by_query(conn=db, user_id=user.id, query={
         '$or': [{'count.user_id': user.id}, {'analysis.user_id': user.id}],
         'finished': False
-    })
+    }, raw=fast_response)
+    if not fast_response:
+        data_case = jsonable_encoder(data_case)
+    await cache.set(CASE_LIST, user.id, data_case)
     # return_obj = []
     # work = None
     # for x in data_case:
@@ -87,19 +155,100 @@ async def get_case_list(
     #         },
     #         'work': work
     #     })
-    return data_case
+    return respond(data_case)
+
+
+@router.get('/case/stream', tags=['case'], name='工作列表变更推送(SSE)')
+async def get_case_stream(
+        request: Request,
+        token: str = None,
+        user: User = Depends(get_current_user_authorizer(required=False)),
+        db: AsyncIOMotorClient = Depends(get_database)
+):
+    '''
+        先调用/case/list获取完整列表，之后按推送的消息增量更新：
+        upsert 新增或替换该case_id，remove 移出列表，reload 重新调用/case/list，ping 心跳
+        浏览器EventSource无法设置Header时token通过参数传入
+    '''
+    if user is None:
+        if not token:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='未登录')
+        user = await get_user_by_token(db=db, token=token)
+    queue = push_hub.subscribe(user.id)
+
+    async def event_stream():
+        try:
+            while not await request.is_disconnected():
+                message = await push_hub.next_message(queue)
+                yield f'data: {json.dumps(message, ensure_ascii=False, default=str)}\n\n'
+        finally:
+            push_hub.unsubscribe(user.id, queue)
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@router.websocket('/case/ws')
+async def case_websocket(websocket: WebSocket, token: str, db: AsyncIOMotorClient = Depends(get_database)):
+    # 与/case/stream消息一致，token通过参数传入
+    try:
+        user = await get_user_by_token(db=db, token=token)
+    except Exception:
+        await websocket.close(code=WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    queue = push_hub.subscribe(user.id)
+    # 客户端不需要发送消息，只用于感知断开
+    receiver = asyncio.ensure_future(websocket.receive_text())
+    sender = None
+    try:
+        while True:
+            # 取消息的任务在发送前不取消，已从队列取出的消息不会丢失
+            if sender is None:
+                sender = asyncio.ensure_future(push_hub.next_message(queue))
+            await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver.done():
+                # 客户端断开时抛出WebSocketDisconnect
+                receiver.result()
+                receiver = asyncio.ensure_future(websocket.receive_text())
+            if sender.done():
+                await websocket.send_text(json.dumps(sender.result(), ensure_ascii=False, default=str))
+                sender = None
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        if sender is not None:
+            sender.cancel()
+        push_hub.unsubscribe(user.id, queue)
 
 
 @router.get('/case/total', tags=['case'], name='样本数据汇总')
 async def get_case_total(
-        finished: bool = True, page: int = 1, limit: int = 20,
+        finished: bool = True, page: int = 1, limit: int = 20, cursor: str = None, total: TotalEnum = TotalEnum.E,
         user: User = Depends(get_current_user_authorizer(required=True)),
         db: AsyncIOMotorClient = Depends(get_database)
 ):
+    # cursor为上一页返回的next，有值时忽略page
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='无效的分页标记')
+    cache_key = f'{finished}:{page}:{limit}:{after}:{total.value}'
+    result = await cache.get(CASE_TOTAL, cache_key)
+    if result is not None:
+        return respond(result)
     data_case = await get_case_list_with_analysis_and_count_by_query(conn=db, query={'finished': finished}, page=page,
-                                                                     limit=limit)
-    total = await count_case_by_query(conn=db, query={'finished': finished})
-    return {'data': data_case, 'total': total}
+                                                                     limit=limit, after=after, raw=fast_response)
+    count = None
+    if total != TotalEnum.N:
+        count = await count_case_view_by_query(conn=db, query={'finished': finished},
+                                               limit=approx_total_cap if total == TotalEnum.A else None)
+    result = {'data': data_case, 'total': count, 'next': next_cursor(data=data_case, key='case_id', limit=limit)}
+    if not fast_response:
+        result = jsonable_encoder(result)
+    await cache.set(CASE_TOTAL, cache_key, result)
+    return respond(result)
 
 
 @router.post('/case/export', tags=['admin'], name='导出样本汇总数据')
@@ -110,61 +259,47 @@ async def post_case_export(
 ):
     if not user.is_admin:
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
-    export_list = []
-    error_list = []
-    excel_data = {'编号': [], '分析1': [], '分析2': [], '分析3': [], '分析4': [], '分析5': [], '核型1': [], '核型1-主看者': [], '主看时间': [],
-                  '核型2': [], '核型2-辅看者': [], '辅看时间': [], '计数1': [], '计数2': [], '计数3': [], '计数4': [], '计数5': [],
-                  '计数6': [], '计数7': [], '计数8': [], '计数9': [], '计数10': [], '计数11': [], '计数12': [], '计数13': [],
-                  '计数14': [], '计数15': [], '计数者': [], '计数时间': [], '计数备注': []}
-    # 需要检查主辅分析是否填完，分析结果是否一致，计数是否15个完整
-    for case_id in case_list:
-        status = True
-        data_case = await get_one_case_with_analysis_and_count_by_query(conn=db, query={'case_id': case_id})
-        # 先判断是否完成填写
-        for x in data_case.analysis:
-            if x.is_main is True and len(x.analysis) != 3:
-                error_list.append({'case_id': data_case.case_id, 'error': '未完成主分析'})
-                status = False
-                # raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='未完成主分析')
-            elif x.is_main is False and len(x.analysis) != 2:
-                error_list.append({'case_id': data_case.case_id, 'error': '未完成辅分析'})
-                status = False
-                # raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='未完成辅分析')
-        if data_case.analysis[0].karyotype != data_case.analysis[1].karyotype:
-            error_list.append({'case_id': data_case.case_id, 'error': '主辅分析结果不一致'})
-            status = False
-            # raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='主辅分析结果不一致')
-        if len(data_case.count.count) != 15:
-            error_list.append({'case_id': data_case.case_id, 'error': '未完成计数'})
-            status = False
-            # raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='未完成计数')
-        for x in data_case.analysis:
-            if status is True and x.is_main is True:
-                excel_data['分析1'].append(x.analysis[0])
-                excel_data['分析2'].append(x.analysis[1])
-                excel_data['分析3'].append(x.analysis[2])
-                excel_data['核型1'].append(x.karyotype)
-                excel_data['核型1-主看者'].append(x.realname)
-                excel_data['主看时间'].append(x.update_time)
-            elif status is True and x.is_main is False:
-                excel_data['分析4'].append(x.analysis[0])
-                excel_data['分析5'].append(x.analysis[1])
-                excel_data['核型2'].append(x.karyotype)
-                excel_data['核型2-辅看者'].append(x.realname)
-                excel_data['辅看时间'].append(x.update_time)
-        if status is True:
-            export_list.append(data_case.case_id)
-            excel_data['编号'].append(data_case.case_id)
-            # 组装15个计数
-            for n in range(len(data_case.count.count)):
-                excel_data[f'计数{n + 1}'].append(data_case.count.count[n])
-            excel_data['计数者'].append(data_case.count.realname)
-            excel_data['计数时间'].append(data_case.count.update_time)
-            excel_data['计数备注'].append(data_case.count.remark)
-    df = pd.DataFrame(excel_data)
-    filename = str(time.time()).split('.')[0]
-    df.to_excel(f'{export_path}/{filename}.xlsx')
-    return {'success': export_list, 'error': error_list, 'file': f'{filename}.xlsx'}
+    # 经任务队列执行，相同请求复用进行中的任务
+    job = await export_jobs.wait((await export_jobs.submit(case_list=case_list)).job_id)
+    if job is None or job.status != ExportJobStatusEnum.F:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='导出失败')
+    return {'success': job.success, 'error': job.error, 'file': job.file}
+
+
+@router.post('/case/export/job', tags=['admin'], name='提交导出任务')
+async def post_case_export_job(
+        case_list: List[str] = Body(..., embed=True),
+        user: User = Depends(get_current_user_authorizer(required=True))
+):
+    if not user.is_admin:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    job = await export_jobs.submit(case_list=case_list)
+    return {'data': {'job_id': job.job_id}}
+
+
+@router.get('/case/export/job', tags=['admin'], response_model=ExportJobModel, name='查询导出任务进度')
+async def get_case_export_job(
+        job_id: str,
+        user: User = Depends(get_current_user_authorizer(required=True))
+):
+    if not user.is_admin:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    job = await export_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='未找到该任务')
+    return job
+
+
+@router.delete('/case/export/job', tags=['admin'], name='取消导出任务')
+async def delete_case_export_job(
+        job_id: str,
+        user: User = Depends(get_current_user_authorizer(required=True))
+):
+    if not user.is_admin:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
+    if not await export_jobs.cancel(job_id):
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='任务不存在或已结束')
+    return {'msg': '操作成功'}
 
 
 @router.get('/case/export', tags=['admin'], name='下载导出文件')
@@ -4,10 +4,15 @@ from typing import List
 from datetime import datetime
 # custom defined
 from app.models.user import User
-from app.core.config import timezone
+from app.core.config import timezone, fast_response
 from app.dependencies.jwt import get_current_user_authorizer
 from app.db.mongodb import AsyncIOMotorClient, get_database
-from app.crud.count import get_one_count_by_query, update_count_by_query_with_item, get_count_list_by_query
+from app.crud.count import get_one_count_by_query, get_count_list_by_query, update_and_get_count_by_query_with_item, \
+    update_count_list_by_user
+from app.crud.case import update_case_view_by_count, update_case_view_list
+from app.crud.workload import finish_workload
+from app.models.count import CountPatchItem
+from app.utils.response import respond
 
 router = APIRouter()
 
@@ -19,9 +24,6 @@ async def patch_count(
         user: User = Depends(get_current_user_authorizer(required=True)),
         db: AsyncIOMotorClient = Depends(get_database)
 ):
-    data_count = await get_one_count_by_query(conn=db, query={'case_id': case_id})
-    if data_count.user_id != user.id:
-        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='非分配本人不可修改')
     item = {}
     if count is not None:
         item['count'] = count
@@ -30,8 +32,28 @@ async def patch_count(
     if remark is not None:
         item['remark'] = remark
     item['update_time'] = datetime.now(tz=timezone).isoformat()
-    await update_count_by_query_with_item(conn=db, query={'case_id': case_id, 'user_id': user.id}, item=item)
-    return {'msg': '修改成功'}
+    data_count = await update_and_get_count_by_query_with_item(
+        conn=db, query={'case_id': case_id, 'user_id': user.id}, item=item)
+    if not data_count:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='非分配本人不可修改')
+    await update_case_view_by_count(conn=db, case_id=case_id, user_id=user.id, item=item)
+    await finish_workload(conn=db, task='count', user_id=user.id, case_ids=[case_id])
+    return {'msg': '修改成功', 'data': data_count}
+
+
+@router.patch('/count/batch', tags=['count'], name='批量修改计数数据')
+async def patch_count_batch(
+        data: List[CountPatchItem] = Body(..., embed=True),
+        user: User = Depends(get_current_user_authorizer(required=True)),
+        db: AsyncIOMotorClient = Depends(get_database)
+):
+    update_time = datetime.now(tz=timezone).isoformat()
+    items = {x.case_id: {**x.dict(exclude={'case_id'}, exclude_none=True), 'update_time': update_time} for x in data}
+    success = await update_count_list_by_user(conn=db, user_id=user.id, items=items)
+    await update_case_view_list(conn=db, task='count', user_id=user.id, items={x: items[x] for x in success})
+    await finish_workload(conn=db, task='count', user_id=user.id, case_ids=success)
+    error = [{'case_id': x, 'error': '非分配本人不可修改'} for x in items if x not in set(success)]
+    return {'msg': '修改成功', 'success': success, 'error': error}
 
 
 @router.get('/count', tags=['count'], name='获取单个计数数据')
@@ -51,5 +73,5 @@ async def get_count_me(
         user: User = Depends(get_current_user_authorizer(required=True)),
         db: AsyncIOMotorClient = Depends(get_database)
 ):
-    data_count = await get_count_list_by_query(conn=db, query={'user_id': user.id})
-    return {'data': data_count}
+    data_count = await get_count_list_by_query(conn=db, query={'user_id': user.id}, raw=fast_response)
+    return respond({'data': data_count})
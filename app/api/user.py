@@ -1,19 +1,25 @@
 from fastapi import APIRouter, Depends, HTTPException, Body
 from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.encoders import jsonable_encoder
 from starlette.status import HTTP_400_BAD_REQUEST
 # custom defined
 from app.models.user import UserCreate, User, TokenResponse, UserListResponse, UserCreateRequest, RolePatchRequest, \
-    RoleCreateModel, GroupEnum, CaseTypeEnum, DivisionCreateModel, RoleWithDivisionModel
+    RoleCreateModel, GroupEnum, CaseTypeEnum, DivisionCreateModel
 from app.crud.user import create_user, get_user, get_user_list_by_query_with_page_and_limit, count_user_by_query, \
     get_user_by_name, update_role_with_item, create_role_with_item, delete_group_by_query, \
     get_one_group_by_query, get_one_user_by_query, create_division_with_item, get_one_division_by_query, \
-    update_division_by_query_with_item, get_group_list, get_division_list_unfold_user_by_query, delete_user_by_query, \
+    update_division_by_query_with_item, get_group_list_with_division, delete_user_by_query, \
     delete_division_by_query, update_user_info_by_query_with_item
-from app.dependencies.jwt import get_current_user_authorizer
+from app.crud.case import update_case_view_realname
+from app.dependencies.jwt import get_current_user_authorizer, invalidate_user_cache
 from app.utils.jwt import create_access_token
 from app.db.mongodb import AsyncIOMotorClient, get_database
-from app.core.config import api_key as API_KEY
-from app.utils.security import generate_salt, get_password_hash, verify_password
+from app.db.cache import cache, GROUP
+from app.core.config import api_key as API_KEY, approx_total_cap
+from app.models.common import TotalEnum
+from app.utils.pagination import decode_cursor, next_cursor
+from app.utils.security import generate_salt, get_password_hash_async
+from app.utils.assignment import invalidate_assignment_table
 
 router = APIRouter()
 
@@ -23,7 +29,7 @@ async def login(user: OAuth2PasswordRequestForm = Depends(), db: AsyncIOMotorCli
     dbuser = await get_user(conn=db, query={'username': user.username})
     if not dbuser:
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='用户名错误')
-    elif not dbuser.check_password(user.password):
+    elif not await dbuser.check_password_async(user.password):
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='密码错误')
     token = create_access_token(data={"id": dbuser.id})
     # swaggerui 要求返回此格式
@@ -54,21 +60,25 @@ async def post_users(
 
 @router.get('/user_list', tags=['admin'], response_model=UserListResponse, name='用户列表获取')
 async def get_user_list(
-        search: str = None, page: int = 1, limit: int = 20,
+        search: str = None, page: int = 1, limit: int = 20, cursor: str = None, total: TotalEnum = TotalEnum.E,
         user: User = Depends(get_current_user_authorizer(required=True)),
         db: AsyncIOMotorClient = Depends(get_database)
 ):
     if not user.is_admin:
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
-    data_user = await get_user_list_by_query_with_page_and_limit(conn=db,
-                                                                 query={'$or': [{'username': {'$regex': search}}, {
-                                                                     'realname': {
-                                                                         '$regex': search}}]} if search else {},
-                                                                 page=page, limit=limit)
-    total = await count_user_by_query(conn=db, query={'$or': [{'username': {'$regex': search}}, {
-        'realname': {
-            '$regex': search}}]} if search else {})
-    return UserListResponse(data=data_user, total=total)
+    # cursor为上一页返回的next，有值时忽略page
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='无效的分页标记')
+    query = {'$or': [{'username': {'$regex': search}}, {'realname': {'$regex': search}}]} if search else {}
+    data_user = await get_user_list_by_query_with_page_and_limit(conn=db, query=query, page=page, limit=limit,
+                                                                 after=after)
+    count = None
+    if total != TotalEnum.N:
+        count = await count_user_by_query(conn=db, query=query,
+                                          limit=approx_total_cap if total == TotalEnum.A else None)
+    return UserListResponse(data=data_user, total=count, next=next_cursor(data=data_user, key='id', limit=limit))
 
 
 @router.get('/user/me', tags=['user'], name='用户个人信息')
@@ -104,6 +114,7 @@ async def delete_user(
     if data_division:
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='该用户还有任务，不可删除')
     await delete_user_by_query(conn=db, query={'id': user_id})
+    await invalidate_user_cache(user_id)
     return {'msg': '操作成功'}
 
 
@@ -114,6 +125,9 @@ async def patch_user(
         db: AsyncIOMotorClient = Depends(get_database)
 ):
     await update_user_info_by_query_with_item(conn=db, query={'id': user.id}, item={'$set': {'realname': realname}})
+    await update_case_view_realname(conn=db, user_id=user.id, realname=realname)
+    await invalidate_user_cache(user.id)
+    await invalidate_assignment_table(conn=db)
     return {'msg': '操作成功'}
 
 
@@ -124,14 +138,15 @@ async def patch_user_password(
         db: AsyncIOMotorClient = Depends(get_database)
 ):
     data_user = await get_user(conn=db, query={'id': user.id})
-    if not data_user.check_password(password=old_password):
+    if not await data_user.check_password_async(password=old_password):
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='旧密码错误')
     item = {}
     salt = generate_salt()
-    hashed_password = get_password_hash(salt + new_password)
+    hashed_password = await get_password_hash_async(salt + new_password)
     item['salt'] = salt
     item['hashed_password'] = hashed_password
     await update_user_info_by_query_with_item(conn=db, query={'id': user.id}, item={'$set': item})
+    await invalidate_user_cache(user.id)
     return {'msg': '操作成功'}
 
 
@@ -144,6 +159,7 @@ async def patch_group(
     if not user.is_admin:
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
     await update_role_with_item(conn=db, query={'id': group_id}, item=RolePatchRequest(group_name=group_name))
+    await invalidate_assignment_table(conn=db)
     return {'msg': '修改成功'}
 
 
@@ -164,16 +180,12 @@ async def get_group(
         user: User = Depends(get_current_user_authorizer(required=True)),
         db: AsyncIOMotorClient = Depends(get_database)
 ):
-    data_group = await get_group_list(conn=db)
-    return_obj = []
-    for x in data_group:
-        data_division = await get_division_list_unfold_user_by_query(conn=db, query={'group_id': x.id})
-        return_obj.append(RoleWithDivisionModel(
-            id=x.id,
-            group_name=x.group_name,
-            group_type=x.group_type,
-            division=data_division
-        ))
+    return_obj = await cache.get(GROUP, 'all')
+    if return_obj is not None:
+        return return_obj
+    return_obj = await get_group_list_with_division(conn=db)
+    return_obj = jsonable_encoder(return_obj)
+    await cache.set(GROUP, 'all', return_obj)
     return return_obj
 
 
@@ -190,6 +202,7 @@ async def delete_group(
     if data_division:
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='该分组下还有任务，不可删除')
     await delete_group_by_query(conn=db, query={'id': group_id})
+    await invalidate_assignment_table(conn=db)
     return {'msg': '操作成功'}
 
 
@@ -221,6 +234,7 @@ async def post_division(
         case_type=case_type,
         quantities=quantities
     ))
+    await invalidate_assignment_table(conn=db)
     return {'data': {'division_id': division_id}}
 
 
@@ -237,6 +251,7 @@ async def patch_division(
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='无效的分组')
     await update_division_by_query_with_item(conn=db, query={'id': division_id},
                                              item={'$set': {'quantities': quantities}})
+    await invalidate_assignment_table(conn=db)
     return {'msg': '修改成功'}
 
 
@@ -249,4 +264,5 @@ async def delete_division(
     if user.is_admin is False:
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail='权限不足')
     await delete_division_by_query(conn=db, query={'id': division_id})
+    await invalidate_assignment_table(conn=db)
     return {'msg': '操作成功'}
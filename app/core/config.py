@@ -31,15 +31,91 @@ analysis_collection_name: str = config('analysis_collection_name', cast=str, def
 count_collection_name: str = config('count_collection_name', cast=str, default='count')
 group_collection_name: str = config('group_collection_name', cast=str, default='group')
 division_collection_name: str = config('division_collection_name', cast=str, default='division')
+case_view_collection_name: str = config('case_view_collection_name', cast=str, default='case_view')
+scan_cursor_collection_name: str = config('scan_cursor_collection_name', cast=str, default='scan_cursor')
+scan_file_collection_name: str = config('scan_file_collection_name', cast=str, default='scan_file')
+lock_collection_name: str = config('lock_collection_name', cast=str, default='lock')
+export_job_collection_name: str = config('export_job_collection_name', cast=str, default='export_job')
+workload_collection_name: str = config('workload_collection_name', cast=str, default='workload')
+version_collection_name: str = config('version_collection_name', cast=str, default='version')
+
+# 密码哈希校验线程数
+password_workers: int = config('password_workers', cast=int, default=4)
+
+# 登录用户缓存数量及有效期（秒）
+user_cache_size: int = config('user_cache_size', cast=int, default=1024)
+user_cache_ttl: int = config('user_cache_ttl', cast=int, default=60)
+
+# 批量写入每批条数、临时错误重试次数、是否使用事务（需副本集）
+bulk_chunk_size: int = config('bulk_chunk_size', cast=int, default=1000)
+bulk_retries: int = config('bulk_retries', cast=int, default=3)
+bulk_use_transaction: bool = config('bulk_use_transaction', cast=bool, default=False)
+
+# 列表接口快速响应：数据库行不经模型校验直接用orjson输出
+fast_response: bool = config('fast_response', cast=bool, default=False)
+
+# 慢查询阈值（毫秒），每种查询形态保留的耗时样本数及最多统计的形态数，同一形态两次explain的最小间隔（秒）
+slow_query_ms: int = config('slow_query_ms', cast=int, default=100)
+query_stats_window: int = config('query_stats_window', cast=int, default=1000)
+query_stats_max: int = config('query_stats_max', cast=int, default=500)
+slow_query_explain_interval: int = config('slow_query_explain_interval', cast=int, default=300)
+
+# 分页估算总数时的计数上限
+approx_total_cap: int = config('approx_total_cap', cast=int, default=10000)
 
 # redis
 redis_host: str = config('redis_host', cast=str, default='127.0.0.1')
 redis_port: int = config('redis_port', cast=int, default=6379)
 redis_password: str = config('redis_password', cast=str, default=None)
+# 接口缓存，local: 进程内，redis: 多worker共享（redis不可用时退化为进程内）
+cache_backend: str = config('cache_backend', cast=str, default='local')
+cache_prefix: str = config('cache_prefix', cast=str, default='chromo')
+cache_ttl: int = config('cache_ttl', cast=int, default=30)
 
 # 导出路径
 export_path: str = config('export_path', cast=str, default='D:\chromo-manager-export')
+# 批量导入单次最多样本数
+import_max_cases: int = config('import_max_cases', cast=int, default=5000)
+# 导出时每批查询的样本数
+export_batch_size: int = config('export_batch_size', cast=int, default=500)
+# 同时执行的导出任务数及保留的已结束任务数
+export_max_jobs: int = config('export_max_jobs', cast=int, default=2)
+export_keep_jobs: int = config('export_keep_jobs', cast=int, default=100)
+# 导出任务心跳间隔（秒），超过export_job_timeout_seconds未更新视为执行的worker已退出
+export_heartbeat_seconds: float = config('export_heartbeat_seconds', cast=float, default=10)
+export_job_timeout_seconds: float = config('export_job_timeout_seconds', cast=float, default=60)
 # 扫描路径
 src_path: str = config('src_path', cast=str, default='/media/msd')
 # 文件后缀
 src_ext: str = config('src_ext', cast=str, default='MMI')
+# 扫描方式，interval: 定时轮询，watch: 文件事件触发（inotify，不可用时退化为轮询目录mtime）
+scan_mode: str = config('scan_mode', cast=str, default='interval')
+scan_interval_minutes: int = config('scan_interval_minutes', cast=int, default=10)
+# 扫描最近几个月份目录（含当月），0为扫描全部月份目录用于补录
+scan_month_window: int = config('scan_month_window', cast=int, default=2)
+# 扫描线程数及单批入库文件数
+scan_workers: int = config('scan_workers', cast=int, default=4)
+scan_batch_size: int = config('scan_batch_size', cast=int, default=1000)
+# 文件事件合并等待时间（秒）及单批最大文件数
+watch_debounce_seconds: float = config('watch_debounce_seconds', cast=float, default=2)
+watch_batch_size: int = config('watch_batch_size', cast=int, default=500)
+# 轮询退化模式下检查目录mtime的间隔（秒）
+watch_poll_seconds: float = config('watch_poll_seconds', cast=float, default=5)
+# API进程是否执行扫描，关闭后由独立worker(python -m app.worker)扫描入库
+scan_in_api: bool = config('scan_in_api', cast=bool, default=True)
+# 独立worker的数据库连接池大小
+worker_max_connections_count: int = config('worker_max_connections_count', cast=int, default=4)
+worker_min_connections_count: int = config('worker_min_connections_count', cast=int, default=1)
+# 多worker时扫描任务由leader执行，租约时长及续租间隔（秒），续租间隔应小于租约时长的一半
+leader_lease_seconds: int = config('leader_lease_seconds', cast=int, default=30)
+leader_renew_seconds: int = config('leader_renew_seconds', cast=int, default=10)
+# 工作列表推送，auto: 优先change stream（需副本集），不支持时轮询；stream/poll: 指定方式
+push_enabled: bool = config('push_enabled', cast=bool, default=True)
+push_mode: str = config('push_mode', cast=str, default='auto')
+# 轮询间隔及时间窗口重叠（秒），每个连接的消息队列长度，心跳间隔（秒）
+push_poll_seconds: float = config('push_poll_seconds', cast=float, default=2)
+push_poll_overlap: float = config('push_poll_overlap', cast=float, default=5)
+push_queue_size: int = config('push_queue_size', cast=int, default=100)
+push_heartbeat_seconds: float = config('push_heartbeat_seconds', cast=float, default=20)
+# 分工分配表缓存时间（秒），分工变更经version集合通知各进程，TTL只兜底直接修改数据库的情况
+assignment_table_ttl: int = config('assignment_table_ttl', cast=int, default=300)
@@ -0,0 +1,167 @@
+from prometheus_client import Histogram, Counter, Gauge, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from pymongo import monitoring
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+from starlette.requests import Request
+from starlette.responses import Response
+from functools import wraps
+import threading
+import time
+
+# 指标为进程内统计，多worker部署时各worker分别采集
+registry = CollectorRegistry()
+
+http_request_duration = Histogram(
+    'http_request_duration_seconds', '接口耗时，_count即请求数', ['method', 'route', 'status'], registry=registry)
+mongodb_command_duration = Histogram(
+    'mongodb_command_duration_seconds', 'MongoDB命令耗时', ['command', 'collection', 'status'], registry=registry,
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+mongodb_pool_checkout_duration = Histogram(
+    'mongodb_pool_checkout_seconds', '从连接池获取连接的等待时间', ['status'], registry=registry,
+    buckets=(.0001, .0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+mongodb_pool_checked_out = Gauge(
+    'mongodb_pool_checked_out_connections', '已借出的连接数', registry=registry)
+scheduler_job_duration = Histogram(
+    'scheduler_job_duration_seconds', '定时任务耗时', ['job', 'result'], registry=registry,
+    buckets=(.1, .5, 1, 5, 10, 30, 60, 120, 300, 600, 1800))
+scheduler_job_skipped = Counter(
+    'scheduler_job_skipped_total', '定时任务错过或因上次未结束而跳过的次数', ['job', 'reason'], registry=registry)
+
+# 不统计的MongoDB命令（握手、心跳等）
+IGNORED_COMMANDS = {'ismaster', 'isMaster', 'hello', 'ping', 'saslStart', 'saslContinue', 'endSessions',
+                    'buildinfo', 'buildInfo', 'getnonce'}
+
+# endpoint到路由模板的映射，用模板而不是实际url作为标签，避免标签数量随参数增长
+_route_paths = {}
+
+
+def get_route_path(request: Request):
+    endpoint = request.scope.get('endpoint')
+    if endpoint is None:
+        return 'unmatched'
+    if endpoint not in _route_paths:
+        for x in request.app.routes:
+            if getattr(x, 'endpoint', None) is not None:
+                _route_paths.setdefault(x.endpoint, x.path)
+    return _route_paths.get(endpoint, 'unmatched')
+
+
+async def metrics_middleware(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        http_request_duration.labels(request.method, get_route_path(request), str(status)).observe(
+            time.perf_counter() - start)
+
+
+class CommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        self._started[(event.request_id, event.connection_id)] = collection if isinstance(collection, str) else ''
+
+    def _finish(self, event, status: str):
+        collection = self._started.pop((event.request_id, event.connection_id), None)
+        if collection is None:
+            return
+        mongodb_command_duration.labels(event.command_name, collection, status).observe(
+            event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finish(event, 'ok')
+
+    def failed(self, event):
+        self._finish(event, 'failed')
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    '''
+        事件不带耗时，check_out_started与checked_out/check_out_failed在同一线程内触发，按线程记录开始时间
+    '''
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _checkout_finished(self, status: str):
+        start = getattr(self._local, 'start', None)
+        if start is not None:
+            self._local.start = None
+            mongodb_pool_checkout_duration.labels(status).observe(time.perf_counter() - start)
+
+    def connection_check_out_started(self, event):
+        self._local.start = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self._checkout_finished('ok')
+        mongodb_pool_checked_out.inc()
+
+    def connection_check_out_failed(self, event):
+        self._checkout_finished(event.reason)
+
+    def connection_checked_in(self, event):
+        mongodb_pool_checked_out.dec()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+
+def get_event_listeners():
+    # 传给AsyncIOMotorClient(event_listeners=...)
+    return [CommandListener(), PoolListener()]
+
+
+def track_job(func):
+    # 包装定时任务，记录耗时及结果
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = 'error'
+        try:
+            value = await func(*args, **kwargs)
+            result = 'success'
+            return value
+        finally:
+            scheduler_job_duration.labels(func.__name__, result).observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+def job_skipped_listener(event):
+    # 任务添加时需指定id，作为job标签
+    reason = 'missed' if event.code == EVENT_JOB_MISSED else 'max_instances'
+    scheduler_job_skipped.labels(event.job_id, reason).inc()
+
+
+def add_scheduler_listeners(scheduler):
+    scheduler.add_listener(job_skipped_listener, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+
+
+def metrics_response():
+    return Response(generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
@@ -1,98 +1,92 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from datetime import datetime
 from typing import List
 from app.core.config import database_name, count_collection_name, case_collection_name, analysis_collection_name, \
-    user_collection_name
-from app.models.case import CaseModel, CaseCreateModel, CaseWithAnalysisAndCount, AnalysisInCase, \
-    CountInCase, AnalysisCreateModel, CountCreateModel, CaseWithAnalysisAndCountByUser, AnalysisByUser, CountByUser
+    user_collection_name, case_view_collection_name
+from app.db.cache import cache, CASE_LIST, CASE_TOTAL, GROUP
+from app.db.bulk import BulkWriter
+from app.crud.workload import add_assigned_workload
+from app.models.case import CaseModel, CaseCreateModel, CaseWithAnalysisAndCount, AnalysisCreateModel, \
+    CountCreateModel, CaseWithAnalysisAndCountByUser, AnalysisByUser, CountByUser
 
 
-async def get_case_list_with_analysis_and_count_by_query(
-        conn: AsyncIOMotorClient, query: dict, user_id: str = None, page: int = None, limit: int = None
-):
-    '''
-        参数中user_id有值时为普通用户调用，数量不多，不做分页；user_id为空时为统计调用，数量大需要分页
-        TODO 该函数设计失误，原本不应该带有状态，后续可考虑拆开
-    '''
+def case_view_to_model(data: dict, user_id: str = None):
+    # case_view文档已内嵌分析计数及用户姓名，直接组装返回模型
     if user_id is not None:
         from app.utils.utils import choose_work_type
-        result = conn[database_name][case_collection_name].aggregate([
-            {'$lookup': {'from': analysis_collection_name, 'localField': 'case_id', 'foreignField': 'case_id',
-                         'as': 'analysis'}},
-            {'$lookup': {'from': count_collection_name, 'localField': 'case_id', 'foreignField': 'case_id',
-                         'as': 'count'}},
-            {'$match': query},
-            {'$unwind': '$count'},
-            {'$unwind': '$analysis'},
-            {'$lookup': {'from': 'user', 'localField': 'analysis.user_id', 'foreignField': 'id',
-                         'as': 'analysis.user'}},
-            {'$lookup': {'from': 'user', 'localField': 'count.user_id', 'foreignField': 'id', 'as': 'count.user'}},
-            {'$unwind': '$analysis.user'},
-            {'$unwind': '$count.user'},
-            {'$group': {'_id': {'case_id': '$case_id', 'count': '$count', 'finished': '$finished'},
-                        'analysis': {'$push': '$analysis'}}},
-            {'$sort': {'_id.case_id': 1}}
-        ])
-        return [CaseWithAnalysisAndCountByUser(
-            case_id=x['_id']['case_id'],
-            finished=x['_id']['finished'],
-            work=choose_work_type(data=x, user_id=user_id),
+        return CaseWithAnalysisAndCountByUser(
+            case_id=data['case_id'],
+            finished=data['finished'],
+            work=choose_work_type(data=data, user_id=user_id),
             analysis=[AnalysisByUser(
-                is_main=y['is_main'],
-                analysis=y['analysis'],
-                karyotype=y['karyotype'],
-                user=y['user_id'],
-                realname=y['user']['realname'],
-                update_time=y['update_time']
-            ) for y in x['analysis']],
+                is_main=x['is_main'],
+                analysis=x['analysis'],
+                karyotype=x['karyotype'],
+                user=x['user_id'],
+                realname=x['realname'],
+                update_time=x.get('update_time')
+            ) for x in data['analysis']],
             count=CountByUser(
-                count=x['_id']['count']['count'],
-                extra=x['_id']['count']['extra'],
-                remark=x['_id']['count']['remark'],
-                user=x['_id']['count']['user_id'],
-                realname=x['_id']['count']['user']['realname'],
-                update_time=x['_id']['count']['update_time']
-            )
-        ) async for x in result]
-    else:
-        result = conn[database_name][case_collection_name].aggregate([
-            {'$lookup': {'from': analysis_collection_name, 'localField': 'case_id', 'foreignField': 'case_id',
-                         'as': 'analysis'}},
-            {'$lookup': {'from': count_collection_name, 'localField': 'case_id', 'foreignField': 'case_id',
-                         'as': 'count'}},
-            {'$unwind': '$count'},
-            {'$unwind': '$analysis'},
-            {'$match': query},
-            {'$lookup': {'from': 'user', 'localField': 'analysis.user_id', 'foreignField': 'id',
-                         'as': 'analysis.user'}},
-            {'$lookup': {'from': 'user', 'localField': 'count.user_id', 'foreignField': 'id', 'as': 'count.user'}},
-            {'$unwind': '$analysis.user'},
-            {'$unwind': '$count.user'},
-            {'$group': {'_id': {'case_id': '$case_id', 'count': '$count', 'finished': '$finished'},
-                        'analysis': {'$push': '$analysis'}}},
-            {'$sort': {'_id.case_id': 1}},
-            {'$skip': (page - 1) * limit},
-            {'$limit': limit}
-        ])
-        return [CaseWithAnalysisAndCount(
-            case_id=x['_id']['case_id'],
-            finished=x['_id']['finished'],
-            analysis=[AnalysisInCase(
-                is_main=y['is_main'],
-                analysis=y['analysis'],
-                karyotype=y['karyotype'],
-                user_id=y['user_id'],
-                realname=y['user']['realname'],
-                update_time=y['update_time']
-            ) for y in x['analysis']],
-            count=CountInCase(
-                count=x['_id']['count']['count'],
-                extra=x['_id']['count']['extra'],
-                remark=x['_id']['count']['remark'],
-                user_id=x['_id']['count']['user_id'],
-                realname=x['_id']['count']['user']['realname'],
-                update_time=x['_id']['count']['update_time']
+                count=data['count']['count'],
+                extra=data['count']['extra'],
+                remark=data['count']['remark'],
+                user=data['count']['user_id'],
+                realname=data['count']['realname'],
+                update_time=data['count'].get('update_time')
             )
-        ) async for x in result]
+        )
+    return CaseWithAnalysisAndCount(**data)
+
+
+def case_view_to_dict(data: dict, user_id: str = None):
+    # 可信的case_view文档直接转换为与模型一致的响应结构，跳过校验
+    if user_id is None:
+        return data
+    from app.utils.utils import choose_work_type
+    work = choose_work_type(data=data, user_id=user_id)
+    return {
+        'case_id': data['case_id'],
+        'finished': data['finished'],
+        'analysis': [{
+            'is_main': x['is_main'],
+            'analysis': x['analysis'],
+            'karyotype': x['karyotype'],
+            'user': x['user_id'],
+            'realname': x['realname'],
+            'update_time': x.get('update_time')
+        } for x in data['analysis']],
+        'count': {
+            'count': data['count']['count'],
+            'extra': data['count']['extra'],
+            'remark': data['count']['remark'],
+            'user': data['count']['user_id'],
+            'realname': data['count']['realname'],
+            'update_time': data['count'].get('update_time')
+        },
+        'work': work.value if work else None
+    }
+
+
+async def get_case_list_with_analysis_and_count_by_query(
+        conn: AsyncIOMotorClient, query: dict, user_id: str = None, page: int = None, limit: int = None,
+        after: str = None, raw: bool = False
+):
+    '''
+        参数中user_id有值时为普通用户调用，数量不多，不做分页；user_id为空时为统计调用，数量大需要分页
+        after有值时按case_id游标分页（取case_id大于after的limit条），否则按page跳过
+        raw为True时返回dict，不构建模型
+        查询case_view物化文档，query字段与case_view一致，如count.user_id、analysis.user_id、finished
+    '''
+    if after is not None:
+        query = {'$and': [query, {'case_id': {'$gt': after}}]}
+    result = conn[database_name][case_view_collection_name].find(query, {'_id': 0, 'modify_time': 0}).sort('case_id', 1)
+    if user_id is None:
+        if after is None:
+            result = result.skip((page - 1) * limit)
+        result = result.limit(limit)
+    convert = case_view_to_dict if raw else case_view_to_model
+    return [convert(data=x, user_id=user_id) async for x in result]
 
 
 async def get_case_list_by_query(conn: AsyncIOMotorClient, query: dict):
@@ -100,14 +94,224 @@ async def get_case_list_by_query(conn: AsyncIOMotorClient, query: dict):
     return [CaseModel(**x) async for x in result]
 
 
+async def get_exist_case_id_set(conn: AsyncIOMotorClient, case_ids: List[str], batch_size: int = 10000):
+    '''
+        批量判断case是否已存在，只投影case_id，不构建完整模型
+        返回已存在的case_id集合
+    '''
+    case_ids = list(set(case_ids))
+    exist_ids = set()
+    for n in range(0, len(case_ids), batch_size):
+        result = conn[database_name][case_collection_name].find(
+            {'case_id': {'$in': case_ids[n:n + batch_size]}}, {'case_id': 1, '_id': 0}
+        )
+        exist_ids.update([x['case_id'] async for x in result])
+    return exist_ids
+
+
 async def create_case_list_with_item(conn: AsyncIOMotorClient, item: List[CaseCreateModel]):
-    conn[database_name][case_collection_name].insert_many([x.dict() for x in item])
-    return True
+    # 按case_id幂等写入，重复导入不会产生重复数据
+    writer = BulkWriter(conn).add(case_collection_name, ['case_id'], [x.dict() for x in item])
+    return await writer.write()
 
 
 async def get_one_case_with_analysis_and_count_by_query(conn: AsyncIOMotorClient, query: dict):
-    result = conn[database_name][case_collection_name].aggregate([
-        {'$match': query},
+    result = await conn[database_name][case_view_collection_name].find_one(query, {'_id': 0})
+    return case_view_to_model(data=result) if result else None
+
+
+async def get_case_view_list_by_case_ids(conn: AsyncIOMotorClient, case_ids: List[str]):
+    result = conn[database_name][case_view_collection_name].find({'case_id': {'$in': case_ids}}, {'_id': 0})
+    return [case_view_to_model(data=x) async for x in result]
+
+
+async def count_case_by_query(conn: AsyncIOMotorClient, query: dict):
+    result = await conn[database_name][case_collection_name].count_documents(query)
+    return result
+
+
+async def count_case_view_by_query(conn: AsyncIOMotorClient, query: dict, limit: int = None):
+    # limit有值时最多数到limit条，用于估算总数
+    if limit:
+        return await conn[database_name][case_view_collection_name].count_documents(query, limit=limit)
+    result = await conn[database_name][case_view_collection_name].count_documents(query)
+    return result
+
+
+async def init_case_view(conn: AsyncIOMotorClient):
+    # case_view为空而已有case时（首次上线），从原始集合生成一次
+    view = conn[database_name][case_view_collection_name]
+    if await view.find_one({}, {'_id': 1}) is None and \
+            await conn[database_name][case_collection_name].find_one({}, {'_id': 1}) is not None:
+        await rebuild_case_view(conn=conn)
+    return True
+
+
+async def create_case_with_analysis_and_count(conn: AsyncIOMotorClient, case_item: List[CaseCreateModel],
+                                              analysis_item: List[AnalysisCreateModel],
+                                              count_item: List[CountCreateModel], transaction: bool = None):
+    '''
+        幂等批量写入case、analysis、count及case_view，重复执行不会产生重复数据
+        写入后按实际存在且尚未计入的analysis、count统计用户工作量
+        不使用事务时按顺序写入，case最后写入作为整批完成的标记：中途失败时case不存在，
+        重新扫描或导入会再次分配并补齐已写入部分
+        返回(各集合写入汇总, 本次新插入的case_id集合)，并发导入同一case时只有一方计为新插入
+    '''
+    writer = BulkWriter(conn, **({} if transaction is None else {'transaction': transaction}))
+    writer.add(analysis_collection_name, ['case_id', 'user_id'], [x.dict() for x in analysis_item])
+    writer.add(count_collection_name, ['case_id'], [x.dict() for x in count_item])
+    writer.add(case_view_collection_name, ['case_id'],
+               build_case_view_list(case_item=case_item, analysis_item=analysis_item, count_item=count_item))
+    writer.add(case_collection_name, ['case_id'], [x.dict() for x in case_item])
+    try:
+        summary = await writer.write()
+    finally:
+        # 写入失败时已写入的analysis、count同样计入，未计入的部分在重新扫描、导入时补计
+        await add_assigned_workload(conn=conn, case_ids=[x.case_id for x in case_item])
+    await cache.delete(CASE_LIST, *set([x.user_id for x in analysis_item] + [x.user_id for x in count_item]))
+    await cache.invalidate(CASE_TOTAL)
+    return summary, set(x['case_id'] for x in writer.inserted.get(case_collection_name, []))
+
+
+def build_case_view_list(case_item: List[CaseCreateModel], analysis_item: List[AnalysisCreateModel],
+                         count_item: List[CountCreateModel]):
+    # 只有分配了分析和计数的case才进入case_view，与原先join结果一致
+    # modify_time为最后修改时间（UTC），推送的轮询模式按此字段查找变更
+    now = datetime.utcnow()
+    analysis = {}
+    for x in analysis_item:
+        analysis.setdefault(x.case_id, []).append({
+            'is_main': x.is_main,
+            'analysis': x.analysis,
+            'karyotype': x.karyotype,
+            'user_id': x.user_id,
+            'realname': x.user_name,
+            'update_time': x.update_time
+        })
+    count = {x.case_id: {
+        'count': x.count,
+        'extra': x.extra,
+        'remark': x.remark,
+        'user_id': x.user_id,
+        'realname': x.user_name,
+        'update_time': x.update_time
+    } for x in count_item}
+    return [{
+        'case_id': x.case_id,
+        'finished': x.finished,
+        'analysis': analysis[x.case_id],
+        'count': count[x.case_id],
+        'modify_time': now
+    } for x in case_item if x.case_id in analysis and x.case_id in count]
+
+
+async def invalidate_case_view_cache(data: dict):
+    # case_view变更后清除该case所有相关用户的工作列表缓存及汇总缓存
+    if data:
+        await cache.delete(CASE_LIST, *set([x['user_id'] for x in data['analysis']] + [data['count']['user_id']]))
+    await cache.invalidate(CASE_TOTAL)
+
+
+async def update_case_view_by_analysis(conn: AsyncIOMotorClient, case_id: str, user_id: str, item: dict):
+    result = await conn[database_name][case_view_collection_name].find_one_and_update(
+        {'case_id': case_id, 'analysis.user_id': user_id},
+        {'$set': {**{f'analysis.$.{k}': v for k, v in item.items()}, 'modify_time': datetime.utcnow()}},
+        projection={'analysis.user_id': 1, 'count.user_id': 1}
+    )
+    await invalidate_case_view_cache(result)
+    return True
+
+
+async def update_case_view_by_count(conn: AsyncIOMotorClient, case_id: str, user_id: str, item: dict):
+    result = await conn[database_name][case_view_collection_name].find_one_and_update(
+        {'case_id': case_id, 'count.user_id': user_id},
+        {'$set': {**{f'count.{k}': v for k, v in item.items()}, 'modify_time': datetime.utcnow()}},
+        projection={'analysis.user_id': 1, 'count.user_id': 1}
+    )
+    await invalidate_case_view_cache(result)
+    return True
+
+
+async def update_case_view_list(conn: AsyncIOMotorClient, task: str, user_id: str, items: dict):
+    '''
+        批量同步case_view，task为analysis或count，items为{case_id: 修改内容}
+    '''
+    if not items:
+        return True
+    prefix = 'analysis.$' if task == 'analysis' else 'count'
+    collection = conn[database_name][case_view_collection_name]
+    now = datetime.utcnow()
+    await collection.bulk_write([UpdateOne(
+        {'case_id': case_id, f'{task}.user_id': user_id},
+        {'$set': {**{f'{prefix}.{k}': v for k, v in item.items()}, 'modify_time': now}}
+    ) for case_id, item in items.items()], ordered=False)
+    await invalidate_case_view_list_cache(conn=conn, case_ids=list(items))
+    return True
+
+
+async def invalidate_case_view_list_cache(conn: AsyncIOMotorClient, case_ids: List[str]):
+    # 批量变更后汇总所有相关用户，一次清除工作列表缓存及汇总缓存
+    result = conn[database_name][case_view_collection_name].find(
+        {'case_id': {'$in': case_ids}}, {'analysis.user_id': 1, 'count.user_id': 1})
+    users = set()
+    async for x in result:
+        users.update([y['user_id'] for y in x['analysis']] + [x['count']['user_id']])
+    if users:
+        await cache.delete(CASE_LIST, *users)
+    await cache.invalidate(CASE_TOTAL)
+
+
+async def update_case_finished(conn: AsyncIOMotorClient, case_ids: List[str], finished: bool):
+    '''
+        修改case完成状态，同时写入case_view；修改case.finished应通过此函数
+    '''
+    if not case_ids:
+        return True
+    await conn[database_name][case_collection_name].update_many(
+        {'case_id': {'$in': case_ids}}, {'$set': {'finished': finished}})
+    await conn[database_name][case_view_collection_name].update_many(
+        {'case_id': {'$in': case_ids}, 'finished': {'$ne': finished}},
+        {'$set': {'finished': finished, 'modify_time': datetime.utcnow()}})
+    await invalidate_case_view_list_cache(conn=conn, case_ids=case_ids)
+    return True
+
+
+async def sync_case_view_finished(conn: AsyncIOMotorClient):
+    '''
+        外部系统直接修改case.finished时同步到case_view，返回同步的case_id列表
+        只检查case_view中未完成的case，读取量与待办数量成正比；完成后退回未完成需通过update_case_finished
+    '''
+    result = conn[database_name][case_view_collection_name].aggregate([
+        {'$match': {'finished': False}},
+        {'$project': {'_id': 0, 'case_id': 1}},
+        {'$lookup': {'from': case_collection_name, 'localField': 'case_id', 'foreignField': 'case_id', 'as': 'case'}},
+        {'$match': {'case.finished': True}},
+        {'$project': {'case_id': 1}},
+    ])
+    case_ids = [x['case_id'] async for x in result]
+    await update_case_finished(conn=conn, case_ids=case_ids, finished=True)
+    return case_ids
+
+
+async def update_case_view_realname(conn: AsyncIOMotorClient, user_id: str, realname: str):
+    collection = conn[database_name][case_view_collection_name]
+    now = datetime.utcnow()
+    await collection.update_many({'analysis.user_id': user_id},
+                                 {'$set': {'analysis.$[x].realname': realname, 'modify_time': now}},
+                                 array_filters=[{'x.user_id': user_id}])
+    await collection.update_many({'count.user_id': user_id}, {'$set': {'count.realname': realname, 'modify_time': now}})
+    await cache.invalidate(CASE_LIST, CASE_TOTAL, GROUP)
+    return True
+
+
+async def rebuild_case_view(conn: AsyncIOMotorClient, query: dict = None):
+    '''
+        由case、analysis、count、user重新生成case_view，用于首次上线或数据修复
+        需要MongoDB 4.2+支持$merge
+    '''
+    await conn[database_name][case_view_collection_name].create_index('case_id', unique=True)
+    await conn[database_name][case_collection_name].aggregate([
+        {'$match': query or {}},
         {'$lookup': {'from': analysis_collection_name, 'localField': 'case_id', 'foreignField': 'case_id',
                      'as': 'analysis'}},
         {'$lookup': {'from': count_collection_name, 'localField': 'case_id', 'foreignField': 'case_id', 'as': 'count'}},
@@ -119,42 +323,23 @@ async def get_one_case_with_analysis_and_count_by_query(conn: AsyncIOMotorClient
         {'$lookup': {'from': user_collection_name, 'localField': 'count.user_id', 'foreignField': 'id',
                      'as': 'count.user'}},
         {'$unwind': '$count.user'},
-        {'$group': {'_id': {'case_id': '$case_id', 'finished': '$finished', 'count': '$count'},
-                    'analysis': {'$push': '$analysis'}}}
-    ])
-    result = [x async for x in result]
-    return CaseWithAnalysisAndCount(
-        case_id=result[0]['_id']['case_id'],
-        finished=result[0]['_id']['finished'],
-        analysis=[AnalysisInCase(
-            is_main=x['is_main'],
-            analysis=x['analysis'],
-            karyotype=x['karyotype'],
-            user_id=x['user_id'],
-            realname=x['user']['realname'],
-            update_time=x['update_time'] if x.get('update_time') else None
-        ) for x in result[0]['analysis']],
-        count=CountInCase(
-            count=result[0]['_id']['count']['count'],
-            extra=result[0]['_id']['count']['extra'],
-            remark=result[0]['_id']['count']['remark'],
-            user_id=result[0]['_id']['count']['user_id'],
-            realname=result[0]['_id']['count']['user']['realname'],
-            update_time=result[0]['_id']['count']['update_time'] if result[0]['_id']['count'].get(
-                'update_time') else None
-        )
-    )
-
-
-async def count_case_by_query(conn: AsyncIOMotorClient, query: dict):
-    result = await conn[database_name][case_collection_name].count_documents(query)
-    return result
-
-
-async def create_case_with_analysis_and_count(conn: AsyncIOMotorClient, case_item: List[CaseCreateModel],
-                                              analysis_item: List[AnalysisCreateModel],
-                                              count_item: List[CountCreateModel]):
-    conn[database_name][case_collection_name].insert_many([x.dict() for x in case_item])
-    conn[database_name][analysis_collection_name].insert_many([x.dict() for x in analysis_item])
-    conn[database_name][count_collection_name].insert_many([x.dict() for x in count_item])
+        {'$sort': {'analysis.is_main': -1}},
+        {'$group': {
+            '_id': '$case_id',
+            'finished': {'$first': '$finished'},
+            'count': {'$first': {
+                'count': '$count.count', 'extra': '$count.extra', 'remark': '$count.remark',
+                'user_id': '$count.user_id', 'realname': '$count.user.realname', 'update_time': '$count.update_time'
+            }},
+            'analysis': {'$push': {
+                'is_main': '$analysis.is_main', 'analysis': '$analysis.analysis', 'karyotype': '$analysis.karyotype',
+                'user_id': '$analysis.user_id', 'realname': '$analysis.user.realname',
+                'update_time': '$analysis.update_time'
+            }}
+        }},
+        {'$project': {'_id': 0, 'case_id': '$_id', 'finished': 1, 'count': 1, 'analysis': 1, 'modify_time': '$$NOW'}},
+        {'$merge': {'into': case_view_collection_name, 'on': 'case_id', 'whenMatched': 'replace',
+                    'whenNotMatched': 'insert'}}
+    ]).to_list(length=None)
+    await cache.invalidate(CASE_LIST, CASE_TOTAL)
     return True
@@ -1,8 +1,11 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
 from typing import Optional
 from app.core.config import database_name, count_collection_name
 from app.models.count import CountModel
 
+COUNT_FIELDS = list(CountModel.__fields__)
+
 
 async def get_one_count_by_query(conn: AsyncIOMotorClient, query: Optional[dict]):
     result = await conn[database_name][count_collection_name].find_one(query)
@@ -10,10 +13,35 @@ async def get_one_count_by_query(conn: AsyncIOMotorClient, query: Optional[dict]
 
 
 async def update_count_by_query_with_item(conn: AsyncIOMotorClient, query: Optional[dict], item: Optional[dict]):
-    conn[database_name][count_collection_name].update_one(query, {'$set': item})
+    await conn[database_name][count_collection_name].update_one(query, {'$set': item})
     return True
 
 
-async def get_count_list_by_query(conn: AsyncIOMotorClient, query: Optional[dict]):
+async def get_count_list_by_query(conn: AsyncIOMotorClient, query: Optional[dict], raw: bool = False):
+    # raw为True时只投影模型字段并返回dict，不构建模型
+    if raw:
+        result = conn[database_name][count_collection_name].find(query, {x: 1 for x in COUNT_FIELDS})
+        return [{x: y.get(x) for x in COUNT_FIELDS} async for y in result]
     result = conn[database_name][count_collection_name].find(query)
     return [CountModel(**x) async for x in result]
+
+
+async def update_and_get_count_by_query_with_item(conn: AsyncIOMotorClient, query: Optional[dict],
+                                                  item: Optional[dict]):
+    # 条件中带用户，校验归属与修改一次完成，不匹配时返回None
+    result = await conn[database_name][count_collection_name].find_one_and_update(
+        query, {'$set': item}, return_document=ReturnDocument.AFTER)
+    return CountModel(**result) if result else None
+
+
+async def update_count_list_by_user(conn: AsyncIOMotorClient, user_id: str, items: dict):
+    '''
+        批量保存该用户的计数，items为{case_id: 修改内容}，返回实际归属该用户并已保存的case_id列表
+    '''
+    collection = conn[database_name][count_collection_name]
+    result = collection.find({'case_id': {'$in': list(items)}, 'user_id': user_id}, {'case_id': 1, '_id': 0})
+    owned = [x['case_id'] async for x in result]
+    if owned:
+        await collection.bulk_write([UpdateOne({'case_id': x, 'user_id': user_id}, {'$set': items[x]})
+                                     for x in owned], ordered=False)
+    return owned
@@ -0,0 +1,39 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from datetime import datetime
+from typing import List
+from app.core.config import database_name, scan_cursor_collection_name, scan_file_collection_name, timezone
+from app.models.scan import ScanCursorModel
+
+
+async def get_scan_cursor_by_path(conn: AsyncIOMotorClient, path: str):
+    # 旧版本游标文档中的names不再读取
+    result = await conn[database_name][scan_cursor_collection_name].find_one({'path': path}, {'_id': 0, 'names': 0})
+    return ScanCursorModel(**result) if result else ScanCursorModel(path=path)
+
+
+async def get_exist_scan_file_names(conn: AsyncIOMotorClient, path: str, names: List[str]):
+    '''
+        返回names中已入库的文件名集合，按(path, name)索引查询，只投影name
+    '''
+    result = conn[database_name][scan_file_collection_name].find(
+        {'path': path, 'name': {'$in': names}}, {'name': 1, '_id': 0})
+    return set([x['name'] async for x in result])
+
+
+async def update_scan_cursor_with_names(conn: AsyncIOMotorClient, path: str, last_mtime: float, names: List[str],
+                                        dir_mtime: float = None):
+    # 已入库的文件名每个一条记录，按(path, name)幂等写入，写入量与新文件数量成正比；事件触发时不知道目录mtime，不更新
+    if names:
+        await conn[database_name][scan_file_collection_name].bulk_write([UpdateOne(
+            {'path': path, 'name': x}, {'$setOnInsert': {'path': path, 'name': x}}, upsert=True
+        ) for x in names], ordered=False)
+    item = {'update_time': datetime.now(tz=timezone).isoformat()}
+    if dir_mtime is not None:
+        item['dir_mtime'] = dir_mtime
+    await conn[database_name][scan_cursor_collection_name].update_one(
+        {'path': path},
+        {'$set': item, '$max': {'last_mtime': last_mtime}, '$unset': {'names': ''}},
+        upsert=True
+    )
+    return True
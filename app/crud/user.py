@@ -1,9 +1,11 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import Optional
 from app.models.user import UserInDB, UserCreate, UserListModel, RolePatchRequest, RoleCreateModel, RoleModel, \
-    DivisionCreateModel, DivisionModel, DivisionInRole, DivisionGroupByGroup
-from app.utils.security import generate_salt, get_password_hash
-from app.core.config import database_name, user_collection_name, group_collection_name, division_collection_name
+    DivisionCreateModel, DivisionModel, DivisionInRole, DivisionGroupByGroup, RoleWithDivisionModel
+from app.utils.security import generate_salt, get_password_hash_async
+from app.core.config import database_name, user_collection_name, group_collection_name, division_collection_name, \
+    version_collection_name
+from app.db.cache import cache, GROUP
 
 
 async def get_user(conn: AsyncIOMotorClient, query: Optional[dict]) -> UserInDB:
@@ -13,23 +15,35 @@ async def get_user(conn: AsyncIOMotorClient, query: Optional[dict]) -> UserInDB:
 
 async def create_user(conn: AsyncIOMotorClient, user: UserCreate) -> UserInDB:
     salt = generate_salt()
-    hashed_password = get_password_hash(salt + user.password)
+    hashed_password = await get_password_hash_async(salt + user.password)
     db_user = user.dict()
     db_user['salt'] = salt
     db_user['hashed_password'] = hashed_password
     del db_user['password']
-    conn[database_name][user_collection_name].insert_one(db_user)
+    await conn[database_name][user_collection_name].insert_one(db_user)
     return UserInDB(**user.dict())
 
 
 async def get_user_list_by_query_with_page_and_limit(conn: AsyncIOMotorClient, query: Optional[dict], page: int,
-                                                     limit: int):
-    result = conn[database_name][user_collection_name].find(query).skip((page - 1) * limit).limit(limit)
+                                                     limit: int, after: str = None):
+    # after有值时按id游标分页，否则按page跳过，两种方式均按id排序以便从任一页继续游标分页
+    if after is not None:
+        query = {'$and': [query, {'id': {'$gt': after}}]}
+    result = conn[database_name][user_collection_name].find(query).sort('id', 1)
+    if after is None:
+        result = result.skip((page - 1) * limit)
+    result = result.limit(limit)
     return [UserListModel(**x) async for x in result]
 
 
-async def count_user_by_query(conn: AsyncIOMotorClient, query: Optional[dict]):
-    result = await conn[database_name][user_collection_name].count_documents(query)
+async def count_user_by_query(conn: AsyncIOMotorClient, query: Optional[dict], limit: int = None):
+    # limit有值时为估算：无条件时读集合元数据，有条件时最多数到limit条
+    collection = conn[database_name][user_collection_name]
+    if limit and not query:
+        return await collection.estimated_document_count()
+    if limit:
+        return await collection.count_documents(query, limit=limit)
+    result = await collection.count_documents(query)
     return result
 
 
@@ -39,17 +53,20 @@ async def get_user_by_name(conn: AsyncIOMotorClient, name: str):
 
 
 async def update_user_info_by_query_with_item(conn: AsyncIOMotorClient, query: dict, item: dict):
-    conn[database_name][user_collection_name].update_one(query, item)
+    await conn[database_name][user_collection_name].update_one(query, item)
+    await cache.invalidate(GROUP)
     return True
 
 
 async def update_role_with_item(conn: AsyncIOMotorClient, query: dict, item: RolePatchRequest):
-    conn[database_name][group_collection_name].update_one(query, {'$set': item.dict(exclude_none=True)})
+    await conn[database_name][group_collection_name].update_one(query, {'$set': item.dict(exclude_none=True)})
+    await cache.invalidate(GROUP)
     return True
 
 
 async def create_role_with_item(conn: AsyncIOMotorClient, item: RoleCreateModel):
-    conn[database_name][group_collection_name].insert_one(item.dict())
+    await conn[database_name][group_collection_name].insert_one(item.dict())
+    await cache.invalidate(GROUP)
     return item.id
 
 
@@ -64,13 +81,42 @@ async def get_role_list(conn: AsyncIOMotorClient):
     return [x async for x in result]
 
 
+async def get_group_list_with_division(conn: AsyncIOMotorClient):
+    # 一次聚合取出全部分组、分工及用户姓名，用户不存在的分工不返回
+    result = conn[database_name][group_collection_name].aggregate([
+        {'$lookup': {'from': division_collection_name, 'localField': 'id', 'foreignField': 'group_id',
+                     'as': 'division'}},
+        {'$lookup': {'from': user_collection_name, 'localField': 'division.user_id', 'foreignField': 'id',
+                     'as': 'user'}},
+        {'$project': {'_id': 0, 'id': 1, 'group_name': 1, 'group_type': 1, 'division': 1, 'user.id': 1,
+                      'user.realname': 1}}
+    ])
+    return_obj = []
+    async for x in result:
+        realname = {y['id']: y['realname'] for y in x['user']}
+        return_obj.append(RoleWithDivisionModel(
+            id=x['id'],
+            group_name=x['group_name'],
+            group_type=x['group_type'],
+            division=[DivisionInRole(
+                id=y['id'],
+                quantities=y['quantities'],
+                user_id=y['user_id'],
+                realname=realname[y['user_id']],
+                case_type=y['case_type']
+            ) for y in x['division'] if y['user_id'] in realname]
+        ))
+    return return_obj
+
+
 async def get_group_list(conn: AsyncIOMotorClient):
     result = conn[database_name][group_collection_name].find()
     return [RoleModel(**x) async for x in result]
 
 
 async def delete_group_by_query(conn: AsyncIOMotorClient, query: dict):
-    conn[database_name][group_collection_name].delete_one(query)
+    await conn[database_name][group_collection_name].delete_one(query)
+    await cache.invalidate(GROUP)
     return True
 
 
@@ -85,7 +131,8 @@ async def get_one_user_by_query(conn: AsyncIOMotorClient, query: dict):
 
 
 async def create_division_with_item(conn: AsyncIOMotorClient, item: DivisionCreateModel):
-    conn[database_name][division_collection_name].insert_one(item.dict())
+    await conn[database_name][division_collection_name].insert_one(item.dict())
+    await cache.invalidate(GROUP)
     return item.id
 
 
@@ -95,7 +142,8 @@ async def get_one_division_by_query(conn: AsyncIOMotorClient, query: dict):
 
 
 async def update_division_by_query_with_item(conn: AsyncIOMotorClient, query: dict, item: dict):
-    conn[database_name][division_collection_name].update_one(query, item)
+    await conn[database_name][division_collection_name].update_one(query, item)
+    await cache.invalidate(GROUP)
     return True
 
 
@@ -120,12 +168,14 @@ async def get_division_list_unfold_user_by_query(conn: AsyncIOMotorClient, query
 
 
 async def delete_user_by_query(conn: AsyncIOMotorClient, query: dict):
-    conn[database_name][user_collection_name].delete_one(query)
+    await conn[database_name][user_collection_name].delete_one(query)
+    await cache.invalidate(GROUP)
     return True
 
 
 async def delete_division_by_query(conn: AsyncIOMotorClient, query: dict):
-    conn[database_name][division_collection_name].delete_one(query)
+    await conn[database_name][division_collection_name].delete_one(query)
+    await cache.invalidate(GROUP)
     return True
 
 
@@ -153,3 +203,15 @@ async def get_all_division_group_by_group(conn: AsyncIOMotorClient):
             case_type=y['case_type']
         ) for y in x['division']]
     ) async for x in result]
+
+
+async def get_division_version(conn: AsyncIOMotorClient) -> int:
+    result = await conn[database_name][version_collection_name].find_one({'name': 'division'}, {'_id': 0, 'version': 1})
+    return result['version'] if result else 0
+
+
+async def inc_division_version(conn: AsyncIOMotorClient):
+    # 分组、分工及用户姓名变更后调用，各进程据此重新加载分配表
+    await conn[database_name][version_collection_name].update_one(
+        {'name': 'division'}, {'$inc': {'version': 1}}, upsert=True)
+    return True
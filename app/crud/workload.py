@@ -0,0 +1,187 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReplaceOne
+from typing import List, Dict, Tuple
+import uuid
+from app.core.config import database_name, analysis_collection_name, count_collection_name, user_collection_name, \
+    workload_collection_name
+from app.models.case import WorkEnum
+
+# 任务已提交结果的条件：分析录入了核型，计数录入了计数
+ANALYSIS_DONE = {'karyotype': {'$nin': [None, '']}}
+COUNT_DONE = {'count.0': {'$exists': True}}
+# analysis、count文档上的标记：counted为已计入待完成，finished为已计入已完成，值为认领时的随机标记
+COUNTED = 'counted'
+FINISHED = 'finished'
+WORKS = [x.value for x in WorkEnum]
+
+
+def workload_key(user_id: str, case_id: str) -> Tuple[str, str, str]:
+    # case_id首位为类型，之后4位为年月，例如L2104052638为L类型2104月
+    return user_id, case_id[:1], case_id[1:5]
+
+
+def add_increment(increments: Dict[tuple, dict], key: tuple, work: str, pending: int, finished: int):
+    item = increments.setdefault(key, {})
+    if pending:
+        item[f'pending.{work}'] = item.get(f'pending.{work}', 0) + pending
+    if finished:
+        item[f'finished.{work}'] = item.get(f'finished.{work}', 0) + finished
+
+
+async def inc_workload(conn: AsyncIOMotorClient, increments: Dict[tuple, dict]):
+    '''
+        increments为{(user_id, case_type, month): {'pending.MA': 1, ...}}，按用户、类型、月份$inc，不存在时创建
+    '''
+    if not increments:
+        return True
+    await conn[database_name][workload_collection_name].bulk_write([UpdateOne(
+        {'user_id': key[0], 'case_type': key[1], 'month': key[2]}, {'$inc': item}, upsert=True
+    ) for key, item in increments.items() if item], ordered=False)
+    return True
+
+
+async def claim(collection, case_ids: List[str], field: str, query: dict = None) -> List[dict]:
+    '''
+        将case_ids中满足query且没有field标记的文档写入本次的随机标记，再按标记读回
+        单个文档的更新是原子的，重复或并发调用时每个文档只会被一次调用认领
+    '''
+    if not case_ids:
+        return []
+    token = uuid.uuid4().hex
+    query = {'case_id': {'$in': case_ids}, **(query or {})}
+    await collection.update_many({**query, field: {'$exists': False}}, {'$set': {field: token}})
+    result = collection.find({**query, field: token}, {'_id': 0, 'case_id': 1, 'user_id': 1, 'is_main': 1})
+    return [x async for x in result]
+
+
+async def add_assigned_workload(conn: AsyncIOMotorClient, case_ids: List[str]):
+    '''
+        将case_ids下尚未计入的analysis、count计入待完成
+        按写入后实际存在的文档统计，中途失败或重试后已写入的部分在重新扫描、导入时补计，不会漏计或重复计入
+    '''
+    increments = {}
+    for x in await claim(conn[database_name][analysis_collection_name], case_ids, COUNTED):
+        work = WorkEnum.MA.value if x['is_main'] else WorkEnum.SA.value
+        add_increment(increments, workload_key(x['user_id'], x['case_id']), work, pending=1, finished=0)
+    for x in await claim(conn[database_name][count_collection_name], case_ids, COUNTED):
+        add_increment(increments, workload_key(x['user_id'], x['case_id']), WorkEnum.C.value, pending=1, finished=0)
+    return await inc_workload(conn=conn, increments=increments)
+
+
+async def finish_workload(conn: AsyncIOMotorClient, task: str, user_id: str, case_ids: List[str]):
+    '''
+        task为analysis或count，将已提交结果的任务标记finished，并从待完成移到已完成
+        两次update_many认领、一次find读回，重复或并发提交只计一次；之后清空结果不会退回待完成
+        尚未计入待完成的任务（如未重新统计的历史数据）同时补counted标记，只计入已完成
+    '''
+    if task == 'analysis':
+        collection, done = conn[database_name][analysis_collection_name], ANALYSIS_DONE
+    else:
+        collection, done = conn[database_name][count_collection_name], COUNT_DONE
+    if not case_ids:
+        return True
+    token = uuid.uuid4().hex
+    query = {'case_id': {'$in': case_ids}, 'user_id': user_id}
+    claim_query = {**query, FINISHED: {'$exists': False}, **done}
+    await collection.update_many({**claim_query, COUNTED: {'$exists': False}},
+                                 {'$set': {COUNTED: token, FINISHED: token}})
+    await collection.update_many(claim_query, {'$set': {FINISHED: token}})
+    result = collection.find({**query, FINISHED: token}, {'_id': 0, 'case_id': 1, 'is_main': 1, COUNTED: 1})
+    increments = {}
+    async for x in result:
+        if task == 'analysis':
+            work = WorkEnum.MA.value if x['is_main'] else WorkEnum.SA.value
+        else:
+            work = WorkEnum.C.value
+        pending = 0 if x[COUNTED] == token else -1
+        add_increment(increments, workload_key(user_id, x['case_id']), work, pending=pending, finished=1)
+    return await inc_workload(conn=conn, increments=increments)
+
+
+async def get_workload_list(conn: AsyncIOMotorClient, case_type: str = None, month: str = None):
+    '''
+        按用户汇总待完成及已完成任务数，detail为各类型、月份明细
+        计数集合每个用户每个类型每月一条，读取量与用户数成正比，与case数量无关
+    '''
+    query = {}
+    if case_type:
+        query['case_type'] = case_type
+    if month:
+        query['month'] = month
+    result = conn[database_name][workload_collection_name].aggregate([
+        {'$match': query},
+        {'$sort': {'case_type': 1, 'month': 1}},
+        {'$group': {
+            '_id': '$user_id',
+            **{f'pending_{x}': {'$sum': f'$pending.{x}'} for x in WORKS},
+            **{f'finished_{x}': {'$sum': f'$finished.{x}'} for x in WORKS},
+            'detail': {'$push': '$$ROOT'}
+        }},
+        {'$lookup': {'from': user_collection_name, 'localField': '_id', 'foreignField': 'id', 'as': 'user'}},
+        {'$sort': {'_id': 1}},
+    ])
+    return [{
+        'user_id': x['_id'],
+        'realname': x['user'][0].get('realname') if x['user'] else None,
+        'pending': {y: x[f'pending_{y}'] for y in WORKS},
+        'finished': {y: x[f'finished_{y}'] for y in WORKS},
+        'detail': [{
+            'case_type': y['case_type'],
+            'month': y['month'],
+            'pending': {z: y.get('pending', {}).get(z, 0) for z in WORKS},
+            'finished': {z: y.get('finished', {}).get(z, 0) for z in WORKS}
+        } for y in x['detail']]
+    } async for x in result]
+
+
+async def rebuild_workload(conn: AsyncIOMotorClient):
+    '''
+        由analysis、count重新统计，用于首次上线或数据修复
+        先为所有任务补counted标记、为已提交结果的任务补finished标记；统计期间的写入可能不计入，应在空闲时执行
+    '''
+    increments = {}
+    for task, collection_name, done in [('analysis', analysis_collection_name, ANALYSIS_DONE),
+                                        ('count', count_collection_name, COUNT_DONE)]:
+        collection = conn[database_name][collection_name]
+        token = uuid.uuid4().hex
+        await collection.update_many({COUNTED: {'$exists': False}}, {'$set': {COUNTED: token}})
+        await collection.update_many({FINISHED: {'$exists': False}, **done}, {'$set': {FINISHED: token}})
+        result = collection.aggregate([
+            {'$group': {
+                '_id': {'user_id': '$user_id', 'case_type': {'$substr': ['$case_id', 0, 1]},
+                        'month': {'$substr': ['$case_id', 1, 4]}, 'is_main': '$is_main'},
+                'total': {'$sum': 1},
+                'finished': {'$sum': {'$cond': [{'$gt': [f'${FINISHED}', None]}, 1, 0]}}
+            }}
+        ])
+        async for x in result:
+            if task == 'analysis':
+                work = WorkEnum.MA.value if x['_id']['is_main'] else WorkEnum.SA.value
+            else:
+                work = WorkEnum.C.value
+            key = (x['_id']['user_id'], x['_id']['case_type'], x['_id']['month'])
+            add_increment(increments, key, work, pending=x['total'] - x['finished'], finished=x['finished'])
+    collection = conn[database_name][workload_collection_name]
+    if increments:
+        await collection.bulk_write([ReplaceOne(
+            {'user_id': key[0], 'case_type': key[1], 'month': key[2]},
+            {'user_id': key[0], 'case_type': key[1], 'month': key[2],
+             'pending': {x: item.get(f'pending.{x}', 0) for x in WORKS},
+             'finished': {x: item.get(f'finished.{x}', 0) for x in WORKS}},
+            upsert=True
+        ) for key, item in increments.items()], ordered=False)
+    # 删除已不存在任务的统计
+    keys = set(increments)
+    stale = [x['_id'] async for x in collection.find({}, {'user_id': 1, 'case_type': 1, 'month': 1})
+             if (x['user_id'], x['case_type'], x['month']) not in keys]
+    if stale:
+        await collection.delete_many({'_id': {'$in': stale}})
+    return True
+
+
+async def init_workload(conn: AsyncIOMotorClient):
+    # 计数集合为空而已有任务时（首次上线），统计一次
+    if await conn[database_name][workload_collection_name].find_one({}, {'_id': 1}) is None and \
+            await conn[database_name][analysis_collection_name].find_one({}, {'_id': 1}) is not None:
+        await rebuild_workload(conn=conn)
+    return True
@@ -0,0 +1,102 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError, NetworkTimeout, OperationFailure
+from typing import List
+from app.core.config import database_name, bulk_chunk_size, bulk_retries, bulk_use_transaction
+from loguru import logger
+import asyncio
+
+DUPLICATE_KEY = 11000
+
+
+def is_transient(e: Exception):
+    if isinstance(e, (AutoReconnect, NetworkTimeout)):
+        return True
+    return isinstance(e, OperationFailure) and (
+            e.has_error_label('TransientTransactionError') or e.has_error_label('RetryableWriteError'))
+
+
+class BulkWriter:
+    '''
+        批量幂等写入：按key字段upsert，已存在的文档不会被覆盖（$setOnInsert）
+        分批无序bulk_write，遇到网络等临时错误重试；transaction为True时在一个事务内写入全部集合（需副本集）
+        用法:
+            writer = BulkWriter(conn)
+            writer.add(case_collection_name, ['case_id'], docs)
+            summary = await writer.write()
+        写入后writer.inserted为{collection: [本次新插入的文档]}，已存在的文档不计入
+    '''
+
+    def __init__(self, conn: AsyncIOMotorClient, chunk_size: int = bulk_chunk_size, retries: int = bulk_retries,
+                 transaction: bool = bulk_use_transaction):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.transaction = transaction
+        self._items = []
+        self.inserted = {}
+
+    def add(self, collection_name: str, keys: List[str], docs: List[dict]):
+        self._items.append((collection_name, keys, docs))
+        return self
+
+    async def write(self):
+        '''
+            返回各集合写入汇总 {collection: {'upserted': 新插入, 'matched': 已存在, 'duplicates': 并发插入冲突}}
+        '''
+        if not self.transaction:
+            self.inserted = {}
+            summary = {}
+            for collection_name, keys, docs in self._items:
+                summary[collection_name] = await self._write_collection(collection_name, keys, docs)
+            return summary
+        for n in range(self.retries + 1):
+            try:
+                async with await self.conn.start_session() as session:
+                    async with session.start_transaction():
+                        # 事务重试时重新统计
+                        self.inserted = {}
+                        summary = {}
+                        for collection_name, keys, docs in self._items:
+                            summary[collection_name] = await self._write_collection(collection_name, keys, docs,
+                                                                                    session=session)
+                        return summary
+            except Exception as e:
+                if n >= self.retries or not is_transient(e):
+                    raise
+                logger.warning(f'批量写入事务重试: {e}')
+                await asyncio.sleep(0.1 * 2 ** n)
+
+    async def _write_collection(self, collection_name: str, keys: List[str], docs: List[dict], session=None):
+        summary = {'upserted': 0, 'matched': 0, 'duplicates': 0}
+        collection = self.conn[database_name][collection_name]
+        inserted = self.inserted.setdefault(collection_name, [])
+        for n in range(0, len(docs), self.chunk_size):
+            chunk = docs[n:n + self.chunk_size]
+            requests = [UpdateOne({k: x[k] for k in keys}, {'$setOnInsert': x}, upsert=True) for x in chunk]
+            result = await self._write_chunk(collection, requests, session)
+            for k in summary:
+                summary[k] += result[k]
+            inserted.extend(chunk[x] for x in result['inserted'])
+        return summary
+
+    async def _write_chunk(self, collection, requests: List[UpdateOne], session=None):
+        # 事务内由外层统一重试，事务外upsert可安全重放
+        retries = 0 if session is not None else self.retries
+        for n in range(retries + 1):
+            try:
+                result = await collection.bulk_write(requests, ordered=False, session=session)
+                return {'upserted': result.upserted_count, 'matched': result.matched_count, 'duplicates': 0,
+                        'inserted': list(result.upserted_ids or {})}
+            except BulkWriteError as e:
+                # 并发upsert同一key时会有重复键错误，视为已存在；其他错误抛出
+                errors = e.details.get('writeErrors', [])
+                if any(x['code'] != DUPLICATE_KEY for x in errors) or session is not None:
+                    raise
+                return {'upserted': e.details.get('nUpserted', 0), 'matched': e.details.get('nMatched', 0),
+                        'duplicates': len(errors), 'inserted': [x['index'] for x in e.details.get('upserted', [])]}
+            except Exception as e:
+                if n >= retries or not is_transient(e):
+                    raise
+                logger.warning(f'批量写入重试: {collection.name} {e}')
+                await asyncio.sleep(0.1 * 2 ** n)
@@ -0,0 +1,153 @@
+from app.core.config import cache_backend, cache_prefix, cache_ttl, redis_host, redis_port, redis_password
+from app.utils.cache import LRUCache
+from loguru import logger
+import json
+import time
+
+# 命名空间，key均在命名空间下
+CASE_LIST = 'case_list'
+CASE_TOTAL = 'case_total'
+GROUP = 'group'
+USER = 'user'
+
+
+class LocalBackend:
+    '''
+        进程内缓存，未配置redis或redis不可用时使用，多个worker之间不共享
+    '''
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._namespaces = {}
+
+    def _namespace(self, namespace: str) -> LRUCache:
+        if namespace not in self._namespaces:
+            self._namespaces[namespace] = LRUCache(maxsize=self.maxsize)
+        return self._namespaces[namespace]
+
+    async def get(self, namespace: str, key: str):
+        return self._namespace(namespace).get(key)
+
+    async def set(self, namespace: str, key: str, value, ttl: float):
+        self._namespace(namespace).set(key, value, ttl=ttl)
+
+    async def delete(self, namespace: str, keys):
+        for x in keys:
+            self._namespace(namespace).delete(x)
+
+    async def invalidate(self, namespace: str):
+        self._namespace(namespace).clear()
+
+    async def close(self):
+        self._namespaces.clear()
+
+
+class RedisBackend:
+    '''
+        每个命名空间对应一个redis hash，field为key，值内附带过期时间
+        整个命名空间失效只需DEL一次；hash本身设置EXPIRE用于清理
+    '''
+
+    def __init__(self, client, prefix: str = cache_prefix):
+        self.client = client
+        self.prefix = prefix
+
+    def _name(self, namespace: str):
+        return f'{self.prefix}:{namespace}'
+
+    async def get(self, namespace: str, key: str):
+        data = await self.client.hget(self._name(namespace), key)
+        if data is None:
+            return None
+        data = json.loads(data)
+        if data['e'] < time.time():
+            return None
+        return data['v']
+
+    async def set(self, namespace: str, key: str, value, ttl: float):
+        name = self._name(namespace)
+        await self.client.hset(name, key, json.dumps({'e': time.time() + ttl, 'v': value}))
+        await self.client.expire(name, int(ttl) + 1)
+
+    async def delete(self, namespace: str, keys):
+        if keys:
+            await self.client.hdel(self._name(namespace), *keys)
+
+    async def invalidate(self, namespace: str):
+        await self.client.delete(self._name(namespace))
+
+    async def close(self):
+        await self.client.close()
+
+
+class SharedCache:
+    '''
+        热点接口结果缓存，值需可JSON序列化
+        缓存读写失败只记录日志，不影响接口本身
+    '''
+
+    def __init__(self):
+        self.backend = LocalBackend()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, namespace: str, key: str):
+        try:
+            value = await self.backend.get(namespace, key)
+        except Exception as e:
+            logger.error(f'读取缓存失败: {e}')
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, namespace: str, key: str, value, ttl: float = cache_ttl):
+        try:
+            await self.backend.set(namespace, key, value, ttl)
+        except Exception as e:
+            logger.error(f'写入缓存失败: {e}')
+
+    async def delete(self, namespace: str, *keys: str):
+        try:
+            await self.backend.delete(namespace, keys)
+        except Exception as e:
+            logger.error(f'删除缓存失败: {e}')
+
+    async def invalidate(self, *namespaces: str):
+        for x in namespaces:
+            try:
+                await self.backend.invalidate(x)
+            except Exception as e:
+                logger.error(f'清空缓存失败: {e}')
+
+    @property
+    def shared(self):
+        # 使用redis时各worker共享缓存，删除和失效对所有worker生效
+        return isinstance(self.backend, RedisBackend)
+
+    def stats(self):
+        return {'backend': type(self.backend).__name__, 'hits': self.hits, 'misses': self.misses}
+
+
+cache = SharedCache()
+
+
+async def connect_to_cache() -> None:
+    if cache_backend != 'redis':
+        logger.info("使用进程内缓存")
+        return
+    try:
+        from redis import asyncio as aioredis
+        client = aioredis.Redis(host=redis_host, port=redis_port, password=redis_password, decode_responses=True)
+        await client.ping()
+    except Exception as e:
+        logger.warning(f'连接redis失败，使用进程内缓存: {e}')
+        return
+    cache.backend = RedisBackend(client)
+    logger.info("连接redis成功！")
+
+
+async def close_cache_connection():
+    await cache.backend.close()
@@ -0,0 +1,133 @@
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from motor.motor_asyncio import AsyncIOMotorClient
+from app.core.config import database_name, user_collection_name, case_collection_name, analysis_collection_name, \
+    count_collection_name, group_collection_name, division_collection_name, case_view_collection_name, \
+    scan_cursor_collection_name, scan_file_collection_name, export_job_collection_name, workload_collection_name, \
+    version_collection_name
+from loguru import logger
+
+# 各集合索引声明，启动时幂等创建；新增查询时在此补充对应索引
+INDEXES = {
+    user_collection_name: [
+        IndexModel([('id', ASCENDING)], unique=True),
+        IndexModel([('username', ASCENDING)], unique=True),
+    ],
+    case_collection_name: [
+        IndexModel([('case_id', ASCENDING)], unique=True),
+        IndexModel([('finished', ASCENDING), ('case_id', ASCENDING)]),
+    ],
+    analysis_collection_name: [
+        IndexModel([('id', ASCENDING)], unique=True),
+        IndexModel([('case_id', ASCENDING), ('user_id', ASCENDING)], unique=True),
+        IndexModel([('user_id', ASCENDING), ('case_id', ASCENDING)]),
+    ],
+    count_collection_name: [
+        IndexModel([('id', ASCENDING)], unique=True),
+        IndexModel([('case_id', ASCENDING), ('user_id', ASCENDING)], unique=True),
+        IndexModel([('user_id', ASCENDING), ('case_id', ASCENDING)]),
+    ],
+    group_collection_name: [
+        IndexModel([('id', ASCENDING)], unique=True),
+    ],
+    division_collection_name: [
+        IndexModel([('id', ASCENDING)], unique=True),
+        IndexModel([('group_id', ASCENDING), ('user_id', ASCENDING), ('case_type', ASCENDING)], unique=True),
+        IndexModel([('user_id', ASCENDING)]),
+    ],
+    case_view_collection_name: [
+        IndexModel([('case_id', ASCENDING)], unique=True),
+        IndexModel([('finished', ASCENDING), ('case_id', ASCENDING)]),
+        IndexModel([('analysis.user_id', ASCENDING), ('finished', ASCENDING), ('case_id', ASCENDING)]),
+        IndexModel([('count.user_id', ASCENDING), ('finished', ASCENDING), ('case_id', ASCENDING)]),
+        IndexModel([('modify_time', ASCENDING)]),
+    ],
+    scan_cursor_collection_name: [
+        IndexModel([('path', ASCENDING)], unique=True),
+    ],
+    scan_file_collection_name: [
+        IndexModel([('path', ASCENDING), ('name', ASCENDING)], unique=True),
+    ],
+    export_job_collection_name: [
+        IndexModel([('job_id', ASCENDING)], unique=True),
+        # 只有未结束的任务有active_key，保证相同导出同时只有一个任务
+        IndexModel([('active_key', ASCENDING)], unique=True, sparse=True),
+        IndexModel([('status', ASCENDING), ('create_time', DESCENDING)]),
+    ],
+    workload_collection_name: [
+        IndexModel([('user_id', ASCENDING), ('case_type', ASCENDING), ('month', ASCENDING)], unique=True),
+    ],
+    version_collection_name: [
+        IndexModel([('name', ASCENDING)], unique=True),
+    ],
+}
+
+# 应用中主要的查询形态，用于explain检查是否命中索引
+QUERY_SHAPES = [
+    {'name': 'user_by_id', 'collection': user_collection_name, 'filter': {'id': ''}},
+    {'name': 'case_exist', 'collection': case_collection_name, 'filter': {'case_id': {'$in': ['']}},
+     'projection': {'case_id': 1, '_id': 0}},
+    {'name': 'analysis_by_case_and_user', 'collection': analysis_collection_name,
+     'filter': {'case_id': '', 'user_id': ''}},
+    {'name': 'analysis_me', 'collection': analysis_collection_name, 'filter': {'user_id': ''}},
+    {'name': 'count_by_case', 'collection': count_collection_name, 'filter': {'case_id': ''}},
+    {'name': 'count_me', 'collection': count_collection_name, 'filter': {'user_id': ''}},
+    {'name': 'division_by_group', 'collection': division_collection_name, 'filter': {'group_id': ''}},
+    {'name': 'case_list', 'collection': case_view_collection_name,
+     'filter': {'$or': [{'count.user_id': ''}, {'analysis.user_id': ''}], 'finished': False},
+     'sort': [('case_id', ASCENDING)]},
+    {'name': 'case_total', 'collection': case_view_collection_name, 'filter': {'finished': True},
+     'sort': [('case_id', ASCENDING)]},
+    {'name': 'case_view_by_case', 'collection': case_view_collection_name, 'filter': {'case_id': ''}},
+]
+
+
+async def create_indexes(client: AsyncIOMotorClient):
+    for collection_name, indexes in INDEXES.items():
+        try:
+            await client[database_name][collection_name].create_indexes(indexes)
+        except OperationFailure as e:
+            # 历史数据有重复等原因导致建索引失败时不阻止启动，记录后人工处理
+            logger.error(f'创建索引失败: {collection_name} {e}')
+
+
+def get_winning_plan_stages(plan: dict):
+    # 将winningPlan展开为阶段列表，如['FETCH', 'IXSCAN(case_id_1)']
+    stages = []
+    while plan:
+        stage = plan.get('stage', '')
+        if plan.get('indexName'):
+            stage = f"{stage}({plan['indexName']})"
+        stages.append(stage)
+        if 'inputStages' in plan:
+            for x in plan['inputStages']:
+                stages.extend(get_winning_plan_stages(x))
+            break
+        plan = plan.get('inputStage')
+    return stages
+
+
+async def get_index_report(client: AsyncIOMotorClient):
+    usage = {}
+    for collection_name in INDEXES:
+        result = client[database_name][collection_name].aggregate([{'$indexStats': {}}])
+        usage[collection_name] = [{
+            'name': x['name'],
+            'key': x['key'],
+            'ops': x['accesses']['ops'],
+            'since': x['accesses']['since']
+        } async for x in result]
+    plans = []
+    for x in QUERY_SHAPES:
+        cursor = client[database_name][x['collection']].find(x['filter'], x.get('projection'))
+        if x.get('sort'):
+            cursor = cursor.sort(x['sort'])
+        explain = await cursor.explain()
+        stages = get_winning_plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {}))
+        plans.append({
+            'name': x['name'],
+            'collection': x['collection'],
+            'winning_plan': stages,
+            'collection_scan': any(y.startswith('COLLSCAN') for y in stages)
+        })
+    return {'usage': usage, 'plans': plans}
@@ -0,0 +1,169 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from loguru import logger
+from typing import Callable, List
+from functools import wraps
+import asyncio
+import os
+import socket
+import time
+import uuid
+# custom defined
+from app.core.config import database_name, lock_collection_name, leader_lease_seconds, leader_renew_seconds
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class Lease:
+    '''
+        基于MongoDB的租约锁，一个name同一时间只有一个owner
+        过期时间按数据库服务器时间($$NOW)计算，不受各进程时钟偏差影响；每次换主token加一，作为fencing token
+    '''
+
+    def __init__(self, name: str, ttl: float = leader_lease_seconds):
+        self.name = name
+        self.ttl = ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.token = None
+        # 本地估算的到期时间，按发起请求前的时间计算，比服务器上的到期时间略早
+        self.expire_at = 0
+
+    async def acquire(self, conn: AsyncIOMotorClient) -> bool:
+        # 未被持有、已过期或本身持有时成功（本身持有即续租，token不变）
+        start = time.monotonic()
+        try:
+            result = await conn[database_name][lock_collection_name].find_one_and_update(
+                {'_id': self.name, '$or': [{'owner': self.owner}, {'$expr': {'$lt': ['$expire_at', '$$NOW']}}]},
+                [{'$set': {
+                    'token': {'$cond': [{'$eq': ['$owner', self.owner]}, '$token',
+                                        {'$add': [{'$ifNull': ['$token', 0]}, 1]}]},
+                    'owner': self.owner,
+                    'expire_at': {'$add': ['$$NOW', int(self.ttl * 1000)]},
+                }}],
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # 被其他owner持有且未过期，upsert插入同_id冲突
+            result = None
+        if result is None:
+            self.token = None
+            return False
+        self.token = result['token']
+        self.expire_at = start + self.ttl
+        return True
+
+    async def release(self, conn: AsyncIOMotorClient):
+        if self.token is None:
+            return
+        await conn[database_name][lock_collection_name].update_one(
+            {'_id': self.name, 'owner': self.owner, 'token': self.token},
+            [{'$set': {'expire_at': '$$NOW'}}])
+        self.token = None
+
+    def is_held(self) -> bool:
+        return self.token is not None and time.monotonic() < self.expire_at
+
+    async def check(self, conn: AsyncIOMotorClient):
+        '''
+            写入前校验仍持有租约且未被他人接管（token未变），否则抛出LeaseLostError
+        '''
+        if not self.is_held() or not await conn[database_name][lock_collection_name].find_one(
+                {'_id': self.name, 'owner': self.owner, 'token': self.token}, {'_id': 1}):
+            self.token = None
+            raise LeaseLostError(self.name)
+
+
+class LeaderElection:
+    '''
+        每个worker都运行选举循环，持有租约的为leader，按leader_renew_seconds续租
+        续租失败或超时即失去leader身份；leader退出或失联后租约过期，其他worker在下一次续租周期接管
+    '''
+
+    def __init__(self, name: str):
+        self.lease = Lease(name=name)
+        self.on_elected: List[Callable] = []
+        self.on_revoked: List[Callable] = []
+        self.enabled = False
+        self._conn = None
+        self._task = None
+        self._leader = False
+        self._elected = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader and self.lease.is_held()
+
+    def start(self, conn: AsyncIOMotorClient):
+        self._conn = conn
+        self.enabled = True
+        self._elected = asyncio.Event()
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self):
+        self.enabled = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._leader:
+            await self._set_leader(False)
+        try:
+            await self.lease.release(self._conn)
+        except Exception as e:
+            logger.warning(f'释放租约失败: {e}')
+
+    async def wait(self, timeout: float) -> bool:
+        # 等待成为leader，超时返回False
+        try:
+            await asyncio.wait_for(self._elected.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def check(self):
+        # 未启用选举（单独调用扫描等）时不校验
+        if self.enabled:
+            await self.lease.check(self._conn)
+
+    async def _set_leader(self, leader: bool):
+        self._leader = leader
+        if leader:
+            self._elected.set()
+        else:
+            self._elected.clear()
+        logger.info(f'{self.lease.owner} {"成为" if leader else "不再是"}{self.lease.name} leader, token={self.lease.token}')
+        for func in self.on_elected if leader else self.on_revoked:
+            try:
+                result = func()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.opt(exception=e).error('leader切换回调失败')
+
+    async def _run(self):
+        while True:
+            try:
+                held = await asyncio.wait_for(self.lease.acquire(self._conn), timeout=leader_renew_seconds)
+            except Exception as e:
+                logger.warning(f'续租失败: {e}')
+                held = self.lease.is_held()
+            if held != self._leader:
+                await self._set_leader(held)
+            await asyncio.sleep(leader_renew_seconds)
+
+    def guard(self, func):
+        # 包装定时任务，非leader时跳过
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not self.is_leader:
+                return None
+            return await func(*args, **kwargs)
+
+        return wrapper
+
+
+scan_leader = LeaderElection(name='scan')
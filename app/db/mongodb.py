@@ -1,5 +1,8 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from app.core.config import database_url, max_connections_count, min_connections_count
+from app.db.indexes import create_indexes
+from app.core.metrics import get_event_listeners
+from app.db.profiler import query_profiler
 from loguru import logger
 
 
@@ -14,13 +17,18 @@ async def get_database() -> AsyncIOMotorClient:
     return db.client
 
 
-async def connect_to_mongodb() -> None:
+async def connect_to_mongodb(max_pool_size: int = max_connections_count,
+                             min_pool_size: int = min_connections_count) -> None:
     logger.info("连接数据库中...")
     db.client = AsyncIOMotorClient(str(database_url),
-                                   maxPoolSize=max_connections_count,
-                                   minPoolSize=min_connections_count,
+                                   maxPoolSize=max_pool_size,
+                                   minPoolSize=min_pool_size,
+                                   event_listeners=get_event_listeners() + [query_profiler],
                                    )
+    query_profiler.attach(db.client)
     logger.info("连接数据库成功！")
+    await create_indexes(db.client)
+    logger.info("索引检查完成！")
 
 
 async def close_mongo_connection():
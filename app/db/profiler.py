@@ -0,0 +1,259 @@
+from pymongo import monitoring
+from bson import SON
+from collections import OrderedDict, deque
+from motor.motor_asyncio import AsyncIOMotorClient
+from loguru import logger
+import asyncio
+import hashlib
+import json
+import threading
+import time
+# custom defined
+from app.core.config import slow_query_ms, query_stats_window, query_stats_max, slow_query_explain_interval
+from app.db.indexes import get_winning_plan_stages
+
+# 统计的命令及查询条件所在字段
+PROFILED_COMMANDS = {
+    'find': 'filter',
+    'aggregate': 'pipeline',
+    'count': 'query',
+    'distinct': 'query',
+    'findAndModify': 'query',
+}
+# 以下阶段内容为结构（字段名、关联集合等），保留原值；其余阶段及查询条件中的值替换为?
+STRUCTURAL_STAGES = {'$lookup', '$project', '$sort', '$unwind', '$group', '$addFields', '$set', '$unset',
+                     '$replaceRoot', '$count', '$merge', '$out'}
+# 带写入的管道不执行explain
+WRITE_STAGES = {'$merge', '$out'}
+
+
+def query_shape(value):
+    '''
+        去掉查询中的字面值，只保留结构，例如{'case_id': {'$in': ['L1', 'L2']}}变为{'case_id': {'$in': '?'}}
+    '''
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        # $and/$or等条件列表保留结构，$in等值列表整体替换
+        if any(isinstance(x, dict) for x in value):
+            return [query_shape(x) for x in value]
+        return '?'
+    if isinstance(value, str) and value.startswith('$'):
+        return value
+    return '?'
+
+
+def pipeline_shape(pipeline: list):
+    shape = []
+    for stage in pipeline:
+        name = next(iter(stage), '')
+        shape.append(stage if name in STRUCTURAL_STAGES else {name: query_shape(stage[name])})
+    return shape
+
+
+def command_shape(command_name: str, command: dict):
+    field = PROFILED_COMMANDS[command_name]
+    if command_name == 'aggregate':
+        shape = {'pipeline': pipeline_shape(command.get('pipeline', []))}
+    else:
+        shape = {field: query_shape(command.get(field, {}))}
+        if command.get('sort'):
+            shape['sort'] = dict(command['sort'])
+        if command.get('projection'):
+            shape['projection'] = dict(command['projection'])
+    return shape
+
+
+def fingerprint(command_name: str, collection: str, shape: dict):
+    text = json.dumps(shape, default=str, ensure_ascii=False)
+    key = hashlib.md5(f'{command_name}:{collection}:{text}'.encode()).hexdigest()[:16]
+    return key, text
+
+
+def find_key(data, key: str):
+    # explain结构随命令和版本不同，递归查找第一个指定字段
+    if isinstance(data, dict):
+        if key in data:
+            return data[key]
+        data = list(data.values())
+    if isinstance(data, list):
+        for x in data:
+            result = find_key(x, key)
+            if result is not None:
+                return result
+    return None
+
+
+def count_returned(command_name: str, reply: dict):
+    if 'cursor' in reply:
+        return len(reply['cursor'].get('firstBatch', reply['cursor'].get('nextBatch', [])))
+    if command_name == 'count':
+        return reply.get('n', 0)
+    if command_name == 'distinct':
+        return len(reply.get('values', []))
+    if command_name == 'findAndModify':
+        return 1 if reply.get('value') else 0
+    return 0
+
+
+class QueryStats:
+    def __init__(self, key: str, command: str, collection: str, shape: str):
+        self.key = key
+        self.command = command
+        self.collection = collection
+        self.shape = shape
+        self.count = 0
+        self.slow = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.docs_returned = 0
+        self.samples = deque(maxlen=query_stats_window)
+        self.explain = None
+        self.explain_time = 0.0
+        self.last_seen = None
+
+    def percentile(self, p: float):
+        data = sorted(self.samples)
+        return data[min(int(len(data) * p / 100), len(data) - 1)] if data else 0
+
+    def to_dict(self):
+        return {
+            'fingerprint': self.key,
+            'command': self.command,
+            'collection': self.collection,
+            'shape': self.shape,
+            'count': self.count,
+            'slow': self.slow,
+            'total_ms': round(self.total_ms, 3),
+            'avg_ms': round(self.total_ms / self.count, 3) if self.count else 0,
+            'p50_ms': round(self.percentile(50), 3),
+            'p95_ms': round(self.percentile(95), 3),
+            'max_ms': round(self.max_ms, 3),
+            'docs_returned': self.docs_returned,
+            'explain': self.explain,
+            'last_seen': self.last_seen,
+        }
+
+
+class QueryProfiler(monitoring.CommandListener):
+    '''
+        按查询形态（去掉字面值）汇总find/aggregate等命令的耗时和返回文档数，getMore计入原查询
+        超过slow_query_ms的查询记录日志，并在后台执行explain(executionStats)补充扫描文档数和执行计划，
+        同一形态在slow_query_explain_interval秒内只explain一次
+    '''
+
+    def __init__(self):
+        self.client = None
+        self.loop = None
+        self._lock = threading.Lock()
+        self._stats = OrderedDict()
+        self._started = {}
+        self._cursors = OrderedDict()
+
+    def attach(self, client: AsyncIOMotorClient):
+        # 在事件循环中调用，explain需要通过该客户端在事件循环中执行
+        self.client = client
+        self.loop = asyncio.get_event_loop()
+
+    def started(self, event):
+        if event.command_name == 'getMore':
+            # 游标未结束时succeeded中会重新登记
+            key = self._cursors.pop(event.command.get('getMore'), None)
+            if key is not None:
+                self._started[(event.request_id, event.connection_id)] = (key, None)
+            return
+        if event.command_name == 'killCursors':
+            for x in event.command.get('cursors', []):
+                self._cursors.pop(x, None)
+            return
+        if event.command_name not in PROFILED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            return
+        shape = command_shape(event.command_name, event.command)
+        key, text = fingerprint(event.command_name, collection, shape)
+        with self._lock:
+            if key not in self._stats:
+                self._stats[key] = QueryStats(key=key, command=event.command_name, collection=collection, shape=text)
+                while len(self._stats) > query_stats_max:
+                    self._stats.popitem(last=False)
+            self._stats.move_to_end(key)
+        self._started[(event.request_id, event.connection_id)] = (key, (event.database_name, event.command))
+
+    def succeeded(self, event):
+        item = self._started.pop((event.request_id, event.connection_id), None)
+        if item is None:
+            return
+        key, origin = item
+        reply = event.reply
+        cursor_id = reply.get('cursor', {}).get('id') if isinstance(reply.get('cursor'), dict) else None
+        if cursor_id:
+            self._cursors[cursor_id] = key
+            while len(self._cursors) > query_stats_max:
+                self._cursors.popitem(last=False)
+        self.record(key=key, duration_ms=event.duration_micros / 1000,
+                    returned=count_returned(event.command_name, reply), origin=origin)
+
+    def failed(self, event):
+        item = self._started.pop((event.request_id, event.connection_id), None)
+        if item is not None:
+            self.record(key=item[0], duration_ms=event.duration_micros / 1000, returned=0, origin=item[1])
+
+    def record(self, key: str, duration_ms: float, returned: int, origin):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                return
+            stats.total_ms += duration_ms
+            stats.docs_returned += returned
+            stats.max_ms = max(stats.max_ms, duration_ms)
+            stats.last_seen = time.time()
+            # getMore没有origin，只累计耗时和文档数
+            if origin is not None:
+                stats.count += 1
+                stats.samples.append(duration_ms)
+            if duration_ms < slow_query_ms:
+                return
+            stats.slow += 1
+            need_explain = origin is not None and time.monotonic() - stats.explain_time >= slow_query_explain_interval
+            if need_explain:
+                stats.explain_time = time.monotonic()
+        logger.warning(f'慢查询 {duration_ms:.1f}ms {stats.command} {stats.collection} {stats.shape}')
+        if need_explain and self.loop is not None and self.client is not None:
+            asyncio.run_coroutine_threadsafe(self.explain(stats=stats, database=origin[0], command=origin[1]),
+                                             self.loop)
+
+    async def explain(self, stats: QueryStats, database: str, command: dict):
+        if stats.command == 'aggregate' and any(next(iter(x), '') in WRITE_STAGES for x in command.get('pipeline', [])):
+            return
+        # 去掉会话、事务等驱动附加字段
+        command = SON((k, v) for k, v in command.items()
+                      if not k.startswith('$') and k not in ('lsid', 'txnNumber', 'autocommit', 'startTransaction'))
+        try:
+            result = await self.client[database].command(SON([('explain', command), ('verbosity', 'executionStats')]))
+        except Exception as e:
+            logger.warning(f'慢查询explain失败 {stats.key}: {e}')
+            return
+        execution = find_key(result, 'executionStats') or {}
+        stats.explain = {
+            'docs_examined': execution.get('totalDocsExamined'),
+            'keys_examined': execution.get('totalKeysExamined'),
+            'returned': execution.get('nReturned'),
+            'execution_ms': execution.get('executionTimeMillis'),
+            'winning_plan': get_winning_plan_stages(find_key(result, 'winningPlan') or {}),
+        }
+        logger.warning(f'慢查询explain {stats.key} {stats.collection} {stats.shape}: {stats.explain}')
+
+    def top(self, n: int = 20, sort: str = 'total_ms'):
+        with self._lock:
+            data = [x.to_dict() for x in self._stats.values()]
+        return sorted(data, key=lambda x: x[sort], reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._cursors.clear()
+
+
+query_profiler = QueryProfiler()
@@ -7,9 +7,34 @@ from fastapi.security import OAuth2PasswordBearer
 from app.models.user import UserInDB, TokenPayload, User
 from app.db.mongodb import AsyncIOMotorClient, get_database
 from app.core.config import jwt_token_prefix, secret_key, access_token_expire_minutes, algorithm, timezone, \
-    database_name, user_collection_name
+    database_name, user_collection_name, user_cache_size, user_cache_ttl
+from app.utils.cache import LRUCache
+from app.db.cache import cache, USER
 import jwt
 
+# 已认证用户缓存，key为用户id，value为User除token外的字段
+# 配置redis时放在共享缓存中，失效对所有worker生效；未配置时使用进程内LRU，只适用于单worker
+user_cache = LRUCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+
+
+async def get_cached_user(user_id: str) -> Optional[dict]:
+    if cache.shared:
+        return await cache.get(USER, user_id)
+    return user_cache.get(user_id)
+
+
+async def set_cached_user(user_id: str, data_user: dict):
+    if cache.shared:
+        await cache.set(USER, user_id, data_user, ttl=user_cache_ttl)
+    else:
+        user_cache.set(user_id, data_user)
+
+
+async def invalidate_user_cache(user_id: str):
+    # 用户信息、密码、权限变更或删除后调用
+    user_cache.delete(user_id)
+    await cache.delete(USER, user_id)
+
 
 async def get_user(conn: AsyncIOMotorClient, query: Optional[dict]) -> UserInDB:
     row = await conn[database_name][user_collection_name].find_one(query)
@@ -41,16 +66,22 @@ async def _get_current_user(db: AsyncIOMotorClient = Depends(get_database),
         raise HTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="40006"
         )
-    '''
-    从redis中读取用户数据，如无数据，再从mongo中查询，如有，直接返回
-    '''
-
-    dbuser = await get_user(db, {'id': token_data.id})
-    if not dbuser:
-        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="40007")
-
-    user = User(**dbuser.dict(), token=token)
-    return user
+    # 先从缓存读取用户数据，如无数据，再从mongo中查询
+    data_user = await get_cached_user(token_data.id)
+    if data_user is None:
+        dbuser = await get_user(db, {'id': token_data.id})
+        if not dbuser:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="40007")
+        data_user = {'id': dbuser.id, 'username': dbuser.username, 'is_admin': dbuser.is_admin,
+                     'realname': dbuser.realname}
+        await set_cached_user(token_data.id, data_user)
+    # 缓存数据来自已校验的UserInDB，无需再次校验
+    return User.construct(**data_user, token=token)
+
+
+# WebSocket、SSE等无法使用Header的连接，token通过参数传入
+async def get_user_by_token(db: AsyncIOMotorClient, token: str) -> User:
+    return await _get_current_user(db=db, token=token)
 
 
 # 公开内容，无token可访问
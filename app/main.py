@@ -2,20 +2,26 @@ from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException
 from starlette.middleware.cors import CORSMiddleware
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from datetime import datetime
 import uvicorn
 
 from app.core.errors import http_error_handler, http422_error_handler, catch_exceptions_middleware
+from app.core.metrics import metrics_middleware
 from app.api import router as api_router
-from app.core.config import allowed_hosts, prefix_url, debug, version, host, port, project_name
-from app.db.mongodb import connect_to_mongodb, close_mongo_connection
-from app.utils.utils import scan_files_by_path
+from app.core.config import allowed_hosts, prefix_url, debug, version, host, port, project_name, scan_in_api, \
+    push_enabled
+from app.db.mongodb import connect_to_mongodb, close_mongo_connection, get_database
+from app.db.cache import connect_to_cache, close_cache_connection
+from app.crud.case import init_case_view
+from app.crud.workload import init_workload
+from app.scheduler import start_scheduler, stop_scheduler
+from app.utils.push import push_hub
 
 app = FastAPI(title=project_name, debug=debug, version=version)
 
 # 普通异常全局捕获
 app.middleware('http')(catch_exceptions_middleware)
+# 接口耗时统计，在异常捕获外层，500也会被记录
+app.middleware('http')(metrics_middleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,10 +31,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-scheduler = AsyncIOScheduler()
-
 app.add_event_handler("startup", connect_to_mongodb)
+app.add_event_handler("startup", connect_to_cache)
+# 先停止调度并释放租约，再断开数据库
+app.add_event_handler("shutdown", stop_scheduler)
+app.add_event_handler("shutdown", push_hub.stop)
 app.add_event_handler("shutdown", close_mongo_connection)
+app.add_event_handler("shutdown", close_cache_connection)
 
 app.add_exception_handler(HTTPException, http_error_handler)
 app.add_exception_handler(RequestValidationError, http422_error_handler)
@@ -37,9 +46,23 @@ app.include_router(api_router, prefix=prefix_url)
 
 
 @app.on_event('startup')
-def init_scheduler():
-    scheduler.add_job(func=scan_files_by_path, trigger='interval', minutes=10, next_run_time=datetime.now())
-    scheduler.start()
+async def init_collections():
+    db = await get_database()
+    await init_case_view(conn=db)
+    await init_workload(conn=db)
+
+
+@app.on_event('startup')
+async def init_push():
+    if push_enabled:
+        push_hub.start(conn=await get_database())
+
+
+@app.on_event('startup')
+async def init_scheduler():
+    # scan_in_api关闭时扫描由独立worker(python -m app.worker)执行
+    if scan_in_api:
+        await start_scheduler()
 
 
 if __name__ == '__main__':
@@ -14,3 +14,9 @@ class AnalysisModel(BaseModel):
 
 class AnalysisCreateModel(AnalysisModel, IDModel, UpdatedAtModel, CreatedAtModel):
     pass
+
+
+class AnalysisPatchItem(BaseModel):
+    case_id: str
+    analysis: List[str] = None
+    karyotype: str = None
@@ -34,6 +34,24 @@ class CaseImportRequest(BaseModel):
     case_id: str
 
 
+class CaseBatchImportRequest(BaseModel):
+    API_KEY: str = None
+    data: List[CaseImportRequest]
+
+
+class CaseImportStatusEnum(str, Enum):
+    C = 'created'
+    U = 'unassigned'
+    I = 'invalid'
+    E = 'exists'
+    D = 'duplicate'
+
+
+class CaseImportResult(BaseModel):
+    case_id: str
+    status: CaseImportStatusEnum
+
+
 class CaseCreateModel(IDModel, CreatedAtModel, UpdatedAtModel):
     case_id: str
     finished: bool = False
@@ -112,3 +130,23 @@ class CaseWithAnalysisAndCountByUser(BaseModel):
     analysis: List[AnalysisByUser]
     count: CountByUser
     work: WorkEnum
+
+
+class ExportJobStatusEnum(str, Enum):
+    P = 'pending'
+    R = 'running'
+    F = 'finished'
+    E = 'failed'
+    C = 'cancelled'
+
+
+class ExportJobModel(BaseModel):
+    job_id: str
+    status: ExportJobStatusEnum
+    total: int
+    done: int = 0
+    file: str = None
+    success: List[str] = []
+    error: List[dict] = []
+    create_time: str
+    update_time: str = None
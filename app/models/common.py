@@ -1,5 +1,6 @@
 from datetime import datetime
 from pydantic import BaseModel, validator
+from enum import Enum
 import uuid
 from app.core.config import timezone
 
@@ -26,3 +27,19 @@ class IDModel(BaseModel):
     @validator("id", pre=True, always=True)
     def default_id(cls, v, values, **kwargs) -> str:
         return v or uuid.uuid1().hex
+
+
+class TotalEnum(str, Enum):
+    # exact: 精确计数，approx: 估算（超过上限只返回上限），none: 不计数
+    E = 'exact'
+    A = 'approx'
+    N = 'none'
+
+
+class QuerySortEnum(str, Enum):
+    # 查询耗时排行的排序字段
+    T = 'total_ms'
+    P = 'p95_ms'
+    M = 'max_ms'
+    C = 'count'
+    S = 'slow'
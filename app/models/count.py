@@ -14,3 +14,10 @@ class CountModel(BaseModel):
 
 class CountCreateModel(CountModel, IDModel, CreatedAtModel, UpdatedAtModel):
     pass
+
+
+class CountPatchItem(BaseModel):
+    case_id: str
+    count: List[str] = None
+    extra: List[str] = None
+    remark: str = None
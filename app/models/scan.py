@@ -0,0 +1,8 @@
+from pydantic import BaseModel
+
+
+class ScanCursorModel(BaseModel):
+    path: str
+    dir_mtime: float = 0
+    last_mtime: float = 0
+    update_time: str = None
@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import List
 from enum import Enum
 # custom defined
-from app.utils.security import verify_password
+from app.utils.security import verify_password, verify_password_async
 from app.models.common import IDModel, UpdatedAtModel, CreatedAtModel
 
 
@@ -37,6 +37,9 @@ class UserInDB(UserBase):
     def check_password(self, password: str):
         return verify_password(self.salt + password, self.hashed_password)
 
+    async def check_password_async(self, password: str):
+        return await verify_password_async(self.salt + password, self.hashed_password)
+
 
 class TokenResponse(BaseModel):
     access_token: str
@@ -58,7 +61,8 @@ class UserListModel(BaseModel):
 
 class UserListResponse(BaseModel):
     data: List[UserListModel]
-    total: int
+    total: int = None
+    next: str = None
 
 
 class GroupEnum(str, Enum):
@@ -0,0 +1,42 @@
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from datetime import datetime
+# custom defined
+from app.core.config import scan_mode, scan_interval_minutes
+from app.core.metrics import track_job, add_scheduler_listeners
+from app.db.mongodb import get_database
+from app.db.lease import scan_leader
+from app.utils.utils import scan_files_by_path
+from app.utils.watcher import watcher
+
+# API进程和独立worker共用的扫描调度
+scheduler = AsyncIOScheduler()
+# 只在leader实际执行时记录耗时，非leader跳过的调度不计入
+scan_job = scan_leader.guard(track_job(scan_files_by_path))
+
+
+def scan_now():
+    # 成为leader时立即补扫一次
+    if scan_mode == 'watch':
+        scheduler.add_job(func=scan_job, id='scan_files_by_path', replace_existing=True)
+    else:
+        scheduler.modify_job('scan_files_by_path', next_run_time=datetime.now())
+
+
+async def start_scheduler():
+    # 每个进程都启动调度，扫描及文件监听只在持有租约的leader上执行
+    if scan_mode == 'watch':
+        scan_leader.on_elected.append(watcher.start)
+        scan_leader.on_revoked.append(watcher.stop)
+    else:
+        scheduler.add_job(func=scan_job, id='scan_files_by_path', trigger='interval', minutes=scan_interval_minutes)
+    scan_leader.on_elected.append(scan_now)
+    add_scheduler_listeners(scheduler)
+    scheduler.start()
+    scan_leader.start(conn=await get_database())
+
+
+async def stop_scheduler():
+    if not scheduler.running:
+        return
+    await scan_leader.stop()
+    scheduler.shutdown(wait=False)
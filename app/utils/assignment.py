@@ -0,0 +1,146 @@
+from bisect import bisect_left, bisect_right
+from typing import List
+from app.core.config import assignment_table_ttl
+from app.crud.user import get_all_division_group_by_group, get_division_version, inc_division_version
+from app.models.user import DivisionGroupByGroup
+from app.models.case import CaseCreateModel, AnalysisCreateModel, CountCreateModel, CaseImportStatusEnum
+from loguru import logger
+import time
+
+# 分配结果
+CREATED = CaseImportStatusEnum.C
+UNASSIGNED = CaseImportStatusEnum.U
+INVALID = CaseImportStatusEnum.I
+
+
+class CompiledCaseType:
+    '''
+        单个样本类型的分工前缀和表
+        analysis_bounds[i]为前i+1个分析组分工数量之和，count_bounds[i]为前i+1个计数人员分工数量之和
+    '''
+
+    def __init__(self):
+        self.analysis_groups = []
+        self.analysis_bounds = []
+        self.count_members = []
+        self.count_bounds = []
+
+    def compile(self, analysis: dict, count: list):
+        # analysis: {group_name: [(user_id, user_name, quantities)]}，count: [(group_name, (user_id, user_name, quantities))]
+        total = 0
+        for _, members in sorted(analysis.items(), key=lambda n: n[0]):
+            total += sum(x[2] for x in members)
+            self.analysis_groups.append(members)
+            self.analysis_bounds.append(total)
+        total = 0
+        for _, member in sorted(count, key=lambda n: n[0]):
+            total += member[2]
+            self.count_members.append(member)
+            self.count_bounds.append(total)
+
+    def resolve_analysis(self, number: int):
+        # 主辅分析求和，求余，余数为0时视为最后一个
+        total = self.analysis_bounds[-1]
+        cache = number % total or total
+        index = bisect_left(self.analysis_bounds, cache)
+        members = self.analysis_groups[index]
+        cache -= self.analysis_bounds[index - 1] if index else 0
+        # 余数落在第一个人的分工内则第一个人主分析，否则第二个人主分析
+        if cache <= members[0][2]:
+            return members[0], members[1]
+        return members[1], members[0]
+
+    def resolve_count(self, number: int):
+        cache = number % self.count_bounds[-1]
+        return self.count_members[bisect_right(self.count_bounds, cache)]
+
+
+class AssignmentTable:
+    '''
+        由分工配置编译出的分配表，每个case通过二分查找定位主分析、辅分析和计数人员
+        人员以(user_id, user_name, quantities)表示
+    '''
+
+    def __init__(self, data_division: List[DivisionGroupByGroup]):
+        # 分析按组名归并，计数按人员展开，之后均按组名排序
+        analysis = {'L': {}, 'G': {}}
+        count = {'L': [], 'G': []}
+        for x in data_division:
+            for y in x.division:
+                member = (y.user_id, y.user_name, y.quantities)
+                if x.group_type == 'count':
+                    count[y.case_type].append((x.group_name, member))
+                else:
+                    analysis[y.case_type].setdefault(x.group_name, []).append(member)
+        self.case_types = {}
+        for case_type in analysis:
+            self.case_types[case_type] = CompiledCaseType()
+            self.case_types[case_type].compile(analysis=analysis[case_type], count=count[case_type])
+
+    def resolve(self, case_id: str):
+        '''
+            返回(主分析人员, 辅分析人员, 计数人员)，非指定类型返回None
+            分工配置不完整时抛出异常（ZeroDivisionError/IndexError）
+        '''
+        compiled = self.case_types.get(case_id[0])
+        if compiled is None:
+            return None
+        main, aux = compiled.resolve_analysis(int(case_id[7:]))
+        return main, aux, compiled.resolve_count(int(case_id[5:]))
+
+
+def is_valid_case_id(case_id: str):
+    # L/G类型，之后为年月及编号，resolve按case_id[5:]、case_id[7:]取编号，须为非空数字
+    return case_id[:1] in ['L', 'G'] and len(case_id) > 7 and case_id[1:].isascii() and case_id[1:].isdigit()
+
+
+def build_assignment(table: AssignmentTable, case_ids: List[str]):
+    '''
+        为新case生成待写入的case、analysis、count，返回(case列表, analysis列表, count列表, {case_id: 结果})
+        非L/G类型或编号不是数字的不入库；分工配置不完整时不创建case，分工修正后扫描或导入可重试
+    '''
+    case_item = []
+    analysis_item = []
+    count_item = []
+    outcomes = {}
+    for case_id in case_ids:
+        # 过滤非指定类型及编号不是数字的case，这些case重试也无法分配，不能计为未分配
+        if not is_valid_case_id(case_id):
+            outcomes[case_id] = INVALID
+            continue
+        try:
+            main, aux, count = table.resolve(case_id)
+        except Exception as e:
+            logger.error(f'分配失败: {case_id} {e!r}')
+            outcomes[case_id] = UNASSIGNED
+            continue
+        case_item.append(CaseCreateModel(case_id=case_id))
+        analysis_item.append(AnalysisCreateModel(case_id=case_id, user_id=main[0], user_name=main[1], is_main=True))
+        analysis_item.append(AnalysisCreateModel(case_id=case_id, user_id=aux[0], user_name=aux[1], is_main=False))
+        count_item.append(CountCreateModel(case_id=case_id, user_id=count[0], user_name=count[1]))
+        outcomes[case_id] = CREATED
+    return case_item, analysis_item, count_item, outcomes
+
+
+_table = None
+_table_version = None
+_table_expire_at = 0
+
+
+async def get_assignment_table(conn) -> AssignmentTable:
+    # 每次使用前比对version集合中的分工版本，其他进程（API的其他worker、独立扫描worker）的修改立即生效
+    global _table, _table_version, _table_expire_at
+    version = await get_division_version(conn=conn)
+    if _table is None or version != _table_version or time.monotonic() > _table_expire_at:
+        data_division = await get_all_division_group_by_group(conn=conn)
+        _table = AssignmentTable(data_division)
+        # 先读版本后读分工，加载期间的修改会在下次比对时重新加载
+        _table_version = version
+        _table_expire_at = time.monotonic() + assignment_table_ttl
+    return _table
+
+
+async def invalidate_assignment_table(conn):
+    global _table
+    _table = None
+    await inc_division_version(conn=conn)
@@ -0,0 +1,107 @@
+from openpyxl import Workbook
+from typing import List
+from app.core.config import export_batch_size
+from app.crud.case import get_case_view_list_by_case_ids
+from app.models.case import CaseWithAnalysisAndCount
+import asyncio
+
+EXPORT_COLUMNS = ['编号', '分析1', '分析2', '分析3', '分析4', '分析5', '核型1', '核型1-主看者', '主看时间', '核型2', '核型2-辅看者',
+                  '辅看时间'] + [f'计数{n + 1}' for n in range(15)] + ['计数者', '计数时间', '计数备注']
+
+
+class ExcelWriter:
+    '''
+        openpyxl只写模式，行数据直接落到临时文件，内存占用不随行数增长
+        第一列为行号，与原先DataFrame.to_excel输出一致
+    '''
+
+    def __init__(self, columns: List[str]):
+        self.columns = columns
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet('Sheet1')
+        self.sheet.append([None] + columns)
+        self.rows = 0
+
+    def append(self, rows: List[dict]):
+        for x in rows:
+            self.sheet.append([self.rows] + [x.get(y) for y in self.columns])
+            self.rows += 1
+
+    def save(self, path: str):
+        self.workbook.save(path)
+
+
+def check_case(data_case: CaseWithAnalysisAndCount):
+    '''
+        检查主辅分析是否填完，分析结果是否一致，计数是否15个完整
+        返回(行数据, 错误列表)，有错误时行数据为None
+    '''
+    errors = []
+    for x in data_case.analysis:
+        if x.is_main is True and len(x.analysis) != 3:
+            errors.append('未完成主分析')
+        elif x.is_main is False and len(x.analysis) != 2:
+            errors.append('未完成辅分析')
+    if len(data_case.analysis) < 2 or data_case.analysis[0].karyotype != data_case.analysis[1].karyotype:
+        errors.append('主辅分析结果不一致')
+    if len(data_case.count.count) != 15:
+        errors.append('未完成计数')
+    if errors:
+        return None, errors
+    row = {'编号': data_case.case_id}
+    for x in data_case.analysis:
+        if x.is_main is True:
+            row.update({'分析1': x.analysis[0], '分析2': x.analysis[1], '分析3': x.analysis[2], '核型1': x.karyotype,
+                        '核型1-主看者': x.realname, '主看时间': x.update_time})
+        else:
+            row.update({'分析4': x.analysis[0], '分析5': x.analysis[1], '核型2': x.karyotype,
+                        '核型2-辅看者': x.realname, '辅看时间': x.update_time})
+    # 组装15个计数
+    for n in range(len(data_case.count.count)):
+        row[f'计数{n + 1}'] = data_case.count.count[n]
+    row.update({'计数者': data_case.count.realname, '计数时间': data_case.count.update_time,
+                '计数备注': data_case.count.remark})
+    return row, []
+
+
+async def run_in_thread(func, *args):
+    '''
+        在线程池中执行，被取消时线程无法中断，等待其执行完再抛出CancelledError，
+        调用方之后删除文件时不会再被线程写入
+    '''
+    future = asyncio.get_event_loop().run_in_executor(None, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+async def export_case_list(conn, case_list: List[str], path: str, batch_size: int = export_batch_size,
+                           progress=None):
+    '''
+        按批次查询case_view并校验，按请求顺序逐批写入Excel，写文件在线程池中执行
+        await progress(已处理数量)在每批写入后回调
+        返回(成功的case_id列表, 错误列表)
+    '''
+    writer = await run_in_thread(ExcelWriter, EXPORT_COLUMNS)
+    export_list = []
+    error_list = []
+    for n in range(0, len(case_list), batch_size):
+        batch = case_list[n:n + batch_size]
+        data_case = {x.case_id: x for x in await get_case_view_list_by_case_ids(conn=conn, case_ids=batch)}
+        rows = []
+        for case_id in batch:
+            if case_id not in data_case:
+                error_list.append({'case_id': case_id, 'error': '未找到样本'})
+                continue
+            row, errors = check_case(data_case[case_id])
+            error_list.extend({'case_id': case_id, 'error': x} for x in errors)
+            if row is not None:
+                export_list.append(case_id)
+                rows.append(row)
+        await run_in_thread(writer.append, rows)
+        if progress is not None:
+            await progress(n + len(batch))
+    await run_in_thread(writer.save, path)
+    return export_list, error_list
@@ -0,0 +1,183 @@
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+from typing import List
+from app.core.config import database_name, export_job_collection_name, export_path, export_max_jobs, \
+    export_keep_jobs, export_heartbeat_seconds, export_job_timeout_seconds, timezone
+from app.db.mongodb import get_database
+from app.models.case import ExportJobModel, ExportJobStatusEnum
+from app.utils.export import export_case_list
+from loguru import logger
+import asyncio
+import hashlib
+import uuid
+import os
+
+ACTIVE = [ExportJobStatusEnum.P.value, ExportJobStatusEnum.R.value]
+
+
+class ExportCancelledError(Exception):
+    pass
+
+
+class ExportJobManager:
+    '''
+        导出任务队列，任务状态保存在export_job集合，多worker部署时任一worker均可查询和取消
+        任务由提交请求的worker执行，每个worker最多同时执行export_max_jobs个导出，导出文件需位于各worker共享的export_path
+        相同case列表的任务未结束时直接复用（active_key唯一索引），不重复导出
+        执行任务的worker定期更新heartbeat，超过export_job_timeout_seconds未更新的任务视为worker已退出，标记为失败
+    '''
+
+    def __init__(self, max_jobs: int = export_max_jobs, keep_jobs: int = export_keep_jobs):
+        self.max_jobs = max_jobs
+        self.keep_jobs = keep_jobs
+        self._tasks = {}
+        self._semaphore = None
+        self._heartbeat_task = None
+
+    @staticmethod
+    def job_key(case_list: List[str]):
+        return hashlib.sha1('\n'.join(case_list).encode()).hexdigest()
+
+    @staticmethod
+    async def _collection():
+        return (await get_database())[database_name][export_job_collection_name]
+
+    async def submit(self, case_list: List[str]) -> ExportJobModel:
+        collection = await self._collection()
+        await self._expire(collection)
+        key = self.job_key(case_list)
+        job = ExportJobModel(job_id=uuid.uuid1().hex, status=ExportJobStatusEnum.P, total=len(case_list),
+                             create_time=datetime.now(tz=timezone).isoformat())
+        try:
+            await collection.insert_one({**job.dict(), 'active_key': key, 'heartbeat': datetime.utcnow()})
+        except DuplicateKeyError:
+            result = await collection.find_one({'active_key': key}, {'_id': 0})
+            if result is not None:
+                return ExportJobModel(**result)
+            # 冲突的任务刚好结束，重新提交
+            return await self.submit(case_list)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_jobs)
+        task = asyncio.get_event_loop().create_task(self._run(job.job_id, case_list))
+        task.add_done_callback(lambda _: self._tasks.pop(job.job_id, None))
+        self._tasks[job.job_id] = task
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.get_event_loop().create_task(self._heartbeat())
+        await self._prune(collection)
+        return job
+
+    async def get(self, job_id: str) -> ExportJobModel:
+        collection = await self._collection()
+        await self._expire(collection)
+        result = await collection.find_one({'job_id': job_id}, {'_id': 0})
+        return ExportJobModel(**result) if result else None
+
+    async def wait(self, job_id: str, poll_seconds: float = 1) -> ExportJobModel:
+        task = self._tasks.get(job_id)
+        if task is not None:
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # 任务被取消时只结束等待，请求本身被取消则继续抛出
+                if not task.cancelled():
+                    raise
+        # 复用的任务可能在其他worker执行，轮询到结束
+        while True:
+            job = await self.get(job_id)
+            if job is None or job.status.value not in ACTIVE:
+                return job
+            await asyncio.sleep(poll_seconds)
+
+    async def cancel(self, job_id: str) -> bool:
+        collection = await self._collection()
+        # 尚未开始执行的任务直接标记为已取消，执行中的任务由执行的worker在下一批次检查到后结束
+        if await self._end(collection, job_id, status=ExportJobStatusEnum.P.value,
+                           item={'status': ExportJobStatusEnum.C.value}) is None:
+            result = await collection.find_one_and_update(
+                {'job_id': job_id, 'status': ExportJobStatusEnum.R.value}, {'$set': {'cancel': True}})
+            if result is None:
+                return False
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        return True
+
+    @staticmethod
+    async def _end(collection, job_id: str, item: dict, status=None, query: dict = None):
+        # 结束任务并释放active_key，任务已结束时返回None
+        return await collection.find_one_and_update(
+            {'job_id': job_id, 'status': status or {'$in': ACTIVE}, **(query or {})},
+            {'$set': {**item, 'update_time': datetime.now(tz=timezone).isoformat()}, '$unset': {'active_key': ''}})
+
+    @staticmethod
+    async def _progress(collection, job_id: str, done: int):
+        result = await collection.find_one_and_update(
+            {'job_id': job_id},
+            {'$set': {'done': done, 'heartbeat': datetime.utcnow(),
+                      'update_time': datetime.now(tz=timezone).isoformat()}},
+            projection={'_id': 0, 'job_id': 1, 'cancel': 1})
+        if result is None or result.get('cancel'):
+            raise ExportCancelledError(job_id)
+
+    async def _run(self, job_id: str, case_list: List[str]):
+        path = f'{export_path}/{job_id}.xlsx'
+        collection = await self._collection()
+        try:
+            async with self._semaphore:
+                # 排队期间可能已被取消
+                if await collection.find_one_and_update(
+                        {'job_id': job_id, 'status': ExportJobStatusEnum.P.value},
+                        {'$set': {'status': ExportJobStatusEnum.R.value,
+                                  'update_time': datetime.now(tz=timezone).isoformat()}}) is None:
+                    return
+                db = await get_database()
+                success, error = await export_case_list(
+                    conn=db, case_list=case_list, path=path,
+                    progress=lambda n: self._progress(collection, job_id, n))
+            # 保存文件期间被取消或已被判定超时
+            if await self._end(collection, job_id, item={
+                'status': ExportJobStatusEnum.F.value, 'file': f'{job_id}.xlsx', 'success': success, 'error': error
+            }, query={'cancel': {'$ne': True}}) is None:
+                raise ExportCancelledError(job_id)
+        except (asyncio.CancelledError, ExportCancelledError):
+            await self._end(collection, job_id, item={'status': ExportJobStatusEnum.C.value})
+            self._remove_file(path)
+        except Exception as e:
+            logger.exception(e)
+            await self._end(collection, job_id, item={'status': ExportJobStatusEnum.E.value})
+            self._remove_file(path)
+
+    async def _heartbeat(self):
+        # 本进程有任务时定期更新heartbeat，排队中的任务同样需要
+        while self._tasks:
+            try:
+                collection = await self._collection()
+                await collection.update_many({'job_id': {'$in': list(self._tasks)}},
+                                             {'$set': {'heartbeat': datetime.utcnow()}})
+            except Exception as e:
+                logger.warning(f'导出任务心跳失败: {e}')
+            await asyncio.sleep(export_heartbeat_seconds)
+
+    @staticmethod
+    async def _expire(collection):
+        await collection.update_many(
+            {'active_key': {'$exists': True},
+             'heartbeat': {'$lt': datetime.utcnow() - timedelta(seconds=export_job_timeout_seconds)}},
+            {'$set': {'status': ExportJobStatusEnum.E.value, 'update_time': datetime.now(tz=timezone).isoformat()},
+             '$unset': {'active_key': ''}})
+
+    async def _prune(self, collection):
+        # 只保留最近keep_jobs个已结束的任务
+        result = collection.find({'status': {'$nin': ACTIVE}}, {'_id': 0, 'job_id': 1}).sort(
+            'create_time', -1).skip(self.keep_jobs)
+        job_ids = [x['job_id'] async for x in result]
+        if job_ids:
+            await collection.delete_many({'job_id': {'$in': job_ids}})
+
+    @staticmethod
+    def _remove_file(path: str):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+export_jobs = ExportJobManager()
@@ -0,0 +1,26 @@
+from typing import Optional
+import base64
+import json
+
+
+def encode_cursor(after: str) -> str:
+    # 续页标记对客户端不透明，内容为上一页最后一条的排序键
+    return base64.urlsafe_b64encode(json.dumps({'after': after}).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Optional[str]:
+    '''
+        解析续页标记，格式错误时抛出ValueError
+    '''
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))['after']
+    except Exception:
+        raise ValueError('invalid cursor')
+
+
+def next_cursor(data: list, key: str, limit: int) -> Optional[str]:
+    # 本页不满说明已到末页
+    if len(data) < limit:
+        return None
+    last = data[-1]
+    return encode_cursor(last[key] if isinstance(last, dict) else getattr(last, key))
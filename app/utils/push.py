@@ -0,0 +1,160 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure, PyMongoError
+from datetime import datetime, timedelta
+from typing import Dict, Set, List
+from loguru import logger
+import asyncio
+# custom defined
+from app.core.config import database_name, case_view_collection_name, push_mode, push_poll_seconds, \
+    push_poll_overlap, push_queue_size, push_heartbeat_seconds
+from app.crud.case import case_view_to_dict
+
+# 消息op: upsert 新增或修改（data为与/case/list一致的单条数据），remove 已完成移出列表，reload 需重新获取列表，ping 心跳
+RELOAD = {'op': 'reload'}
+PING = {'op': 'ping'}
+
+
+def case_view_users(doc: dict) -> Set[str]:
+    users = set(x['user_id'] for x in doc.get('analysis', []))
+    if doc.get('count'):
+        users.add(doc['count']['user_id'])
+    return users
+
+
+def build_message(doc: dict, user_id: str):
+    if doc['finished']:
+        return {'op': 'remove', 'case_id': doc['case_id']}
+    return {'op': 'upsert', 'case_id': doc['case_id'], 'data': case_view_to_dict(data=doc, user_id=user_id)}
+
+
+class PushHub:
+    '''
+        监听case_view变更并按用户分发工作列表增量，case_view已合并case、analysis、count，只需监听这一个集合
+        push_mode为stream时使用change stream（需副本集），poll时按modify_time轮询，auto时不支持change stream则退化为轮询
+        每个连接一个有界队列，消费过慢队列满时清空并发送reload，由客户端重新获取列表
+    '''
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._task = None
+        self.mode = None
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=push_queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def _put(self, queue: asyncio.Queue, message: dict):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(RELOAD)
+
+    def publish(self, doc: dict):
+        for user_id in case_view_users(doc):
+            for queue in self._subscribers.get(user_id, ()):
+                self._put(queue, build_message(doc, user_id))
+
+    def broadcast(self, message: dict):
+        for queues in self._subscribers.values():
+            for queue in queues:
+                self._put(queue, message)
+
+    async def next_message(self, queue: asyncio.Queue) -> dict:
+        # 超过心跳间隔没有消息时返回ping
+        try:
+            return await asyncio.wait_for(queue.get(), timeout=push_heartbeat_seconds)
+        except asyncio.TimeoutError:
+            return PING
+
+    def start(self, conn: AsyncIOMotorClient):
+        self._task = asyncio.get_event_loop().create_task(self._run(conn))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self, conn: AsyncIOMotorClient):
+        collection = conn[database_name][case_view_collection_name]
+        if push_mode != 'poll':
+            try:
+                await self._watch(collection)
+            except OperationFailure as e:
+                if push_mode == 'stream':
+                    raise
+                logger.warning(f'不支持change stream，推送退化为轮询: {e}')
+        await self._poll(collection)
+
+    async def _watch(self, collection):
+        resume_token = None
+        while True:
+            try:
+                async with collection.watch(full_document='updateLookup', resume_after=resume_token) as stream:
+                    self.mode = 'stream'
+                    logger.info('工作列表推送已启动(change stream)')
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        self._on_change(change)
+            except OperationFailure:
+                # 单机mongod等不支持change stream，由调用方退化为轮询
+                if self.mode is None:
+                    raise
+                logger.opt(exception=True).warning('change stream中断，重新连接')
+                resume_token = None
+                self.broadcast(RELOAD)
+            except PyMongoError:
+                logger.opt(exception=True).warning('change stream中断，重新连接')
+            await asyncio.sleep(1)
+
+    def _on_change(self, change: dict):
+        if change['operationType'] in ('insert', 'update', 'replace') and change.get('fullDocument'):
+            self.publish(change['fullDocument'])
+        elif change['operationType'] in ('delete', 'drop', 'rename', 'dropDatabase', 'invalidate'):
+            # 删除事件只有_id，不知道涉及哪些用户
+            self.broadcast(RELOAD)
+
+    async def _poll(self, collection):
+        '''
+            按modify_time查找变更，时间窗口向前重叠push_poll_overlap秒以容忍多进程写入的时钟偏差，
+            重叠部分按(case_id, modify_time)去重
+        '''
+        self.mode = 'poll'
+        logger.info('工作列表推送已启动(轮询)')
+        overlap = timedelta(seconds=push_poll_overlap)
+        last = datetime.utcnow()
+        seen = {}
+        while True:
+            await asyncio.sleep(push_poll_seconds)
+            if not self._subscribers:
+                last = datetime.utcnow()
+                continue
+            try:
+                docs: List[dict] = await collection.find(
+                    {'modify_time': {'$gt': last - overlap}}, {'_id': 0}).sort('modify_time', 1).to_list(length=None)
+            except PyMongoError:
+                logger.opt(exception=True).warning('推送轮询失败')
+                continue
+            for doc in docs:
+                key = (doc['case_id'], doc['modify_time'])
+                if key in seen:
+                    continue
+                seen[key] = doc['modify_time']
+                self.publish(doc)
+                last = max(last, doc['modify_time'])
+            seen = {k: v for k, v in seen.items() if v > last - overlap}
+
+
+push_hub = PushHub()
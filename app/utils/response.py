@@ -0,0 +1,24 @@
+from starlette.responses import JSONResponse
+from app.core.config import fast_response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class FastJSONResponse(JSONResponse):
+    '''
+        使用orjson序列化，未安装orjson时与JSONResponse一致
+        content需为可直接序列化的dict/list，不经过jsonable_encoder
+    '''
+
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+def respond(content):
+    # 开启fast_response时直接返回响应对象，跳过FastAPI的校验和默认序列化
+    return FastJSONResponse(content) if fast_response else content
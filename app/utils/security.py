@@ -1,8 +1,14 @@
 import bcrypt
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
+from app.core.config import password_workers
+import asyncio
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt计算耗时且会释放GIL，放到独立线程池中执行，不阻塞事件循环
+_password_executor = ThreadPoolExecutor(max_workers=password_workers, thread_name_prefix='bcrypt')
+
 
 def generate_salt():
     return bcrypt.gensalt().decode()
@@ -14,3 +20,13 @@ def verify_password(plain_password, hashed_password):
 
 def get_password_hash(password):
     return pwd_context.hash(password)
+
+
+async def verify_password_async(plain_password, hashed_password):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_password_executor, verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_password_executor, get_password_hash, password)
@@ -1,16 +1,20 @@
-from fastapi import Depends
 from datetime import datetime
-from app.core.config import src_path, src_ext
-from app.crud.case import get_case_list_by_query, create_case_with_analysis_and_count
-from app.crud.user import get_all_division_group_by_group
-from app.models.case import CaseCreateModel, AnalysisCreateModel, CountCreateModel, WorkEnum
+from app.core.config import src_path, src_ext, scan_month_window, scan_workers, scan_batch_size
+from app.crud.case import get_exist_case_id_set, create_case_with_analysis_and_count, sync_case_view_finished
+from app.crud.scan import get_scan_cursor_by_path, get_exist_scan_file_names, update_scan_cursor_with_names
+from app.models.case import WorkEnum
 from app.db.mongodb import get_database
+from app.utils.assignment import get_assignment_table, build_assignment, UNASSIGNED, INVALID
+from app.db.lease import scan_leader
+from loguru import logger
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+import asyncio
 import os
-import traceback
 
 
 def choose_work_type(data, user_id):
-    if data['_id']['count']['user_id'] == user_id:
+    if data['count']['user_id'] == user_id:
         return WorkEnum.C
     else:
         for y in data['analysis']:
@@ -22,6 +26,21 @@ def choose_work_type(data, user_id):
             return None
 
 
+# 定时扫描与文件事件可能同时触发，入库需串行，避免重复分配
+_ingest_lock = None
+
+
+# 目录遍历是阻塞IO，放到独立线程池中执行，不阻塞事件循环
+_scan_executor = ThreadPoolExecutor(max_workers=scan_workers, thread_name_prefix='scan')
+
+
+def get_ingest_lock():
+    global _ingest_lock
+    if _ingest_lock is None:
+        _ingest_lock = asyncio.Lock()
+    return _ingest_lock
+
+
 def month_path():
     now = datetime.now()
     path = now.strftime('%y%m')
@@ -29,147 +48,133 @@ def month_path():
     return path
 
 
-async def scan_files_by_path():
-    # 先扫描目标路径下文件，筛选组装case_id列表，新的case进行判断并直接分配分析计数
-    m_path = month_path()
+def month_paths(window: int = scan_month_window):
+    '''
+        返回需要扫描的月份目录，window为包含当月在内的月份数，<=0时返回src_path下全部目录
+    '''
+    if window <= 0:
+        if not os.path.isdir(src_path):
+            return []
+        return sorted(x.name for x in os.scandir(src_path) if x.is_dir())
+    now = datetime.now()
+    year, month = now.year, now.month
+    paths = []
+    for _ in range(window):
+        paths.append(f'{year % 100:02d}{month:02d}')
+        month -= 1
+        if month == 0:
+            year, month = year - 1, 12
+    return paths
+
+
+def get_dir_mtime(path: str):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def iter_src_files(path: str, batch_size: int = scan_batch_size):
+    '''
+        遍历目录中的源文件，按批次返回[(文件名, mtime)]，内存占用与批次大小成正比
+    '''
+    batch = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if src_ext not in entry.name:
+                continue
+            try:
+                batch.append((entry.name, entry.stat().st_mtime))
+            except FileNotFoundError:
+                continue
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+async def filter_new_files(db, m_path: str, files: List[Tuple[str, float]]):
+    # 去掉已入库的文件，每批一次索引查询
+    exist = await get_exist_scan_file_names(conn=db, path=m_path, names=[x[0] for x in files])
+    return [x for x in files if x[0] not in exist]
+
+
+async def scan_directory(db, m_path: str):
+    # 根据游标增量扫描单个月份目录，目录mtime未变化时说明没有文件新增或删除，直接跳过遍历
+    loop = asyncio.get_event_loop()
+    path = os.path.join(src_path, m_path)
+    cursor = await get_scan_cursor_by_path(conn=db, path=m_path)
+    dir_mtime = await loop.run_in_executor(_scan_executor, get_dir_mtime, path)
+    if dir_mtime is None or dir_mtime == cursor.dir_mtime:
+        return 0
+    total = 0
+    unassigned = 0
+    batches = iter_src_files(path=path)
+    try:
+        while True:
+            # 此时文件带sample_id，例如L2104052638.045.MMI
+            files = await loop.run_in_executor(_scan_executor, next, batches, None)
+            if files is None:
+                break
+            new_files = await filter_new_files(db=db, m_path=m_path, files=files)
+            if not new_files:
+                continue
+            async with get_ingest_lock():
+                unassigned += await ingest_files(db=db, m_path=m_path, new_files=new_files)
+            total += len(new_files)
+    finally:
+        batches.close()
+    # 全部批次入库后再记录目录mtime，中途失败下次会重新遍历；有未分配的文件时不记录，下次扫描重试
+    await update_scan_cursor_with_names(conn=db, path=m_path, last_mtime=cursor.last_mtime, names=[],
+                                        dir_mtime=None if unassigned else dir_mtime)
+    return total
+
+
+async def scan_files_by_path(window: int = scan_month_window):
+    # 先扫描目标路径下新增文件，筛选组装case_id列表，新的case进行判断并直接分配分析计数
+    loop = asyncio.get_event_loop()
     db = await get_database()
-    # 此时文件带sample_id，例如L2104052638.045.MMI
-    filenames = [filename for filename in os.listdir(os.path.join(src_path, m_path)) if src_ext in filename]
+    m_paths = await loop.run_in_executor(_scan_executor, month_paths, window)
+    results = await asyncio.gather(*[scan_directory(db=db, m_path=x) for x in m_paths], return_exceptions=True)
+    for m_path, result in zip(m_paths, results):
+        if isinstance(result, Exception):
+            logger.opt(exception=result).error(f'扫描目录失败: {m_path}')
+        elif result:
+            logger.info(f'扫描目录: {m_path} 新增{result}个文件')
+    try:
+        case_ids = await sync_case_view_finished(conn=db)
+        if case_ids:
+            logger.info(f'同步完成状态: {len(case_ids)}个case')
+    except Exception as e:
+        logger.opt(exception=e).error('同步完成状态失败')
+
+
+async def ingest_files(db, m_path: str, new_files: List[Tuple[str, float]], dir_mtime: float = None):
+    '''
+        新增文件入库并分配分析计数，new_files为[(文件名, mtime)]
+        未分配(分工配置不完整)及非指定类型的文件不记入游标，返回未分配的文件数
+        调用方需持有get_ingest_lock()
+    '''
+    # 多worker时校验仍为leader，防止失去租约后与新leader同时入库
+    await scan_leader.check()
     # 只保留case_id
-    filenames = sorted(list(set(x.split('.')[0] for x in filenames)))
-    data_case = await get_case_list_by_query(conn=db, query={})
-    scaned_filenames = [x.case_id for x in data_case]
+    filenames = sorted(list(set(x[0].split('.')[0] for x in new_files)))
+    # 只查询新文件对应的case，避免每次加载全部case
+    scaned_filenames = await get_exist_case_id_set(conn=db, case_ids=filenames)
     # 取差集筛选未扫描文件
-    new_cases = list(set(filenames).difference(set(scaned_filenames)))
-    data_division = await get_all_division_group_by_group(conn=db)
-    # data_division = [
-    #     {
-    #         "group_id": "group_id",
-    #         "group_name": "group_name",
-    #         "group_type": "count",
-    #         "division": [
-    #             {
-    #                 'user_id': '$user_id',
-    #                 'user_name': '$user.realname',
-    #                 'quantities': '$quantities',
-    #                 'case_type': 'L',
-    #                 'group_id': '$group_id',
-    #                 'id': '$id'
-    #             },
-    #             {
-    #                 'user_id': '$user_id',
-    #                 'user_name': '$user.realname',
-    #                 'quantities': '$quantities',
-    #                 'case_type': 'L',
-    #                 'group_id': '$group_id',
-    #                 'id': '$id'
-    #             }
-    #         ]
-    #     }
-    # ]
-    division = {'L': {'analysis': [], 'count': []}, 'G': {'analysis': [], 'count': []}}
-    case_insert_list = []
-    analysis_insert_list = []
-    count_insert_list = []
-    # 组装分工
-    # {
-    #     'L': {
-    #         'analysis': [
-    #             {'group_name': '分析A组', 'division': [
-    #                 {'user_id': 'xxx', 'quantities': 20},
-    #                 {'user_id': 'yyy', 'quantities': 20}
-    #             ]}
-    #         ],
-    #         'count': [
-    #             {'user_id': 'xxx', 'quantities': 20, 'group_name': '计数A组'}
-    #         ]
-    #     }
-    # }
-    for x in data_division:
-        for y in x.division:
-            if x.group_type == 'count':
-                division[y.case_type][x.group_type].append(
-                    {
-                        'user_id': y.user_id,
-                        'user_name': y.user_name,
-                        'quantities': y.quantities,
-                        'group_name': x.group_name
-                    }
-                )
-            else:
-                for z in division[y.case_type][x.group_type]:
-                    if x.group_name == z['group_name']:
-                        z['division'].append(
-                            {
-                                'user_id': y.user_id,
-                                'user_name': y.user_name,
-                                'quantities': y.quantities
-                            }
-                        )
-                        break
-                else:
-                    division[y.case_type][x.group_type].append(
-                        {
-                            'group_name': x.group_name,
-                            'division': [
-                                {
-                                    'user_id': y.user_id,
-                                    'user_name': y.user_name,
-                                    'quantities': y.quantities
-                                }
-                            ]
-                        }
-                    )
-    # 对analysis和count根据group_name进行排序, group_name都在value下同层
-    for x in division.values():
-        for y in x.values():
-            y.sort(key=lambda n: n['group_name'])
-    for case_id in new_cases:
-        try:
-            # 过滤非指定类型
-            if case_id[0] not in ['L', 'G']:
-                continue
-            case_insert_list.append(CaseCreateModel(case_id=case_id))
-            # 先算分析，主辅分析求和，求余
-            analysis_count_sum = sum([sum([y['quantities'] for y in x['division']]) for x in division[case_id[0]]['analysis']])
-            analysis_cache = int(case_id[7:]) % analysis_count_sum
-            if analysis_cache == 0:
-                analysis_cache = analysis_count_sum
-            for x in division[case_id[0]]['analysis']:
-                # 编号大于该组分工总和，则计算下一组
-                if analysis_cache - sum([y['quantities'] for y in x['division']]) > 0:
-                    analysis_cache = analysis_cache - sum([y['quantities'] for y in x['division']])
-                else:
-                    # 第一个人主分析
-                    if analysis_cache <= x['division'][0]['quantities']:
-                        analysis_insert_list.append(
-                            AnalysisCreateModel(case_id=case_id, user_id=x['division'][0]['user_id'],
-                                                user_name=x['division'][0]['user_name'], is_main=True))
-                        analysis_insert_list.append(
-                            AnalysisCreateModel(case_id=case_id, user_id=x['division'][1]['user_id'],
-                                                user_name=x['division'][1]['user_name'], is_main=False))
-                        break
-                    # 第二个人主分析
-                    else:
-                        analysis_insert_list.append(
-                            AnalysisCreateModel(case_id=case_id, user_id=x['division'][1]['user_id'],
-                                                user_name=x['division'][1]['user_name'], is_main=True))
-                        analysis_insert_list.append(
-                            AnalysisCreateModel(case_id=case_id, user_id=x['division'][0]['user_id'],
-                                                user_name=x['division'][0]['user_name'], is_main=False))
-                        break
-            # 算计数
-            count_cache = int(case_id[5:]) % sum(x['quantities'] for x in division[case_id[0]]['count'])
-            for x in division[case_id[0]]['count']:
-                if count_cache < x['quantities']:
-                    count_insert_list.append(
-                        CountCreateModel(case_id=case_id, user_id=x['user_id'], user_name=x['user_name']))
-                    break
-                else:
-                    count_cache = count_cache - x['quantities']
-        except Exception:
-            traceback.print_exc()
-            print(case_id)
+    new_cases = sorted(set(filenames).difference(scaned_filenames))
+    table = await get_assignment_table(conn=db)
+    case_insert_list, analysis_insert_list, count_insert_list, outcomes = build_assignment(table=table,
+                                                                                          case_ids=new_cases)
     if case_insert_list:
-        await create_case_with_analysis_and_count(conn=db, case_item=case_insert_list,
-                                                  analysis_item=analysis_insert_list, count_item=count_insert_list)
+        summary, _ = await create_case_with_analysis_and_count(conn=db, case_item=case_insert_list,
+                                                               analysis_item=analysis_insert_list,
+                                                               count_item=count_insert_list)
+        logger.info(f'扫描入库: {m_path} {summary}')
+    retry = set(x for x, y in outcomes.items() if y in (UNASSIGNED, INVALID))
+    names = [x[0] for x in new_files if x[0].split('.')[0] not in retry]
+    # 入库后再推进游标，失败时下次扫描会重试这些文件
+    await update_scan_cursor_with_names(conn=db, path=m_path, last_mtime=max(x[1] for x in new_files),
+                                        names=names, dir_mtime=dir_mtime)
+    return sum(1 for x in new_files if outcomes.get(x[0].split('.')[0]) == UNASSIGNED)
@@ -0,0 +1,199 @@
+from app.core.config import src_path, src_ext, watch_debounce_seconds, watch_batch_size, watch_poll_seconds
+from app.db.mongodb import get_database
+from app.utils.utils import month_paths, get_dir_mtime, scan_files_by_path, ingest_files, get_ingest_lock, \
+    filter_new_files
+from loguru import logger
+import ctypes
+import ctypes.util
+import asyncio
+import struct
+import os
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# 文件写完或移入才算新文件，避免读到写了一半的文件
+FILE_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF
+# 根目录只关心新建的月份目录
+ROOT_MASK = IN_CREATE | IN_MOVED_TO
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    '''
+        基于ctypes的Linux inotify封装，非Linux或内核不支持时初始化抛出OSError
+    '''
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify不可用')
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1失败')
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch失败: {path}')
+        return wd
+
+    def read_events(self):
+        # 返回[(wd, mask, name)]
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    '''
+        监听src_path下扫描窗口内月份目录的新文件，防抖合并成小批次后入库分配
+        inotify不可用时每watch_poll_seconds检查一次目录mtime，有变化才扫描
+    '''
+
+    def __init__(self, debounce: float = watch_debounce_seconds, batch_size: int = watch_batch_size,
+                 poll_seconds: float = watch_poll_seconds):
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self._inotify = None
+        self._root_wd = None
+        self._dirs = {}
+        self._pending = {}
+        self._flush_handle = None
+        self._poll_task = None
+        self._tasks = set()
+        self._loop = None
+
+    def start(self):
+        self._loop = asyncio.get_event_loop()
+        try:
+            self._inotify = Inotify()
+            self._root_wd = self._inotify.add_watch(src_path, ROOT_MASK)
+            for m_path in month_paths():
+                self._watch_month(m_path)
+            self._loop.add_reader(self._inotify.fd, self._on_readable)
+            logger.info(f'文件监听已启动(inotify): {src_path}')
+        except (OSError, AttributeError) as e:
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+            logger.warning(f'inotify不可用，退化为轮询目录mtime: {e}')
+            self._poll_task = self._loop.create_task(self._poll())
+
+    async def stop(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        if self._inotify is not None:
+            self._loop.remove_reader(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+        # 失去leader后其他worker可能已开始扫描，取消并等待正在防抖、入库的任务结束，不再继续入库
+        tasks = list(self._tasks)
+        if self._poll_task is not None:
+            tasks.append(self._poll_task)
+        for x in tasks:
+            x.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # 失去leader后可能再次start，未入库的文件由成为leader时的补扫处理
+        self._flush_handle = None
+        self._poll_task = None
+        self._tasks = set()
+        self._root_wd = None
+        self._dirs = {}
+        self._pending = {}
+
+    def _watch_month(self, m_path: str):
+        path = os.path.join(src_path, m_path)
+        if m_path in self._dirs.values() or not os.path.isdir(path):
+            return
+        wd = self._inotify.add_watch(path, FILE_MASK)
+        self._dirs[wd] = m_path
+
+    def _on_readable(self):
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，丢失的文件交给游标扫描补齐
+                logger.warning('inotify事件队列溢出，执行一次全量扫描')
+                self._spawn(scan_files_by_path())
+            elif mask & (IN_IGNORED | IN_DELETE_SELF):
+                self._dirs.pop(wd, None)
+            elif wd == self._root_wd:
+                if mask & IN_ISDIR:
+                    self._watch_month(name)
+                    # 目录创建与添加监听之间可能已有文件写入
+                    self._spawn(scan_files_by_path())
+            elif wd in self._dirs and src_ext in name:
+                self._add_pending(self._dirs[wd], name)
+
+    def _add_pending(self, m_path: str, name: str):
+        try:
+            mtime = os.stat(os.path.join(src_path, m_path, name)).st_mtime
+        except OSError:
+            return
+        files = self._pending.setdefault(m_path, {})
+        files[name] = mtime
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        if sum(len(x) for x in self._pending.values()) >= self.batch_size:
+            self._flush()
+        else:
+            self._flush_handle = self._loop.call_later(self.debounce, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        for m_path, files in pending.items():
+            self._spawn(self._ingest(m_path, list(files.items())))
+
+    def _spawn(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _ingest(self, m_path, new_files):
+        try:
+            db = await get_database()
+            async with get_ingest_lock():
+                # 重写等重复事件的文件已入库，过滤后不再重复处理
+                new_files = await filter_new_files(db=db, m_path=m_path, files=new_files)
+                if not new_files:
+                    return
+                await ingest_files(db=db, m_path=m_path, new_files=new_files)
+            logger.info(f'文件事件入库: {m_path} {len(new_files)}个文件')
+        except Exception as e:
+            logger.exception(e)
+
+    async def _poll(self):
+        last_mtime = {}
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                mtime = {x: get_dir_mtime(os.path.join(src_path, x)) for x in month_paths()}
+                if mtime != last_mtime:
+                    await scan_files_by_path()
+                    last_mtime = mtime
+            except Exception as e:
+                logger.exception(e)
+
+
+watcher = FileWatcher()
@@ -0,0 +1,76 @@
+'''
+独立的扫描入库worker，与API进程分开运行，使用自己的连接池和扫描线程数
+
+    python -m app.worker                        # 按scan_mode持续扫描，与其他进程通过租约选主
+    python -m app.worker --once --window 0      # 扫描全部月份目录一次后退出，用于补录
+    python -m app.worker --metrics-port 9100    # 在9100端口提供Prometheus指标
+
+API进程配置scan_in_api=false后只处理接口请求；用户及列表缓存的跨进程失效需要cache_backend=redis
+'''
+from prometheus_client import start_http_server
+from loguru import logger
+import argparse
+import asyncio
+import signal
+import sys
+# custom defined
+from app.core.config import worker_max_connections_count, worker_min_connections_count, scan_month_window, \
+    leader_renew_seconds
+from app.core.metrics import registry
+from app.db.mongodb import connect_to_mongodb, close_mongo_connection, get_database
+from app.db.cache import connect_to_cache, close_cache_connection
+from app.db.lease import scan_leader
+from app.crud.case import init_case_view
+from app.crud.workload import init_workload
+from app.scheduler import start_scheduler, stop_scheduler
+from app.utils.utils import scan_files_by_path
+
+
+async def run_once(window: int):
+    # 单次扫描同样需要持有租约（并持续续租），避免与正在运行的leader重复入库
+    scan_leader.start(conn=await get_database())
+    try:
+        if not await scan_leader.wait(timeout=leader_renew_seconds):
+            logger.error('其他进程正在执行扫描，退出')
+            return 1
+        await scan_files_by_path(window=window)
+        return 0
+    finally:
+        await scan_leader.stop()
+
+
+async def run_forever():
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await start_scheduler()
+    logger.info('扫描worker已启动')
+    await stop.wait()
+    await stop_scheduler()
+    return 0
+
+
+async def main(args):
+    await connect_to_mongodb(max_pool_size=worker_max_connections_count, min_pool_size=worker_min_connections_count)
+    await connect_to_cache()
+    try:
+        await init_case_view(conn=await get_database())
+        await init_workload(conn=await get_database())
+        if args.once:
+            return await run_once(window=args.window)
+        return await run_forever()
+    finally:
+        await close_cache_connection()
+        await close_mongo_connection()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m app.worker')
+    parser.add_argument('--once', action='store_true', help='扫描一次后退出')
+    parser.add_argument('--window', type=int, default=scan_month_window, help='--once时扫描的月份数，0为全部')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Prometheus指标端口')
+    args = parser.parse_args()
+    if args.metrics_port:
+        start_http_server(args.metrics_port, registry=registry)
+    sys.exit(asyncio.get_event_loop().run_until_complete(main(args)))
@@ -0,0 +1,366 @@
+'''
+端到端压测：在进程内启动app.main，连接临时mongod或进程内替身，写入模拟的用户、分组、分工和样本后
+按场景权重并发执行登录、样本列表、汇总翻页、录入分析/计数、导出和扫描，输出各路由的延迟分位数和吞吐量(JSON)
+
+    python -m benchmarks.load --backend standin --users 20 --duration 30
+    python -m benchmarks.load --backend mongod --mongod /usr/bin/mongod --cases 20000 --output result.json
+    python -m benchmarks.load --backend url --database-url mongodb://127.0.0.1:27017
+
+依赖见benchmarks/requirements.txt；url方式会清空--database-name指定的库，只能用于临时实例
+'''
+from datetime import datetime
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+# custom defined
+from benchmarks.login import percentile
+
+SCENARIOS = ['login', 'case_list', 'case_total', 'patch_analysis', 'patch_count', 'export', 'scan']
+DEFAULT_MIX = 'login=1,case_list=4,case_total=3,patch_analysis=3,patch_count=2,export=0.2,scan=0.2'
+PASSWORD = 'welcome1'
+
+
+def parse_mix(mix: str):
+    weights = {}
+    for x in mix.split(','):
+        name, weight = x.split('=')
+        if name not in SCENARIOS:
+            raise SystemExit(f'未知场景: {name}，可选: {",".join(SCENARIOS)}')
+        weights[name] = float(weight)
+    return weights
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Backend:
+    '''
+        standin: mongomock_motor进程内替身，不需要mongod，但不支持部分聚合（如数组localField的$lookup）
+        mongod: 在临时目录启动一个mongod，结束后删除
+        url: 连接已有的临时实例
+    '''
+
+    def __init__(self, kind: str, mongod: str = 'mongod', database_url: str = None):
+        self.kind = kind
+        self.mongod = mongod
+        self.database_url = database_url
+        self.process = None
+        self.dbpath = None
+
+    def start(self):
+        if self.kind == 'mongod':
+            self.dbpath = tempfile.mkdtemp(prefix='loadtest-mongod-')
+            port = free_port()
+            self.process = subprocess.Popen(
+                [self.mongod, '--dbpath', self.dbpath, '--port', str(port), '--bind_ip', '127.0.0.1', '--quiet'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.database_url = f'mongodb://127.0.0.1:{port}'
+        return self.database_url
+
+    def client(self):
+        if self.kind == 'standin':
+            from mongomock_motor import AsyncMongoMockClient
+            return AsyncMongoMockClient()
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient(self.database_url)
+
+    async def wait_ready(self, client, timeout: float = 30):
+        if self.kind == 'standin':
+            return
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                await client.admin.command('ping')
+                return
+            except Exception:
+                if self.process and self.process.poll() is not None:
+                    raise SystemExit('mongod启动失败')
+                if time.monotonic() > deadline:
+                    raise SystemExit('等待mongod超时')
+                await asyncio.sleep(0.2)
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.dbpath:
+            shutil.rmtree(self.dbpath, ignore_errors=True)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, route: str, elapsed: float, ok: bool):
+        self.latencies.setdefault(route, []).append(elapsed * 1000)
+        if not ok:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, elapsed: float):
+        return {route: {
+            'requests': len(data),
+            'errors': self.errors.get(route, 0),
+            'rps': round(len(data) / elapsed, 2),
+            'p50_ms': round(percentile(data, 50), 3),
+            'p95_ms': round(percentile(data, 95), 3),
+            'p99_ms': round(percentile(data, 99), 3),
+            'max_ms': round(max(data), 3),
+        } for route, data in sorted(self.latencies.items())}
+
+
+class LoadTest:
+    def __init__(self, client, http, recorder: Recorder, args):
+        self.client = client
+        self.http = http
+        self.recorder = recorder
+        self.args = args
+        self.tokens = {}
+        self.analysis_cases = {}
+        self.count_cases = {}
+        self.case_ids = []
+        self.next_case = 0
+
+    async def request(self, route: str, method: str, url: str, token: str = None, **kwargs):
+        from app.core.config import prefix_url
+        headers = kwargs.pop('headers', {})
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        start = time.perf_counter()
+        try:
+            response = await self.http.request(method, prefix_url + url, headers=headers, **kwargs)
+            ok = response.status_code < 400
+        except Exception:
+            response, ok = None, False
+        self.recorder.add(route, time.perf_counter() - start, ok)
+        return response
+
+    async def login(self, username: str):
+        response = await self.request('POST /users/login', 'POST', '/users/login',
+                                      data={'username': username, 'password': PASSWORD})
+        return response.json()['access_token'] if response is not None and response.status_code == 200 else None
+
+    def new_case_ids(self, n: int, case_type: str = None):
+        from app.utils.utils import month_path
+        ids = []
+        for _ in range(n):
+            t = case_type or random.choice('LG')
+            ids.append(f'{t}{month_path()}{self.next_case:06d}')
+            self.next_case += 1
+        return ids
+
+    async def seed(self):
+        # 全部经接口写入，与线上数据的生成路径一致
+        from app.core.config import api_key, import_max_cases
+        from app.core.config import database_name, analysis_collection_name, count_collection_name
+        from app.crud.user import get_user_by_name
+        args = self.args
+        await self.http_ok('POST', '/users/init', json={'data': {
+            'username': 'admin', 'realname': '管理员', 'is_admin': True, 'password': PASSWORD}, 'api_key': api_key})
+        admin = self.tokens['admin'] = await self.token('admin')
+        analysts = [f'analyst{i}' for i in range(args.analysts)]
+        counters = [f'counter{i}' for i in range(args.counters)]
+        for name in analysts + counters:
+            await self.http_ok('POST', '/user', token=admin, json={
+                'username': name, 'realname': name, 'is_admin': False, 'password': PASSWORD})
+        user_ids = {x: (await get_user_by_name(conn=self.client, name=x)).id for x in analysts + counters}
+        # 两个分析组（主分析/辅助分析）和一个计数组，每人都有L、G两种分工
+        groups = [(analysts[0::2], 'analysis'), (analysts[1::2], 'analysis'), (counters, 'count')]
+        for i, (members, group_type) in enumerate(groups):
+            group = await self.http_ok('POST', '/group', token=admin, json={
+                'group_name': f'{group_type}{i}', 'group_type': group_type})
+            for name in members:
+                for case_type in 'LG':
+                    await self.http_ok('POST', '/division', token=admin, json={
+                        'group_id': group['data']['group_id'], 'user_id': user_ids[name],
+                        'case_type': case_type, 'quantities': random.randint(1, 5)})
+        self.case_ids = self.new_case_ids(args.cases)
+        for i in range(0, len(self.case_ids), import_max_cases):
+            await self.http_ok('POST', '/case/import/batch', json={
+                'API_KEY': api_key, 'data': [{'case_id': x} for x in self.case_ids[i:i + import_max_cases]]})
+        for name in analysts + counters:
+            self.tokens[name] = await self.token(name)
+        names = {v: k for k, v in user_ids.items()}
+        async for x in self.client[database_name][analysis_collection_name].find({}, {'case_id': 1, 'user_id': 1}):
+            self.analysis_cases.setdefault(names.get(x['user_id']), []).append(x['case_id'])
+        async for x in self.client[database_name][count_collection_name].find({}, {'case_id': 1, 'user_id': 1}):
+            self.count_cases.setdefault(names.get(x['user_id']), []).append(x['case_id'])
+        if not self.analysis_cases or not self.count_cases:
+            raise SystemExit('没有已分配的样本，请增大--cases')
+        return {'users': len(user_ids) + 1, 'groups': len(groups), 'divisions': len(user_ids) * 2,
+                'cases': len(self.case_ids)}
+
+    async def http_ok(self, method: str, url: str, token: str = None, **kwargs):
+        from app.core.config import prefix_url
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        response = await self.http.request(method, prefix_url + url, headers=headers, **kwargs)
+        if response.status_code >= 400:
+            raise SystemExit(f'写入模拟数据失败: {method} {url} {response.status_code} {response.text}')
+        return response.json()
+
+    async def token(self, username: str):
+        # 准备阶段登录，不计入结果
+        response = await self.http_ok('POST', '/users/login', data={'username': username, 'password': PASSWORD})
+        return response['access_token']
+
+    async def scenario_login(self):
+        await self.login(random.choice([x for x in self.tokens if x != 'admin']))
+
+    async def scenario_case_list(self):
+        name = random.choice([x for x in self.tokens if x != 'admin'])
+        await self.request('GET /case/list', 'GET', '/case/list', token=self.tokens[name])
+
+    async def scenario_case_total(self):
+        # 按游标连续翻页
+        params = {'finished': False, 'limit': self.args.page_size, 'total': 'approx'}
+        for _ in range(self.args.pages):
+            response = await self.request('GET /case/total', 'GET', '/case/total', token=self.tokens['admin'],
+                                          params=params)
+            if response is None or response.status_code != 200 or not response.json().get('next'):
+                break
+            params = {**params, 'cursor': response.json()['next'], 'total': 'none'}
+
+    async def scenario_patch_analysis(self):
+        name = random.choice(list(self.analysis_cases))
+        await self.request('PATCH /analysis', 'PATCH', '/analysis', token=self.tokens[name], json={
+            'case_id': random.choice(self.analysis_cases[name]), 'analysis': ['46,XX'], 'karyotype': '46,XX'})
+
+    async def scenario_patch_count(self):
+        name = random.choice(list(self.count_cases))
+        await self.request('PATCH /count', 'PATCH', '/count', token=self.tokens[name], json={
+            'case_id': random.choice(self.count_cases[name]), 'count': ['46'], 'remark': 'load'})
+
+    async def scenario_export(self):
+        await self.request('POST /case/export', 'POST', '/case/export', token=self.tokens['admin'], json={
+            'case_list': random.sample(self.case_ids, min(self.args.export_size, len(self.case_ids)))})
+
+    async def scenario_scan(self):
+        # 在当月目录生成新文件后执行一次扫描
+        from app.core.config import src_path, src_ext
+        from app.utils.utils import month_path, scan_files_by_path
+        path = os.path.join(src_path, month_path())
+        os.makedirs(path, exist_ok=True)
+        for x in self.new_case_ids(self.args.scan_files):
+            open(os.path.join(path, f'{x}.001.{src_ext}'), 'w').close()
+        start = time.perf_counter()
+        try:
+            await scan_files_by_path(window=1)
+            ok = True
+        except Exception:
+            ok = False
+        self.recorder.add('scan', time.perf_counter() - start, ok)
+
+    async def user(self, weights: dict, deadline: float):
+        names, values = list(weights), list(weights.values())
+        while time.monotonic() < deadline:
+            await getattr(self, f'scenario_{random.choices(names, values)[0]}')()
+
+
+async def run(args, backend: Backend):
+    import httpx
+    from app.main import app, init_collections
+    from app.db.mongodb import db
+    from app.db.indexes import create_indexes
+    from app.db.cache import connect_to_cache, close_cache_connection
+    from app.core.config import database_name, version
+
+    client = backend.client()
+    await backend.wait_ready(client)
+    await client.drop_database(database_name)
+    db.client = client
+    # 不执行app的startup：数据库由压测指定，扫描由scan场景触发，不启动定时任务
+    if backend.kind != 'standin':
+        await create_indexes(client)
+    await connect_to_cache()
+    await init_collections()
+    recorder = Recorder()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://loadtest',
+                                     timeout=None) as http:
+            test = LoadTest(client=client, http=http, recorder=recorder, args=args)
+            seed = await test.seed()
+            start = time.monotonic()
+            await asyncio.gather(*[test.user(parse_mix(args.mix), start + args.duration) for _ in range(args.users)])
+            elapsed = time.monotonic() - start
+    finally:
+        await close_cache_connection()
+        await client.drop_database(database_name)
+    return {
+        'version': version,
+        'time': datetime.now().isoformat(),
+        'backend': backend.kind,
+        'users': args.users,
+        'duration_s': round(elapsed, 3),
+        'mix': parse_mix(args.mix),
+        'seed': seed,
+        'total_rps': round(sum(len(x) for x in recorder.latencies.values()) / elapsed, 2),
+        'routes': recorder.report(elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['standin', 'mongod', 'url'], default='standin')
+    parser.add_argument('--mongod', default='mongod', help='mongod可执行文件路径')
+    parser.add_argument('--database-url', default='mongodb://127.0.0.1:27017')
+    parser.add_argument('--database-name', default='chromoLoadTest')
+    parser.add_argument('--users', type=int, default=20, help='并发虚拟用户数')
+    parser.add_argument('--duration', type=float, default=30, help='压测时长（秒）')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='场景权重')
+    parser.add_argument('--analysts', type=int, default=12)
+    parser.add_argument('--counters', type=int, default=6)
+    parser.add_argument('--cases', type=int, default=5000)
+    parser.add_argument('--pages', type=int, default=5, help='case_total场景连续翻页数')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--export-size', type=int, default=50, help='export场景每次导出的样本数')
+    parser.add_argument('--scan-files', type=int, default=20, help='scan场景每次新增的文件数')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('--output', help='结果写入文件，默认输出到stdout')
+    args = parser.parse_args()
+    parse_mix(args.mix)
+    random.seed(args.seed)
+
+    backend = Backend(kind=args.backend, mongod=args.mongod, database_url=args.database_url)
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        # 配置在导入app时读取，需先设置环境变量
+        os.environ.update({
+            'database_url': backend.start() or args.database_url,
+            'database_name': args.database_name,
+            'src_path': os.path.join(workdir, 'src'),
+            'export_path': os.path.join(workdir, 'export'),
+            'cache_backend': 'local',
+            'debug': 'false',
+        })
+        os.makedirs(os.environ['export_path'])
+        from loguru import logger
+        logger.remove()
+        logger.add(sys.stderr, level='WARNING')
+        result = asyncio.get_event_loop().run_until_complete(run(args, backend))
+    finally:
+        backend.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
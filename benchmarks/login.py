@@ -0,0 +1,71 @@
+'''
+登录吞吐基准：并发执行bcrypt校验的同时，测量其他请求（模拟为简单协程）的延迟
+对比在事件循环中同步校验(verify_password)与线程池校验(verify_password_async)两种方式
+
+    python -m benchmarks.login --logins 50 --workers 4
+'''
+import argparse
+import asyncio
+import json
+import os
+import time
+
+
+def percentile(data, p):
+    data = sorted(data)
+    return data[min(int(len(data) * p / 100), len(data) - 1)] if data else 0
+
+
+async def other_requests(stop: asyncio.Event, latencies: list, interval: float = 0.005):
+    # 模拟其他接口：每个请求本身几乎不耗时，延迟完全来自事件循环排队
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0)
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(interval)
+
+
+async def run(mode: str, logins: int, hashed: str):
+    from app.utils.security import verify_password, verify_password_async
+    loop = asyncio.get_event_loop()
+
+    async def login():
+        if mode == 'sync':
+            return verify_password('welcome1', hashed)
+        return await verify_password_async('welcome1', hashed)
+
+    stop = asyncio.Event()
+    latencies = []
+    other = loop.create_task(other_requests(stop, latencies))
+    start = time.perf_counter()
+    await asyncio.gather(*[login() for _ in range(logins)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await other
+    return {
+        'mode': mode,
+        'logins': logins,
+        'login_per_second': round(logins / elapsed, 2),
+        'other_requests': len(latencies),
+        'other_p50_ms': round(percentile(latencies, 50), 3),
+        'other_p99_ms': round(percentile(latencies, 99), 3),
+        'other_max_ms': round(max(latencies) if latencies else 0, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=4, help='校验线程数(password_workers)')
+    args = parser.parse_args()
+    # 线程池在导入app.utils.security时按password_workers创建
+    os.environ['password_workers'] = str(args.workers)
+    from app.utils.security import get_password_hash_async
+    loop = asyncio.get_event_loop()
+    hashed = loop.run_until_complete(get_password_hash_async('welcome1'))
+    for mode in ['sync', 'executor']:
+        print(json.dumps(loop.run_until_complete(run(mode, args.logins, hashed))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''
+列表响应序列化基准：测量每1000行case_view文档输出为响应体的CPU耗时
+对比模型构建+jsonable_encoder+JSONResponse与dict直出+FastJSONResponse两种方式
+
+    python -m benchmarks.serialization --rows 1000 --repeat 20
+'''
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+import argparse
+import json
+import time
+# custom defined
+from app.crud.case import case_view_to_model, case_view_to_dict
+from app.utils.response import FastJSONResponse, orjson
+
+
+def make_rows(rows: int):
+    return [{
+        'case_id': f'{i:08d}',
+        'finished': False,
+        'analysis': [{
+            'is_main': j == 0,
+            'analysis': ['46,XX', 'inv(9)'],
+            'karyotype': '46,XX',
+            'user_id': f'u{j}',
+            'realname': f'用户{j}',
+            'update_time': '2021-06-01T08:00:00+08:00'
+        } for j in range(2)],
+        'count': {
+            'count': ['1', '2', '3'],
+            'extra': ['x'],
+            'remark': '备注',
+            'user_id': 'u2',
+            'realname': '用户2',
+            'update_time': '2021-06-01T08:00:00+08:00'
+        }
+    } for i in range(rows)]
+
+
+def model_path(data: list, user_id: str):
+    content = jsonable_encoder([case_view_to_model(data=x, user_id=user_id) for x in data])
+    return JSONResponse(content).body
+
+
+def fast_path(data: list, user_id: str):
+    return FastJSONResponse([case_view_to_dict(data=x, user_id=user_id) for x in data]).body
+
+
+def measure(func, data: list, user_id: str, repeat: int):
+    start = time.process_time()
+    for _ in range(repeat):
+        body = func(data, user_id)
+    return (time.process_time() - start) / repeat * 1000 / len(data) * 1000, body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    data = make_rows(args.rows)
+    for shape, user_id in [('total', None), ('user', 'u0')]:
+        before, body_before = measure(model_path, data, user_id, args.repeat)
+        after, body_after = measure(fast_path, data, user_id, args.repeat)
+        # 两种方式输出的内容必须一致
+        assert json.loads(body_before) == json.loads(body_after)
+        print(json.dumps({
+            'shape': shape,
+            'orjson': orjson is not None,
+            'before_ms_per_1000_rows': round(before, 3),
+            'after_ms_per_1000_rows': round(after, 3),
+            'speedup': round(before / after, 2) if after else None
+        }))
+
+
+if __name__ == '__main__':
+    main()
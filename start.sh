@@ -1,2 +1,3 @@
 #!/usr/bin/env bash
-uvicorn --host=0.0.0.0 app.main:app --workers=1
+# 扫描任务经租约选主只在一个worker执行，可按CPU核数设置workers；多worker时需配置cache_backend=redis，用户及列表缓存的失效才能到达所有worker
+uvicorn --host=0.0.0.0 app.main:app --workers=${workers:-1}
@@ -0,0 +1,58 @@
+from mongomock.collection import BulkOperationBuilder
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import BulkWriteError
+import pytest
+# custom defined
+from app.core.config import database_name
+from app.db.cache import cache, LocalBackend
+
+
+@pytest.fixture
+def conn():
+    return AsyncMongoMockClient()
+
+
+@pytest.fixture
+def db(conn):
+    return conn[database_name]
+
+
+@pytest.fixture(autouse=True)
+def local_cache():
+    # 每个测试使用独立的进程内缓存
+    cache.backend = LocalBackend()
+    yield cache
+
+
+@pytest.fixture(autouse=True)
+def mongomock_upsert_index(monkeypatch):
+    '''
+        mongomock的bulk_write按upsert的先后序号返回upserted的index，MongoDB返回的是请求在列表中的序号
+        BulkWriter据此确定新插入的文档，这里修正为与MongoDB一致
+    '''
+    execute = BulkOperationBuilder.execute
+
+    def wrapper(self, *args, **kwargs):
+        indexes = []
+
+        def track(index, func):
+            def exec_op():
+                result = func()
+                if result.get('upserted'):
+                    indexes.append(index)
+                return result
+            exec_op.__name__ = func.__name__
+            return exec_op
+
+        def fix(result):
+            for index, item in zip(indexes, result.get('upserted', [])):
+                item['index'] = index
+            return result
+
+        self.executors = [track(n, x) for n, x in enumerate(self.executors)]
+        try:
+            return fix(execute(self, *args, **kwargs))
+        except BulkWriteError as e:
+            fix(e.details)
+            raise
+    monkeypatch.setattr(BulkOperationBuilder, 'execute', wrapper)
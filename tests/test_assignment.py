@@ -0,0 +1,90 @@
+import pytest
+from app.models.user import DivisionGroupByGroup
+from app.utils.assignment import AssignmentTable, build_assignment, CREATED, UNASSIGNED, INVALID
+
+# (分析组[(组名, [(user_id, 分工数量)])], 计数[(组名, user_id, 分工数量)])
+DIVISIONS = [
+    ([('A', [('a1', 1), ('a2', 1)])], [('C', 'c1', 1)]),
+    ([('A', [('a1', 3), ('a2', 2)]), ('B', [('b1', 1), ('b2', 4)])], [('C1', 'c1', 2), ('C2', 'c2', 3)]),
+    ([('B', [('b1', 5), ('b2', 5)]), ('A', [('a1', 2), ('a2', 7)]), ('C', [('c1', 1), ('c2', 1)])],
+     [('D2', 'd2', 1), ('D1', 'd1', 4), ('D3', 'd3', 2)]),
+]
+
+
+def build_table(analysis, count):
+    data = [DivisionGroupByGroup(group_id=name, group_name=name, group_type='analysis', division=[
+        {'id': user_id, 'group_id': name, 'user_id': user_id, 'user_name': user_id, 'quantities': quantities,
+         'case_type': 'L'} for user_id, quantities in members
+    ]) for name, members in analysis]
+    data += [DivisionGroupByGroup(group_id=name, group_name=name, group_type='count', division=[
+        {'id': user_id, 'group_id': name, 'user_id': user_id, 'user_name': user_id, 'quantities': quantities,
+         'case_type': 'L'}
+    ]) for name, user_id, quantities in count]
+    return AssignmentTable(data).case_types['L']
+
+
+def baseline_analysis(analysis, number):
+    # 改为前缀和二分查找之前的逐组累减
+    groups = sorted(analysis, key=lambda n: n[0])
+    total = sum(sum(y[1] for y in x[1]) for x in groups)
+    cache = number % total
+    if cache == 0:
+        cache = total
+    for _, members in groups:
+        if cache - sum(y[1] for y in members) > 0:
+            cache = cache - sum(y[1] for y in members)
+        elif cache <= members[0][1]:
+            return members[0][0], members[1][0]
+        else:
+            return members[1][0], members[0][0]
+
+
+def baseline_count(count, number):
+    members = sorted(count, key=lambda n: n[0])
+    cache = number % sum(x[2] for x in members)
+    for _, user_id, quantities in members:
+        if cache < quantities:
+            return user_id
+        cache = cache - quantities
+
+
+def boundaries(bounds):
+    # 各区间边界及前后各一个编号，覆盖三轮取余
+    total = bounds[-1]
+    return sorted(set(x for k in range(3) for b in [0] + bounds for d in (-1, 0, 1)
+                      for x in [k * total + b + d] if x >= 0))
+
+
+@pytest.mark.parametrize('analysis, count', DIVISIONS)
+def test_resolve_analysis_matches_baseline(analysis, count):
+    compiled = build_table(analysis, count)
+    for number in boundaries(compiled.analysis_bounds):
+        main, aux = compiled.resolve_analysis(number)
+        assert (main[0], aux[0]) == baseline_analysis(analysis, number), number
+
+
+@pytest.mark.parametrize('analysis, count', DIVISIONS)
+def test_resolve_count_matches_baseline(analysis, count):
+    compiled = build_table(analysis, count)
+    for number in boundaries(compiled.count_bounds):
+        assert compiled.resolve_count(number)[0] == baseline_count(count, number), number
+
+
+def test_build_assignment_outcomes():
+    analysis, count = DIVISIONS[1]
+    table = AssignmentTable([])
+    table.case_types['L'] = build_table(analysis, count)
+    case_ids = ['L2104052638', 'G2104000001', 'X2104000001', 'L2104ab2638', 'L2104', 'L2104.1', 'L2104０５2638']
+    case_item, analysis_item, count_item, outcomes = build_assignment(table=table, case_ids=case_ids)
+    assert outcomes == {
+        'L2104052638': CREATED,
+        # G类型没有分工
+        'G2104000001': UNASSIGNED,
+        'X2104000001': INVALID,
+        'L2104ab2638': INVALID,
+        'L2104': INVALID,
+        'L2104.1': INVALID,
+        'L2104０５2638': INVALID,
+    }
+    assert [x.case_id for x in case_item] == ['L2104052638']
+    assert len(analysis_item) == 2 and len(count_item) == 1
@@ -0,0 +1,185 @@
+from mongomock_motor import AsyncMongoMockCollection
+import mongomock
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+import pytest
+# custom defined
+from app.core.config import case_collection_name, analysis_collection_name, count_collection_name, \
+    case_view_collection_name
+from app.crud.case import create_case_with_analysis_and_count
+from app.db import bulk
+from app.db.bulk import BulkWriter
+from app.models.case import CaseCreateModel, AnalysisCreateModel, CountCreateModel
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    async def sleep(_):
+        pass
+    monkeypatch.setattr(bulk.asyncio, 'sleep', sleep)
+
+
+def fail_on(monkeypatch, name: str, errors: list):
+    # 对指定集合的bulk_write依次抛出errors中的异常，之后正常写入
+    bulk_write = AsyncMongoMockCollection.bulk_write
+    calls = []
+
+    async def wrapper(self, requests, **kwargs):
+        if self.name == name:
+            calls.append(len(requests))
+            if errors:
+                raise errors.pop(0)
+        return await bulk_write(self, requests, **kwargs)
+    monkeypatch.setattr(AsyncMongoMockCollection, 'bulk_write', wrapper)
+    return calls
+
+
+def docs(*case_ids, **extra):
+    return [{'case_id': x, **extra} for x in case_ids]
+
+
+@pytest.mark.asyncio
+async def test_write_in_chunks(conn, db, monkeypatch):
+    calls = fail_on(monkeypatch, case_collection_name, [])
+    writer = BulkWriter(conn, chunk_size=2, transaction=False)
+    writer.add(case_collection_name, ['case_id'], docs('L1', 'L2', 'L3', 'L4', 'L5'))
+    summary = await writer.write()
+    assert calls == [2, 2, 1]
+    assert summary == {case_collection_name: {'upserted': 5, 'matched': 0, 'duplicates': 0}}
+    assert await db[case_collection_name].count_documents({}) == 5
+
+
+@pytest.mark.asyncio
+async def test_partial_duplicate_batch(conn, db):
+    await db[case_collection_name].insert_many(docs('L1', 'L3', remark='old'))
+    writer = BulkWriter(conn, chunk_size=2, transaction=False)
+    writer.add(case_collection_name, ['case_id'], docs('L1', 'L2', 'L3', 'L4', remark='new'))
+    summary = await writer.write()
+    assert summary == {case_collection_name: {'upserted': 2, 'matched': 2, 'duplicates': 0}}
+    assert [x['case_id'] for x in writer.inserted[case_collection_name]] == ['L2', 'L4']
+    # 已存在的文档不会被覆盖
+    result = {x['case_id']: x['remark'] async for x in db[case_collection_name].find()}
+    assert result == {'L1': 'old', 'L2': 'new', 'L3': 'old', 'L4': 'new'}
+    # 重复执行不产生重复数据
+    writer = BulkWriter(conn, transaction=False)
+    writer.add(case_collection_name, ['case_id'], docs('L1', 'L2', 'L3', 'L4'))
+    assert (await writer.write())[case_collection_name]['upserted'] == 0
+    assert writer.inserted[case_collection_name] == []
+    assert await db[case_collection_name].count_documents({}) == 4
+
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicate_key_counts_as_existing(conn, db, monkeypatch):
+    # 并发upsert同一key时其中一方得到重复键错误，视为已存在，其余文档照常计入
+    error = BulkWriteError({'writeErrors': [{'index': 0, 'code': bulk.DUPLICATE_KEY, 'errmsg': 'E11000'}],
+                            'nUpserted': 1, 'nMatched': 0, 'upserted': [{'index': 1, '_id': 'x'}]})
+    fail_on(monkeypatch, case_collection_name, [error])
+    writer = BulkWriter(conn, transaction=False)
+    writer.add(case_collection_name, ['case_id'], docs('L1', 'L2'))
+    summary = await writer.write()
+    assert summary == {case_collection_name: {'upserted': 1, 'matched': 0, 'duplicates': 1}}
+    assert [x['case_id'] for x in writer.inserted[case_collection_name]] == ['L2']
+
+
+@pytest.mark.asyncio
+async def test_other_write_errors_raise(conn, monkeypatch):
+    error = BulkWriteError({'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'validation'}]})
+    fail_on(monkeypatch, case_collection_name, [error])
+    writer = BulkWriter(conn, transaction=False)
+    writer.add(case_collection_name, ['case_id'], docs('L1'))
+    with pytest.raises(BulkWriteError):
+        await writer.write()
+
+
+@pytest.mark.asyncio
+async def test_retry_after_transient_error(conn, db, monkeypatch):
+    calls = fail_on(monkeypatch, case_collection_name, [AutoReconnect('reset'), AutoReconnect('reset')])
+    writer = BulkWriter(conn, retries=2, transaction=False)
+    writer.add(case_collection_name, ['case_id'], docs('L1', 'L2'))
+    summary = await writer.write()
+    assert len(calls) == 3
+    assert summary[case_collection_name]['upserted'] == 2
+    assert await db[case_collection_name].count_documents({}) == 2
+
+
+@pytest.mark.asyncio
+async def test_retries_exhausted(conn, monkeypatch):
+    calls = fail_on(monkeypatch, case_collection_name, [AutoReconnect('reset')] * 3)
+    writer = BulkWriter(conn, retries=2, transaction=False)
+    writer.add(case_collection_name, ['case_id'], docs('L1'))
+    with pytest.raises(AutoReconnect):
+        await writer.write()
+    assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_non_transient_error_not_retried(conn, monkeypatch):
+    calls = fail_on(monkeypatch, case_collection_name, [OperationFailure('bad', code=2)])
+    writer = BulkWriter(conn, retries=2, transaction=False)
+    writer.add(case_collection_name, ['case_id'], docs('L1'))
+    with pytest.raises(OperationFailure):
+        await writer.write()
+    assert len(calls) == 1
+
+
+class FakeSession:
+    # mongomock不支持事务，只模拟会话接口，用于验证事务重试逻辑
+
+    def __init__(self):
+        self.transactions = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def start_transaction(self):
+        self.transactions += 1
+        return self
+
+
+@pytest.mark.asyncio
+async def test_transaction_retried_as_a_whole(conn, db, monkeypatch, request):
+    session = FakeSession()
+
+    async def start_session():
+        return session
+    monkeypatch.setattr(conn, 'start_session', start_session, raising=False)
+    mongomock.ignore_feature('session')
+    request.addfinalizer(lambda: mongomock.warn_on_feature('session'))
+    transient = OperationFailure('conflict', code=112)
+    transient._add_error_label('TransientTransactionError')
+    calls = fail_on(monkeypatch, count_collection_name, [transient])
+    writer = BulkWriter(conn, retries=2, transaction=True)
+    writer.add(analysis_collection_name, ['case_id'], docs('L1'))
+    writer.add(count_collection_name, ['case_id'], docs('L1'))
+    summary = await writer.write()
+    assert session.transactions == 2 and len(calls) == 2
+    # 事务内单批不单独重试，重试时重新统计
+    assert summary[count_collection_name]['upserted'] == 1
+    assert list(writer.inserted) == [analysis_collection_name, count_collection_name]
+
+
+def case_items(*case_ids):
+    return dict(
+        case_item=[CaseCreateModel(case_id=x) for x in case_ids],
+        analysis_item=[AnalysisCreateModel(case_id=x, user_id=y, user_name=y, is_main=y == 'u1')
+                       for x in case_ids for y in ['u1', 'u2']],
+        count_item=[CountCreateModel(case_id=x, user_id='u3', user_name='u3') for x in case_ids])
+
+
+@pytest.mark.asyncio
+async def test_failure_partway_leaves_no_case_row(conn, db, monkeypatch):
+    fail_on(monkeypatch, case_view_collection_name, [OperationFailure('bad', code=2)])
+    with pytest.raises(OperationFailure):
+        await create_case_with_analysis_and_count(conn=conn, transaction=False, **case_items('L2104000001'))
+    # analysis、count已写入，case最后写入，失败时不存在，重新扫描或导入会再次处理
+    assert await db[analysis_collection_name].count_documents({}) == 2
+    assert await db[count_collection_name].count_documents({}) == 1
+    assert await db[case_collection_name].count_documents({}) == 0
+    summary, inserted = await create_case_with_analysis_and_count(conn=conn, transaction=False,
+                                                                  **case_items('L2104000001'))
+    assert inserted == {'L2104000001'}
+    assert summary[analysis_collection_name]['matched'] == 2
+    assert summary[case_view_collection_name]['upserted'] == 1
+    assert await db[case_collection_name].count_documents({}) == 1
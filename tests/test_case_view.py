@@ -0,0 +1,36 @@
+import pytest
+from app.core.config import case_collection_name, case_view_collection_name
+from app.crud.case import create_case_with_analysis_and_count, update_case_finished, sync_case_view_finished
+from app.models.case import CaseCreateModel, AnalysisCreateModel, CountCreateModel
+
+
+async def create_cases(conn, case_ids):
+    await create_case_with_analysis_and_count(
+        conn=conn, case_item=[CaseCreateModel(case_id=x) for x in case_ids],
+        analysis_item=[AnalysisCreateModel(case_id=x, user_id=y, user_name=y, is_main=y == 'u1')
+                       for x in case_ids for y in ['u1', 'u2']],
+        count_item=[CountCreateModel(case_id=x, user_id='u3', user_name='u3') for x in case_ids],
+        transaction=False)
+
+
+async def view_finished(db):
+    return {x['case_id']: x['finished'] async for x in db[case_view_collection_name].find()}
+
+
+@pytest.mark.asyncio
+async def test_update_case_finished_writes_case_view(conn, db):
+    await create_cases(conn, ['L2104000001', 'L2104000002'])
+    await update_case_finished(conn=conn, case_ids=['L2104000001'], finished=True)
+    assert await view_finished(db) == {'L2104000001': True, 'L2104000002': False}
+    assert (await db[case_collection_name].find_one({'case_id': 'L2104000001'}))['finished'] is True
+    await update_case_finished(conn=conn, case_ids=['L2104000001'], finished=False)
+    assert await view_finished(db) == {'L2104000001': False, 'L2104000002': False}
+
+
+@pytest.mark.asyncio
+async def test_sync_case_view_finished_picks_up_external_writes(conn, db):
+    await create_cases(conn, ['L2104000001', 'L2104000002'])
+    await db[case_collection_name].update_one({'case_id': 'L2104000002'}, {'$set': {'finished': True}})
+    assert await sync_case_view_finished(conn=conn) == ['L2104000002']
+    assert await view_finished(db) == {'L2104000001': False, 'L2104000002': True}
+    assert await sync_case_view_finished(conn=conn) == []
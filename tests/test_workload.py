@@ -0,0 +1,70 @@
+import pytest
+from app.core.config import analysis_collection_name, count_collection_name
+from app.crud.case import create_case_with_analysis_and_count
+from app.crud.workload import finish_workload, get_workload_list, rebuild_workload
+from app.models.case import CaseCreateModel, AnalysisCreateModel, CountCreateModel
+
+
+async def create_cases(conn, case_ids):
+    await create_case_with_analysis_and_count(
+        conn=conn, case_item=[CaseCreateModel(case_id=x) for x in case_ids],
+        analysis_item=[AnalysisCreateModel(case_id=x, user_id=y, user_name=y, is_main=y == 'u1')
+                       for x in case_ids for y in ['u1', 'u2']],
+        count_item=[CountCreateModel(case_id=x, user_id='u3', user_name='u3') for x in case_ids],
+        transaction=False)
+
+
+async def workload(conn):
+    return {x['user_id']: (x['pending'], x['finished']) for x in await get_workload_list(conn=conn)}
+
+
+def work(ma=0, sa=0, c=0):
+    return {'C': c, 'MA': ma, 'SA': sa}
+
+
+async def submit(db, conn, case_ids):
+    await db[count_collection_name].update_many({'case_id': {'$in': case_ids}}, {'$set': {'count': [46]}})
+    await finish_workload(conn=conn, task='count', user_id='u3', case_ids=case_ids)
+
+
+@pytest.mark.asyncio
+async def test_assigned_workload(conn):
+    await create_cases(conn, ['L2104000001', 'L2104000002'])
+    # 重复入库不重复计入
+    await create_cases(conn, ['L2104000001', 'L2104000002'])
+    assert await workload(conn) == {
+        'u1': (work(ma=2), work()),
+        'u2': (work(sa=2), work()),
+        'u3': (work(c=2), work()),
+    }
+
+
+@pytest.mark.asyncio
+async def test_double_submission_counts_once(conn, db):
+    await create_cases(conn, ['L2104000001', 'L2104000002'])
+    await submit(db, conn, ['L2104000001', 'L2104000002'])
+    await submit(db, conn, ['L2104000001', 'L2104000002'])
+    assert (await workload(conn))['u3'] == (work(), work(c=2))
+    # 未提交结果的任务不计入
+    await db[analysis_collection_name].update_one({'case_id': 'L2104000001', 'user_id': 'u1'},
+                                                  {'$set': {'karyotype': ''}})
+    await finish_workload(conn=conn, task='analysis', user_id='u1', case_ids=['L2104000001'])
+    assert (await workload(conn))['u1'] == (work(ma=2), work())
+
+
+@pytest.mark.asyncio
+async def test_legacy_row_submission(conn, db):
+    await create_cases(conn, ['L2104000001'])
+    # 上线前已存在、未计入待完成的任务，工作量集合非空所以启动时没有重新统计
+    await db[count_collection_name].insert_one({'case_id': 'L2103000009', 'user_id': 'u3', 'is_main': None})
+    await submit(db, conn, ['L2103000009'])
+    await submit(db, conn, ['L2103000009'])
+    data = await get_workload_list(conn=conn)
+    rows = {x['month']: (x['pending']['C'], x['finished']['C']) for y in data if y['user_id'] == 'u3'
+            for x in y['detail']}
+    assert rows == {'2104': (1, 0), '2103': (0, 1)}
+    # 已补counted标记，之后入库或重新统计结果一致
+    await create_cases(conn, ['L2104000001'])
+    before = await workload(conn)
+    await rebuild_workload(conn=conn)
+    assert await workload(conn) == before